@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+"""
+DeSC-Nalmefene 医療機関別F10.2患者数作成スクリプト
+
+このスクリプトは、全ての疾患ファイル（receipt_diseases）のF10.2レコードを
+レセプト(医療機関)（receipt_medical_institution）と結合し、
+(iryokikan_no, fiscal_year, distinct_patients) の表として保存します。
+create_analysis_dataset.py は専門医療機関の判定にこの表のみを用います。
+元ファイルより新しい表が既にある場合は再作成しません。
+"""
+
+import os
+import sys
+# Add project root to sys.path to allow importing from 'utils'
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+import logging
+import time
+from typing import List
+import polars as pl
+from utils.env_loader import DATA_ROOT_DIR as ENV_DATA_ROOT_DIR
+from utils.partition_index import load_diseases_code_index, select_files_for_codes
+from utils.table_io import find_table, list_table_files, read_table
+from utils.comorbidity_engine import build_category_lookup
+from utils.institution_volume import (DEFAULT_INSTITUTION_VOLUME_PATH, build_institution_volume,
+                                      volume_quantiles)
+
+# Create local logs directory before setting up logging
+os.makedirs("outputs/logs", exist_ok=True)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('outputs/logs/build_institution_volume.log'),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+class Config:
+    # 月次ファイルの読み込み元（create_analysis_dataset.py と同じ raw/ 配下）
+    DISEASE_DIR = os.path.join(ENV_DATA_ROOT_DIR, "raw", "receipt_diseases")
+    INSTITUTION_DIR = os.path.join(ENV_DATA_ROOT_DIR, "raw", "receipt_medical_institution")
+    # ICD10マスター（create_analysis_dataset.py と同じ master/）
+    MASTER_DIR = "master"
+    # icd10_code の前方一致（create_analysis_dataset.py と同じ）。標準病名（icd10_kbn_code = 1）のみ
+    F10_2_ICD10_CODE = "F102"
+
+    # 医療機関別患者数の出力先
+    OUTPUT_PATH = DEFAULT_INSTITUTION_VOLUME_PATH
+
+    # ログに出力する分位点
+    QUANTILES = [0.5, 0.75, 0.9, 0.95, 0.99]
+
+    # Trueの場合、既存の表も作り直す
+    REBUILD_ALL = False
+
+def is_up_to_date(output_path: str, source_files: List[str]) -> bool:
+    """出力ファイルが元ファイルより新しいか"""
+    if not os.path.exists(output_path):
+        return False
+    output_mtime = os.path.getmtime(output_path)
+    return all(os.path.getmtime(f) <= output_mtime for f in source_files)
+
+def main():
+    """メイン処理"""
+    logger.info("DeSC-Nalmefene 医療機関別F10.2患者数の作成を開始します")
+    start_time = time.time()
+
+    icd10_file = find_table(Config.MASTER_DIR, "m_icd10")
+    if icd10_file is None:
+        logger.error(f"ICD10マスターファイルが見つかりません: {Config.MASTER_DIR}")
+        return
+    disease_files = list_table_files(Config.DISEASE_DIR, "receipt_diseases")
+    institution_files = list_table_files(Config.INSTITUTION_DIR, "receipt_medical_institution")
+    if not disease_files or not institution_files:
+        logger.error(f"疾患ファイルまたはレセプト(医療機関)ファイルが見つかりません: "
+                     f"{Config.DISEASE_DIR}, {Config.INSTITUTION_DIR}")
+        return
+
+    if not Config.REBUILD_ALL and is_up_to_date(Config.OUTPUT_PATH, [icd10_file] + disease_files + institution_files):
+        logger.info(f"医療機関別F10.2患者数は最新のため再作成しません: {Config.OUTPUT_PATH}")
+        return
+
+    icd10_master = read_table(icd10_file)
+    f10_2_diseases_codes = (build_category_lookup(icd10_master, {"f10_2": [Config.F10_2_ICD10_CODE]})
+                            ["diseases_code"].to_list())
+    logger.info(f"F10.2 の diseases_code: {len(f10_2_diseases_codes)} 件")
+
+    # F10.2を含み得る疾患ファイルのみを読み込む
+    disease_files = select_files_for_codes(disease_files, f10_2_diseases_codes,
+                                           load_diseases_code_index(Config.DISEASE_DIR))
+    logger.info(f"疾患ファイル {len(disease_files)} 件、レセプト(医療機関)ファイル {len(institution_files)} 件を集計します")
+
+    volume = build_institution_volume(disease_files, institution_files, f10_2_diseases_codes)
+    logger.info(f"医療機関・年度: {len(volume)} 件（医療機関 {volume['iryokikan_no'].n_unique()} 件）")
+
+    os.makedirs(os.path.dirname(Config.OUTPUT_PATH), exist_ok=True)
+    # 書き込み途中のファイルを読まれないよう、一時ファイルに書いてから置き換える
+    tmp_path = Config.OUTPUT_PATH + ".tmp"
+    volume.write_ipc(tmp_path, compression="zstd")
+    os.replace(tmp_path, Config.OUTPUT_PATH)
+    logger.info(f"医療機関別F10.2患者数を保存しました: {Config.OUTPUT_PATH}")
+
+    overall = volume_quantiles(volume, Config.QUANTILES).filter(pl.col("fiscal_year").is_null())
+    for row in overall.iter_rows(named=True):
+        logger.info(f"年間患者数の {row['quantile']:.0%} 分位点: {row['distinct_patients']:.0f} 人")
+
+    end_time = time.time()
+    logger.info(f"医療機関別F10.2患者数の作成が完了しました。処理時間: {end_time - start_time:.2f}秒")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+DeSC-Nalmefene パーティションインデックス作成スクリプト
+
+このスクリプトは、月次の疾患ファイル（receipt_diseases）毎に含まれる
+diseases_codeと行数、およびコホート単位の読み込みで使うファイル毎の
+kojin_idサマリー（min/max・Bloomフィルタ）を作成し、サイドカーファイルとして保存します。
+既存のインデックスがある場合は、追加・更新されたファイルのみを集計します。
+"""
+
+import os
+import sys
+# Add project root to sys.path to allow importing from 'utils'
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+import logging
+import time
+from typing import List
+from utils.env_loader import DATA_ROOT_DIR as ENV_DATA_ROOT_DIR
+from utils.partition_index import update_diseases_code_index, update_kojin_id_summary
+from utils.canonical_schema import DEFAULT_CANONICAL_ROOT_DIR
+from utils.table_io import list_table_files
+from utils.working_copy import DEFAULT_WORKING_COPY_DIR
+
+# Create local logs directory before setting up logging
+os.makedirs("outputs/logs", exist_ok=True)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('outputs/logs/build_partition_index.log'),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+class Config:
+    DATA_ROOT_DIR = ENV_DATA_ROOT_DIR
+    
+    # インデックスを作成する疾患ファイルディレクトリ
+    # extract_f10_2_patients.py は DATA_ROOT_DIR 直下、create_analysis_dataset.py は raw/ 配下を参照する
+    # （正規化済みデータ・作業コピーがある場合はどちらも canonical/・mmap/ 配下を参照する）
+    DISEASE_DIRS = [
+        os.path.join(ENV_DATA_ROOT_DIR, "receipt_diseases"),
+        os.path.join(ENV_DATA_ROOT_DIR, "raw", "receipt_diseases"),
+        os.path.join(DEFAULT_CANONICAL_ROOT_DIR, "receipt_diseases"),
+        os.path.join(DEFAULT_WORKING_COPY_DIR, "receipt_diseases")
+    ]
+    
+    # kojin_idサマリーを作成するファイル群（ディレクトリ, ファイル名の接頭辞）
+    # create_analysis_dataset.py のコホート単位の読み込みが対象
+    KOJIN_ID_SUMMARY_TARGETS = [
+        (os.path.join(ENV_DATA_ROOT_DIR, "raw", "receipt_diseases"), "receipt_diseases"),
+        (os.path.join(ENV_DATA_ROOT_DIR, "raw", "receipt_drug"), "receipt_drug_"),
+        (os.path.join(ENV_DATA_ROOT_DIR, "raw"), "exam_interview_processed"),
+        # 正規化済みデータ（convert_canonical_storage.py で作成）がある場合はそちらも対象
+        (os.path.join(DEFAULT_CANONICAL_ROOT_DIR, "receipt_diseases"), "receipt_diseases"),
+        (os.path.join(DEFAULT_CANONICAL_ROOT_DIR, "receipt_drug"), "receipt_drug_"),
+        (DEFAULT_CANONICAL_ROOT_DIR, "exam_interview_processed"),
+        # メモリマップ用作業コピー（build_working_copy.py で作成）がある場合はそちらも対象
+        (os.path.join(DEFAULT_WORKING_COPY_DIR, "receipt_diseases"), "receipt_diseases"),
+        (os.path.join(DEFAULT_WORKING_COPY_DIR, "receipt_drug"), "receipt_drug_")
+    ]
+
+def list_partition_files(partition_dir: str, prefix: str) -> List[str]:
+    """パーティションディレクトリ内の月次ファイル（Feather・Parquet）のリストを取得"""
+    return list_table_files(partition_dir, prefix)
+
+def main():
+    """メイン処理"""
+    logger.info("DeSC-Nalmefene パーティションインデックスの作成を開始します")
+    start_time = time.time()
+    
+    # 同じディレクトリを二重に処理しないよう実パスで重複を除く
+    disease_dirs = []
+    for disease_dir in Config.DISEASE_DIRS:
+        if not os.path.isdir(disease_dir):
+            logger.warning(f"疾患ファイルディレクトリが見つかりません: {disease_dir}")
+            continue
+        if os.path.realpath(disease_dir) not in [os.path.realpath(d) for d in disease_dirs]:
+            disease_dirs.append(disease_dir)
+    
+    for disease_dir in disease_dirs:
+        disease_files = list_partition_files(disease_dir, "receipt_diseases")
+        logger.info(f"{disease_dir}: 疾患ファイル {len(disease_files)} 件")
+        update_diseases_code_index(disease_dir, disease_files)
+    
+    for target_dir, prefix in Config.KOJIN_ID_SUMMARY_TARGETS:
+        if not os.path.isdir(target_dir):
+            logger.warning(f"ディレクトリが見つかりません: {target_dir}")
+            continue
+        target_files = list_partition_files(target_dir, prefix)
+        logger.info(f"{target_dir}: {prefix}* ファイル {len(target_files)} 件")
+        update_kojin_id_summary(target_dir, target_files)
+    
+    end_time = time.time()
+    logger.info(f"パーティションインデックスの作成が完了しました。処理時間: {end_time - start_time:.2f}秒")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+DeSC-Nalmefene 患者バケットレイアウト作成スクリプト
+
+このスクリプトは、月次の薬剤・薬剤算定日・疾患ファイルを、kojin_idのハッシュで
+N個のバケットに振り分け、バケット内をkojin_idと日付で並べ替えて保存します。
+コホート単位の特徴量作成では、対象患者が属するバケットのみを読み込めば済むようになります。
+"""
+
+import os
+import sys
+# Add project root to sys.path to allow importing from 'utils'
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+import logging
+import polars as pl
+import gc
+import time
+import tempfile
+import shutil
+from typing import Dict, List
+from tqdm import tqdm
+from utils.env_loader import DATA_ROOT_DIR as ENV_DATA_ROOT_DIR
+from utils.table_io import scan_table
+from utils.patient_buckets import (BUCKETED_DATASETS, DEFAULT_BUCKET_ROOT_DIR, DEFAULT_NUM_BUCKETS,
+                                   LAYOUT_FILENAME, bucket_expr, get_bucket_file_path, get_source_signatures,
+                                   list_monthly_files, save_bucket_layout)
+
+# Create local logs directory before setting up logging
+os.makedirs("outputs/logs", exist_ok=True)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('outputs/logs/build_patient_buckets.log'),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+class Config:
+    # 月次ファイルの読み込み元（create_analysis_dataset.py と同じ raw/ 配下）
+    RAW_DATA_DIR = os.path.join(ENV_DATA_ROOT_DIR, "raw")
+
+    # バケットデータセットの出力先
+    BUCKET_ROOT_DIR = DEFAULT_BUCKET_ROOT_DIR
+
+    NUM_BUCKETS = DEFAULT_NUM_BUCKETS
+
+def get_monthly_files(source_dir: str, prefix: str) -> List[str]:
+    """月次ファイルのリストを取得"""
+    if not os.path.isdir(source_dir):
+        logger.warning(f"ディレクトリが見つかりません: {source_dir}")
+        return []
+    return list_monthly_files(source_dir, prefix)
+
+def split_into_bucket_parts(monthly_files: List[str], parts_dir: str, num_buckets: int):
+    """月次ファイルを1件ずつ読み込み、バケット毎の部分ファイルに書き出す"""
+    for i, file_path in enumerate(tqdm(monthly_files, desc="バケット振り分け", unit="file")):
+        df = (scan_table(file_path)
+              .with_columns(pl.col("kojin_id").cast(pl.Int64))
+              .with_columns(bucket_expr(num_buckets))
+              .collect())
+
+        for (bucket,), part in df.partition_by("bucket", as_dict=True, include_key=False).items():
+            bucket_dir = os.path.join(parts_dir, f"bucket_{bucket:03d}")
+            os.makedirs(bucket_dir, exist_ok=True)
+            part.write_ipc(os.path.join(bucket_dir, f"part_{i:04d}.feather"), compression="zstd")
+
+        del df
+        gc.collect()
+
+def merge_bucket_parts(parts_dir: str, bucket_root: str, dataset: str,
+                       sort_keys: List[str], num_buckets: int) -> Dict[str, int]:
+    """バケット毎に部分ファイルを結合・並べ替えて保存"""
+    os.makedirs(os.path.join(bucket_root, dataset), exist_ok=True)
+    row_counts = {}
+    for bucket in tqdm(range(num_buckets), desc="バケット書き込み", unit="bucket"):
+        bucket_dir = os.path.join(parts_dir, f"bucket_{bucket:03d}")
+        output_path = get_bucket_file_path(bucket_root, dataset, bucket)
+        if not os.path.isdir(bucket_dir):
+            # 該当患者のいないバケットは古いファイルが残らないよう削除しておく
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            continue
+
+        bucket_df = (pl.scan_ipc(os.path.join(bucket_dir, "*.feather"), memory_map=False)
+                     .sort(sort_keys)
+                     .collect())
+        bucket_df.write_ipc(output_path, compression="zstd")
+        row_counts[os.path.basename(output_path)] = len(bucket_df)
+
+        del bucket_df
+        shutil.rmtree(bucket_dir)
+        gc.collect()
+    return row_counts
+
+def build_bucketed_dataset(dataset: str, spec: Dict, bucket_root: str, num_buckets: int) -> Dict:
+    """1データセット分のバケットレイアウトを作成"""
+    source_dir = os.path.join(Config.RAW_DATA_DIR, dataset)
+    monthly_files = get_monthly_files(source_dir, spec["prefix"])
+    if not monthly_files:
+        logger.warning(f"{dataset}: 月次ファイルが見つからないためスキップします")
+        return {}
+
+    logger.info(f"{dataset}: 月次ファイル {len(monthly_files)} 件を {num_buckets} バケットに再配置します")
+    # 読み込み側が元ファイルの追加・更新を検知できるよう、振り分け前の状態を記録する
+    source_signatures = get_source_signatures(monthly_files)
+    # 部分ファイルは出力先と同じディスク上に作成し、処理後に必ず削除する
+    parts_dir = tempfile.mkdtemp(prefix=f"{dataset}_parts_", dir=bucket_root)
+    try:
+        split_into_bucket_parts(monthly_files, parts_dir, num_buckets)
+        row_counts = merge_bucket_parts(parts_dir, bucket_root, dataset, spec["sort_keys"], num_buckets)
+    finally:
+        shutil.rmtree(parts_dir, ignore_errors=True)
+
+    logger.info(f"{dataset}: {len(row_counts)} バケット, {sum(row_counts.values())} 行を保存しました")
+    return {
+        "source_dir": source_dir,
+        "source_files": [os.path.basename(f) for f in monthly_files],
+        "source_signatures": source_signatures,
+        "sort_keys": spec["sort_keys"],
+        "row_counts": row_counts
+    }
+
+def main():
+    """メイン処理"""
+    logger.info("DeSC-Nalmefene 患者バケットレイアウトの作成を開始します")
+    start_time = time.time()
+
+    os.makedirs(Config.BUCKET_ROOT_DIR, exist_ok=True)
+
+    # 再作成中は読み込み側が月次ファイルを使うよう、既存のレイアウト情報を先に削除する
+    layout_path = os.path.join(Config.BUCKET_ROOT_DIR, LAYOUT_FILENAME)
+    if os.path.exists(layout_path):
+        os.remove(layout_path)
+
+    datasets = {}
+    for dataset, spec in BUCKETED_DATASETS.items():
+        dataset_layout = build_bucketed_dataset(dataset, spec, Config.BUCKET_ROOT_DIR, Config.NUM_BUCKETS)
+        if dataset_layout:
+            datasets[dataset] = dataset_layout
+
+    if not datasets:
+        logger.error("バケット化できるデータセットがなかったため処理を終了します")
+        return
+
+    # 全バケットの書き込みが終わってからレイアウト情報を保存し、読み込み側に公開する
+    save_bucket_layout(Config.BUCKET_ROOT_DIR, {
+        "num_buckets": Config.NUM_BUCKETS,
+        "datasets": datasets
+    })
+
+    end_time = time.time()
+    logger.info(f"患者バケットレイアウトの作成が完了しました。処理時間: {end_time - start_time:.2f}秒")
+
+if __name__ == "__main__":
+    main()
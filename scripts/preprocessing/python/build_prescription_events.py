@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+DeSC-Nalmefene 処方イベントデータセット作成スクリプト
+
+このスクリプトは、月次の薬剤ファイル（receipt_drug）と薬剤算定日ファイル
+（receipt_drug_santei_ymd）を月毎に一度だけ結合し、
+(kojin_id, shohou_ymd[Date], drug_code, receipt_id, line_no) の処方イベントとして保存します。
+元ファイルより新しいイベントファイルが既にある月は再作成しません。
+"""
+
+import os
+import sys
+# Add project root to sys.path to allow importing from 'utils'
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+import logging
+import gc
+import time
+from tqdm import tqdm
+from utils.partition_index import update_kojin_id_summary
+from utils.prescription_events import (DEFAULT_PRESCRIPTION_EVENT_SOURCE_DIR, DEFAULT_PRESCRIPTION_EVENTS_DIR,
+                                       build_monthly_prescription_events, get_event_file_path,
+                                       get_santei_file_path, is_event_file_current,
+                                       list_prescription_event_files, list_source_drug_files)
+
+# Create local logs directory before setting up logging
+os.makedirs("outputs/logs", exist_ok=True)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('outputs/logs/build_prescription_events.log'),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+class Config:
+    # 月次ファイルの読み込み元（create_analysis_dataset.py と同じ raw/ 配下。読み込み側もこの月次ファイルと照合する）
+    SOURCE_DIR = DEFAULT_PRESCRIPTION_EVENT_SOURCE_DIR
+    DRUG_DIR = os.path.join(SOURCE_DIR, "receipt_drug")
+    SANTEI_DIR = os.path.join(SOURCE_DIR, "receipt_drug_santei_ymd")
+
+    # 処方イベントデータセットの出力先
+    EVENTS_DIR = DEFAULT_PRESCRIPTION_EVENTS_DIR
+
+    # Trueの場合、既存のイベントファイルも全て作り直す
+    REBUILD_ALL = False
+
+def main():
+    """メイン処理"""
+    logger.info("DeSC-Nalmefene 処方イベントデータセットの作成を開始します")
+    start_time = time.time()
+
+    drug_files = list_source_drug_files(Config.SOURCE_DIR)
+    if not drug_files:
+        logger.error(f"薬剤ファイルが見つかりません: {Config.DRUG_DIR}")
+        return
+
+    os.makedirs(Config.EVENTS_DIR, exist_ok=True)
+
+    built, skipped, missing = 0, 0, 0
+    for drug_file in tqdm(drug_files, desc="処方イベント作成", unit="file"):
+        santei_file = get_santei_file_path(drug_file, Config.SANTEI_DIR)
+        if not os.path.exists(santei_file):
+            logger.warning(f"対応する薬剤算定日ファイルがありません: {os.path.basename(santei_file)}")
+            missing += 1
+            continue
+
+        event_file = get_event_file_path(drug_file, Config.EVENTS_DIR)
+        if not Config.REBUILD_ALL and is_event_file_current(event_file, [drug_file, santei_file]):
+            skipped += 1
+            continue
+
+        events = build_monthly_prescription_events(drug_file, santei_file)
+        # 書き込み途中のファイルを読まれないよう、一時ファイルに書いてから置き換える
+        tmp_file = event_file + ".tmp"
+        events.write_ipc(tmp_file, compression="zstd")
+        os.replace(tmp_file, event_file)
+        built += 1
+
+        del events
+        gc.collect()
+
+    logger.info(f"作成: {built} 件, 最新のためスキップ: {skipped} 件, 算定日ファイルなし: {missing} 件")
+
+    # コホート患者を含まない月をスキップできるよう、kojin_idサマリーも更新する
+    event_files = list_prescription_event_files(Config.EVENTS_DIR)
+    update_kojin_id_summary(Config.EVENTS_DIR, event_files)
+
+    end_time = time.time()
+    logger.info(f"処方イベントデータセットの作成が完了しました。処理時間: {end_time - start_time:.2f}秒")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+DeSC-Nalmefene メモリマップ用作業コピー作成スクリプト
+
+このスクリプトは、頻繁に読み込むテーブル（receipt_diseases、receipt_drug、tekiyo、m_icd10）を
+非圧縮のArrow IPC（.arrow）として mmap/ 配下に複製します。
+同じ計算ノードで分析を繰り返す場合、読み込みはzstdの展開なしにページキャッシュから行われます。
+正規化済みデータ（canonical/）がある場合はそちらから、なければ raw/ から複製します。
+"""
+
+import os
+import sys
+# Add project root to sys.path to allow importing from 'utils'
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+import logging
+import gc
+import time
+from typing import Dict, List
+from tqdm import tqdm
+from utils.env_loader import DATA_ROOT_DIR as ENV_DATA_ROOT_DIR
+from utils.canonical_schema import DEFAULT_CANONICAL_ROOT_DIR, resolve_data_dir
+from utils.partition_index import get_file_signature
+from utils.table_io import find_table, get_table_path, list_table_files, read_table, table_name, write_table
+from utils.working_copy import (DEFAULT_WORKING_COPY_DIR, HOT_TABLES, WORKING_COPY_MANIFEST_FILENAME,
+                                load_working_copy_manifest, save_working_copy_manifest)
+
+# Create local logs directory before setting up logging
+os.makedirs("outputs/logs", exist_ok=True)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('outputs/logs/build_working_copy.log'),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+class Config:
+    # 複製元（正規化済みデータがあればそちらを優先）
+    SOURCE_DATA_DIR = resolve_data_dir(os.path.join(ENV_DATA_ROOT_DIR, "raw"), DEFAULT_CANONICAL_ROOT_DIR)
+
+    # m_icd10 は extract_f10_2_patients.py と同じく DATA_ROOT_DIR 直下、なければ master/ から複製する
+    MASTER_DIRS = [ENV_DATA_ROOT_DIR, os.path.join(project_root, "master")]
+
+    # 作業コピーの出力先
+    WORKING_COPY_DIR = DEFAULT_WORKING_COPY_DIR
+
+def get_source_files(table: str, partitioned: bool) -> List[str]:
+    """テーブルの複製元ファイルのリスト"""
+    if partitioned:
+        return list_table_files(os.path.join(Config.SOURCE_DATA_DIR, table), table)
+    source_dirs = Config.MASTER_DIRS if table.startswith("m_") else [Config.SOURCE_DATA_DIR]
+    for source_dir in source_dirs:
+        source_file = find_table(source_dir, table)
+        if source_file is not None:
+            return [source_file]
+    return []
+
+def copy_table(table: str, partitioned: bool, previous: Dict) -> Dict:
+    """1テーブル分の作業コピーを作成（変更のないファイルはスキップ）"""
+    source_files = get_source_files(table, partitioned)
+    if not source_files:
+        logger.warning(f"{table}: 複製元ファイルが見つからないためスキップします")
+        return {}
+
+    output_dir = os.path.join(Config.WORKING_COPY_DIR, table) if partitioned else Config.WORKING_COPY_DIR
+    os.makedirs(output_dir, exist_ok=True)
+
+    files = {}
+    copied = 0
+    for source_file in tqdm(source_files, desc=f"{table} 複製", unit="file"):
+        output_file = get_table_path(output_dir, table_name(source_file), "arrow")
+        file_size, file_mtime = get_file_signature(source_file)
+        entry = previous.get("files", {}).get(os.path.basename(output_file))
+        if (entry is not None and os.path.exists(output_file) and entry["source"] == source_file
+                and entry["source_size"] == file_size and entry["source_mtime"] == file_mtime):
+            files[os.path.basename(output_file)] = entry
+            continue
+
+        df = read_table(source_file)
+        write_table(df, output_file)
+        files[os.path.basename(output_file)] = {
+            "source": source_file,
+            "source_size": file_size,
+            "source_mtime": file_mtime
+        }
+        copied += 1
+        del df
+        gc.collect()
+
+    # 複製元から削除されたファイルは作業コピーからも削除する
+    for stale_name in set(previous.get("files", {})) - set(files):
+        stale_path = os.path.join(output_dir, stale_name)
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+
+    logger.info(f"{table}: {len(files)} ファイル（うち新規・更新 {copied} 件）")
+    return {"partitioned": partitioned, "files": files}
+
+def main():
+    """メイン処理"""
+    logger.info("DeSC-Nalmefene メモリマップ用作業コピーの作成を開始します")
+    logger.info(f"複製元: {Config.SOURCE_DATA_DIR}")
+    start_time = time.time()
+
+    os.makedirs(Config.WORKING_COPY_DIR, exist_ok=True)
+
+    # 作成中は読み込み側が元のデータを使うよう、既存のマニフェストを先に削除する
+    previous = load_working_copy_manifest(Config.WORKING_COPY_DIR) or {"tables": {}}
+    manifest_path = os.path.join(Config.WORKING_COPY_DIR, WORKING_COPY_MANIFEST_FILENAME)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    tables = {}
+    for table, partitioned in HOT_TABLES.items():
+        table_manifest = copy_table(table, partitioned, previous["tables"].get(table, {}))
+        if table_manifest:
+            tables[table] = table_manifest
+
+    if not tables:
+        logger.error("作業コピーを作成できるテーブルがなかったため処理を終了します")
+        return
+
+    # 全ファイルの書き込みが終わってからマニフェストを保存し、読み込み側に公開する
+    save_working_copy_manifest(Config.WORKING_COPY_DIR, {
+        "source_data_dir": Config.SOURCE_DATA_DIR,
+        "tables": tables
+    })
+
+    end_time = time.time()
+    logger.info(f"メモリマップ用作業コピーの作成が完了しました。処理時間: {end_time - start_time:.2f}秒")
+
+if __name__ == "__main__":
+    main()
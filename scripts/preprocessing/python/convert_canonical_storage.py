@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+DeSC-Nalmefene 正規化済みデータ（canonical storage）作成スクリプト
+
+このスクリプトは、raw/ 配下の各テーブルを master/optimized_database_schema.json の
+カラム定義に従って正規の型（ID類はInt64、YYYY/MM/DDの日付はDate、短いコード・フラグは
+Categorical）に変換し、同じディレクトリ構成で canonical/ 配下に一度だけ保存します。
+読み込み側は型変換や日付の文字列解析を行わずにそのまま利用できます。
+Parquet形式で保存する場合は、行グループ毎のmin/max統計で読み飛ばしが効くよう並べ替えて保存します。
+"""
+
+import os
+import sys
+# Add project root to sys.path to allow importing from 'utils'
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+import logging
+import polars as pl
+import gc
+import time
+from typing import Dict
+from tqdm import tqdm
+from utils.env_loader import DATA_ROOT_DIR as ENV_DATA_ROOT_DIR
+from utils.canonical_schema import (CANONICAL_MANIFEST_FILENAME, DEFAULT_CANONICAL_ROOT_DIR,
+                                    canonicalize, conversion_null_counts, get_canonical_dtypes, list_raw_files,
+                                    load_canonical_manifest, save_canonical_manifest)
+from utils.partition_index import get_file_signature
+from utils.table_io import DEFAULT_ROW_GROUP_SIZE, OUTPUT_FORMATS, table_name, write_table
+
+# Create local logs directory before setting up logging
+os.makedirs("outputs/logs", exist_ok=True)
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler('outputs/logs/convert_canonical_storage.log'),
+        logging.StreamHandler()
+    ]
+)
+logger = logging.getLogger(__name__)
+
+class Config:
+    # 変換元（create_analysis_dataset.py と同じ raw/ 配下）
+    RAW_DATA_DIR = os.path.join(ENV_DATA_ROOT_DIR, "raw")
+
+    # 正規化済みデータの出力先
+    CANONICAL_ROOT_DIR = DEFAULT_CANONICAL_ROOT_DIR
+
+    # Trueの場合、変換済みのファイルも全て作り直す
+    REBUILD_ALL = False
+
+    # 保存形式（"feather" または "parquet"）
+    STORAGE_FORMAT = "feather"
+
+    # Parquet保存時の並び順（先頭の列ほど行グループ毎のmin/max統計による読み飛ばしが効く）
+    # 疾患ファイルはコードで絞り込む抽出が中心のため diseases_code を先頭にする
+    # 診療行為はインデックスのレセプトを receipt_id で引く読み込みのみのため receipt_id を先頭にする
+    PARQUET_SORT_KEYS = {
+        "receipt_diseases": ["diseases_code", "kojin_id", "receipt_ym"],
+        "receipt_medical_practice": ["receipt_id", "line_no"],
+        "receipt_medical_practice_santei_ymd": ["receipt_id", "line_no", "serial_no"],
+    }
+    DEFAULT_PARQUET_SORT_KEYS = ["kojin_id", "receipt_ym"]
+
+    ROW_GROUP_SIZE = DEFAULT_ROW_GROUP_SIZE
+
+def get_output_relative_path(relative_path: str) -> str:
+    """保存形式に応じた出力ファイルの相対パス"""
+    if Config.STORAGE_FORMAT not in OUTPUT_FORMATS:
+        raise ValueError(f"不明な保存形式です: {Config.STORAGE_FORMAT}")
+    return os.path.join(os.path.dirname(relative_path),
+                        table_name(relative_path) + OUTPUT_FORMATS[Config.STORAGE_FORMAT])
+
+def convert_file(table: str, source_path: str, output_path: str) -> int:
+    """1ファイルを正規の型に変換して保存し、行数を返す（変換できずnullとした値は列毎の件数をログに出力）"""
+    source = pl.read_ipc(source_path, memory_map=False)
+    counts = conversion_null_counts(source, table)
+    null_counts = {column: count for column, count in counts.row(0, named=True).items() if count} if counts.width else {}
+    if null_counts:
+        logger.warning(f"{os.path.basename(source_path)}: 正規の型に変換できず null とした値があります {null_counts}")
+    df = canonicalize(source, table)
+    del source
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    write_table(df, output_path,
+                sort_keys=Config.PARQUET_SORT_KEYS.get(table, Config.DEFAULT_PARQUET_SORT_KEYS),
+                row_group_size=Config.ROW_GROUP_SIZE)
+    n_rows = len(df)
+    del df
+    gc.collect()
+    return n_rows
+
+def main():
+    """メイン処理"""
+    logger.info("DeSC-Nalmefene 正規化済みデータの作成を開始します")
+    start_time = time.time()
+
+    if not os.path.isdir(Config.RAW_DATA_DIR):
+        logger.error(f"変換元ディレクトリが見つかりません: {Config.RAW_DATA_DIR}")
+        return
+
+    sources = list_raw_files(Config.RAW_DATA_DIR)
+    if not sources:
+        logger.error("変換対象のファイルが見つかりません")
+        return
+
+    os.makedirs(Config.CANONICAL_ROOT_DIR, exist_ok=True)
+
+    # 変換中は読み込み側が raw/ を使うよう、既存のマニフェストを先に削除する
+    previous = load_canonical_manifest(Config.CANONICAL_ROOT_DIR) or {"files": {}}
+    manifest_path = os.path.join(Config.CANONICAL_ROOT_DIR, CANONICAL_MANIFEST_FILENAME)
+    if os.path.exists(manifest_path):
+        os.remove(manifest_path)
+
+    for table in sorted({table for table, _ in sources}):
+        if not get_canonical_dtypes(table):
+            logger.warning(f"{table}: スキーマ定義にないテーブルのため型を変えずにコピーします")
+
+    files: Dict[str, Dict] = {}
+    converted, skipped = 0, 0
+    for table, relative_path in tqdm(sources, desc="正規化", unit="file"):
+        source_path = os.path.join(Config.RAW_DATA_DIR, relative_path)
+        output_relative_path = get_output_relative_path(relative_path)
+        output_path = os.path.join(Config.CANONICAL_ROOT_DIR, output_relative_path)
+        file_size, file_mtime = get_file_signature(source_path)
+
+        # 保存形式を切り替えた場合は出力パスが変わるため再変換となる
+        entry = previous["files"].get(relative_path)
+        if (not Config.REBUILD_ALL and entry is not None
+                and entry.get("output") == output_relative_path and os.path.exists(output_path)
+                and entry["source_size"] == file_size and entry["source_mtime"] == file_mtime):
+            files[relative_path] = entry
+            skipped += 1
+            continue
+
+        n_rows = convert_file(table, source_path, output_path)
+        files[relative_path] = {
+            "table": table,
+            "output": output_relative_path,
+            "source_size": file_size,
+            "source_mtime": file_mtime,
+            "n_rows": n_rows
+        }
+        converted += 1
+
+    # raw/ から削除されたファイルは正規化済みデータからも削除する
+    for relative_path in set(previous["files"]) - set(files):
+        stale_path = os.path.join(Config.CANONICAL_ROOT_DIR,
+                                  previous["files"][relative_path].get("output", relative_path))
+        if os.path.exists(stale_path):
+            os.remove(stale_path)
+            logger.info(f"削除されたファイルの変換結果を削除しました: {relative_path}")
+
+    logger.info(f"変換: {converted} 件, 変更なしのためスキップ: {skipped} 件")
+
+    # 全ファイルの変換が終わってからマニフェストを保存し、読み込み側に公開する
+    save_canonical_manifest(Config.CANONICAL_ROOT_DIR, {"storage_format": Config.STORAGE_FORMAT, "files": files})
+
+    end_time = time.time()
+    logger.info(f"正規化済みデータの作成が完了しました。処理時間: {end_time - start_time:.2f}秒")
+
+if __name__ == "__main__":
+    main()
@@ -20,12 +20,40 @@ import logging
 import polars as pl
 from pathlib import Path
 import gc
-from typing import Dict, List, Set, Optional, Tuple
+from typing import Dict, List, Optional, Tuple
 import psutil
 from tqdm import tqdm
 import time
 from datetime import datetime, timedelta
 from utils.env_loader import DATA_ROOT_DIR as ENV_DATA_ROOT_DIR, OUTPUT_DIR as ENV_OUTPUT_DIR
+from utils.partition_index import (load_diseases_code_index, select_files_for_codes,
+                                   load_kojin_id_summary, select_files_for_patients)
+from utils.patient_buckets import (DEFAULT_BUCKET_ROOT_DIR, buckets_for_patients,
+                                   get_bucket_file_path, load_bucket_layout, stale_bucket_datasets)
+from utils.canonical_schema import (DEFAULT_CANONICAL_ROOT_DIR, date_expr, resolve_data_dir,
+                                    with_date_columns)
+from utils.table_io import (find_table, get_table_path, is_table_file, list_table_files, read_table, scan_table,
+                            table_name, write_table)
+from utils.working_copy import DEFAULT_WORKING_COPY_DIR, resolve_table_dir
+from utils.stage_executor import run_stages
+from utils.cohort_keys import CohortKeys
+from utils.comorbidity_engine import build_category_lookup, flag_categories
+from utils.comorbidity_indices import index_category_codes, with_index_scores
+from utils.prescription_events import (DEFAULT_PRESCRIPTION_EVENT_SOURCE_DIR, DEFAULT_PRESCRIPTION_EVENTS_DIR,
+                                       resolve_prescription_event_sources, scan_prescription_events)
+from utils.treatment_eras import TREATMENT_ERA_SCHEMA, build_treatment_eras
+from utils.care_continuity import bitmap_months, build_care_continuity
+from utils.institution_features import (build_institution_lookup, classify_institutions,
+                                        resolve_receipt_institutions)
+from utils.institution_volume import (DEFAULT_INSTITUTION_VOLUME_PATH, flag_specialist_facilities,
+                                      load_institution_volume, specialist_facilities, specialist_threshold,
+                                      volume_quantiles)
+from utils.index_procedures import build_practice_names, collect_index_procedures, procedure_frequencies
+from utils.enrollment_population import (DEFAULT_ENROLLMENT_POPULATION_DIR, load_enrollment_population,
+                                         prescribing_rates, treated_fiscal_years)
+from utils.treatment_states import (INTERVAL_STATE_SCHEMA, assign_states, follow_up_end_expr, interval_treatments,
+                                    transition_counts)
+from utils.patient_timeline import build_timeline_events, to_timeline_store
 
 # Create local logs directory before setting up logging
 os.makedirs("outputs/logs", exist_ok=True)
@@ -61,6 +89,140 @@ class Config:
                            "F30", "F31", "F32", "F33", "F34", "F38", "F39",  # 気分障害
                            "F40", "F41", "F42", "F43", "F44", "F45", "F48"]   # 神経症性障害
     }
+    
+    # 併存疾患の参照期間（インデックス日前の日数）。レセプト年月が参照期間の開始月からインデックス日までの
+    # レセプトに病名がある場合に併存疾患ありとする（Noneの場合はインデックス日以前の全期間）
+    COMORBIDITY_LOOKBACK_DAYS = 365
+    
+    # 併存疾患と同じ1回のスキャンでカテゴリフラグ（has_cci_*、has_elix_*）と指数（charlson_index、elixhauser_index）を作成する
+    # 指数: "charlson"（17カテゴリ、Charlsonの重み）、"elixhauser"（31カテゴリ、van Walravenの重み）
+    COMORBIDITY_INDICES = ["charlson", "elixhauser"]
+    
+    # 観察期間（研究計画書の 2014年4月〜2023年9月。extract_f10_2_patients.py の STUDY_PERIOD_START/END）
+    OBSERVATION_START = "2014-04-01"
+    OBSERVATION_END = "2023-09-30"
+    
+    # Figure 5 用の治療エピソード（{cohort}_cohort_treatment_eras）。処方イベントデータセットから作成する
+    # インデックス日以降の DRUG_CODES の処方を、前の処方の終了日（処方日＋処方日数）から
+    # TREATMENT_ERA_ALLOWED_GAP_DAYS 日以内の次の処方と連結する
+    BUILD_TREATMENT_ERAS = True
+    TREATMENT_ERA_ALLOWED_GAP_DAYS = 30
+    TREATMENT_ERA_DEFAULT_DAYS_SUPPLY = 30 # 処方日数（算定日ファイルの回数）が欠損・0の場合
+    
+    # Figure 5 用の F10.2 診療継続（{cohort}_cohort_care_continuity / care_spells / care_transfers）
+    # 医療機関を問わず F10.2 の算定月の空白が CARE_CONTINUITY_MAX_GAP_MONTHS か月以内であれば継続とみなす（転院後の継続を含む）
+    BUILD_CARE_CONTINUITY = True
+    F10_2_ICD10_CODE = "F102" # ICD10マスターの icd10_code（extract_f10_2_patients.py と同じ）
+    CARE_CONTINUITY_MAX_GAP_MONTHS = 2
+    
+    # Table 2 用の医療機関の特徴（ベースラインの iryokikan_no・institution_type・bed_size_band 等）
+    # インデックス日以降最初の DRUG_CODES の処方のレセプト（処方がない場合はインデックスのF10.2レコードのレセプト）の医療機関を
+    # 医療機関マスター・標榜科マスターから分類する。処方イベントデータセットがない場合は全患者がインデックスのレセプト
+    BUILD_INSTITUTION_FEATURES = True
+    # 精神科系の標榜科（標準化診療科名）
+    PSYCHIATRIC_SPECIALTIES = ["精神科", "心療内科", "神経科", "児童精神科"]
+    # 総病床数コード（m_hco_med.total_byoshousuu_code）→ 病床規模。対応がないコード（0:不明等）は "unknown"
+    BED_SIZE_BANDS = {
+        "1": "<20",
+        "2": "20-99", "3": "20-99",
+        "4": "100-199", "5": "100-199",
+        "6": "200-399", "7": "200-399",
+        "8": "400+", "9": "400+", "10": "400+", "11": "400+", "12": "400+", "13": "400+",
+    }
+    
+    # 専門医療機関（年間のF10.2患者数が閾値以上の医療機関）。build_institution_volume.py で作成した
+    # (iryokikan_no, fiscal_year, distinct_patients) の表を絞り込むだけで判定するため、閾値を変えても疾患ファイルは読み直さない
+    INSTITUTION_VOLUME_PATH = DEFAULT_INSTITUTION_VOLUME_PATH
+    SPECIALIST_FACILITY_MIN_PATIENTS = None # 閾値（人/年度）。None の場合は分布の SPECIALIST_FACILITY_QUANTILE 分位点
+    SPECIALIST_FACILITY_QUANTILE = 0.9
+    # institution_volume_quantiles に出力する分位点
+    INSTITUTION_VOLUME_QUANTILES = [0.5, 0.75, 0.9, 0.95, 0.99]
+    
+    # Table 4 用のインデックス日の同時算定診療行為（インデックスのレセプトでインデックス日に算定された診療行為）
+    BUILD_INDEX_PROCEDURES = True
+    INDEX_PROCEDURE_TOP_N = 20 # 治療群毎に出力する診療行為の件数（算定された患者数の多い順）
+    
+    # Figure 2 用の地域（chiiki_code）・年度毎の処方患者数と加入者10万人あたりの処方患者数
+    BUILD_PRESCRIPTION_HEATMAP = True
+    HEATMAP_DRUG_CODES = [DRUG_CODES["nalmefene"]]
+    HEATMAP_FISCAL_YEARS = None # 対象の年度（Noneの場合は観察期間の全年度）
+    # 分母の地域・年度毎の加入者数は適用ファイルから一度だけ集計して保存し、薬剤・年度を変えた再実行では読み直さない
+    ENROLLMENT_POPULATION_DIR = DEFAULT_ENROLLMENT_POPULATION_DIR
+    REBUILD_ENROLLMENT_POPULATION = False
+    
+    # Figure 4 用の治療状態の推移。インデックス日から SANKEY_INTERVAL_DAYS 日毎の区間に分け、
+    # 区間内の処方から治療状態を決める（複数の区分の処方がある区間は先に書いた区分）。
+    # 処方がなければ "none"、区間の開始日が観察可能期間（適用ファイル）・観察期間の終了より後なら "lost"
+    BUILD_TREATMENT_TRANSITIONS = True
+    SANKEY_INTERVAL_DAYS = 91 # 約3か月
+    SANKEY_N_INTERVALS = 8
+    SANKEY_DRUG_STATES = {
+        "nalmefene": ["nalmefene"],
+        "abstinence": ["acamprosate", "disulfiram", "cyanamide"],
+    }
+    
+    # Figure 3 用の患者毎のイベントタイムライン（{cohort}_cohort_timeline_events.arrow と _timeline_offsets）。
+    # F10.2の算定月（F10.2 診療継続）・対象薬剤の処方・健診・転院を一度だけまとめ、患者毎のオフセットで切り出せる形で保存する
+    BUILD_PATIENT_TIMELINES = True
+    
+    # Table 7 用の横持ち健診パネル（{cohort}_cohort_exam_panel）に含める健診項目
+    # 列名は "<項目>_<時点>"（例: gamma_gt_before_index、bmi_year2）。健診ファイルにない項目は除外する。空の場合は作成しない
+    EXAM_PANEL_COLUMNS = [
+        "exam_ymd",
+        "height", "weight", "bmi", "fukui",
+        "systolic_blood_pressure", "diastolic_blood_pressure",
+        "hdl", "ldl", "chusei_shibou",
+        "got", "gpt", "gamma_gt", "albumin_kashi", "kesshoubansuu",
+        "kuufukuji_ketto", "hba1c",
+        "nyoutou_code", "nyoutanpaku_code",
+        "inshu_code", "inshuryou_code", "kitsuen_code", "suimin_code",
+        "shokushuukan_code", "undou_shuukan_30pun_code",
+    ]
+    
+    # diseases_codeインデックス（build_partition_index.py で作成）がある場合、
+    # 併存疾患のコードを含み得る疾患ファイルのみを読み込む
+    USE_DISEASES_CODE_INDEX = True
+    
+    # kojin_idサマリー（build_partition_index.py で作成）がある場合、
+    # コホートの患者を含み得るファイルのみを読み込む
+    USE_KOJIN_ID_SUMMARY = True
+    
+    # 患者バケットレイアウト（build_patient_buckets.py で作成）がある場合、
+    # 治療群分類ではコホートの患者が属するバケットのみを読み込む
+    USE_PATIENT_BUCKETS = True
+    BUCKET_ROOT_DIR = DEFAULT_BUCKET_ROOT_DIR
+    
+    # 処方イベントデータセット（build_prescription_events.py で作成）がある場合、
+    # 治療群分類では薬剤と算定日の結合済みデータを1回のスキャンで読み込む（バケットより優先）。
+    # 作成元の月次ファイルより古い・作成後に追加された月は、作成元の薬剤・算定日ファイルを結合して読み込む
+    USE_PRESCRIPTION_EVENTS = True
+    PRESCRIPTION_EVENTS_DIR = DEFAULT_PRESCRIPTION_EVENTS_DIR
+    PRESCRIPTION_EVENT_SOURCE_DIR = DEFAULT_PRESCRIPTION_EVENT_SOURCE_DIR
+    
+    # 正規化済みデータ（convert_canonical_storage.py で作成）がある場合、
+    # raw/ の代わりにそちらから読み込み、読み込み時の型変換・日付解析を省く
+    USE_CANONICAL_STORAGE = True
+    CANONICAL_ROOT_DIR = DEFAULT_CANONICAL_ROOT_DIR
+    
+    # 出力形式（"feather" または "parquet"）
+    # "parquet" の場合はkojin_id順に並べ、行グループ毎の統計付きで保存する
+    OUTPUT_FORMAT = "feather"
+    
+    # メモリマップ用作業コピー（build_working_copy.py で作成）がある場合、
+    # 疾患・薬剤・適用ファイルとICD10マスターは非圧縮の作業コピーをメモリマップで読み込む
+    USE_WORKING_COPY = True
+    WORKING_COPY_DIR = DEFAULT_WORKING_COPY_DIR
+    
+    # 各コホートは全患者コホート（f10_2_patients_all）のウォッシュアウトによる絞り込みのため、
+    # 変数は全患者について一度だけ作成し、他のコホートは患者の絞り込みと保存のみ行う
+    DERIVE_COHORTS_FROM_SUPERSET = True
+    SUPERSET_COHORT = "all"
+    
+    # 基本情報・治療群・併存疾患・健診の各ステージをスレッドプールで並行実行する
+    # 実行中のメモリ増加量が利用可能メモリの STAGE_MEMORY_FRACTION を超えている間は次のステージを開始しない
+    RUN_STAGES_CONCURRENTLY = True
+    MAX_CONCURRENT_STAGES = 4
+    STAGE_MEMORY_FRACTION = 0.5
 
 def optimize_parameters():
     """システムリソースに基づく最適なパラメータの設定"""
@@ -76,10 +238,17 @@ def optimize_parameters():
     batch_size = n_threads * 2
     logger.debug(f"optimize_parameters: batch_size = {batch_size}")
     
+    # ステージの並行実行で、新しいステージを開始してよいメモリ増加量の上限
+    memory_budget = int(available_memory * Config.STAGE_MEMORY_FRACTION)
+    stage_workers = max(1, min(Config.MAX_CONCURRENT_STAGES, n_threads))
+    logger.debug(f"optimize_parameters: memory_budget = {memory_budget}, stage_workers = {stage_workers}")
+    
     optimized_params = {
         'n_threads': n_threads,
         'chunk_size': chunk_size,
-        'batch_size': batch_size
+        'batch_size': batch_size,
+        'memory_budget': memory_budget,
+        'stage_workers': stage_workers
     }
     logger.debug(f"optimize_parameters: 戻り値 = {optimized_params}")
     logger.debug("optimize_parameters: 終了")
@@ -91,25 +260,26 @@ def load_patient_cohorts(output_dir: str) -> Dict[str, pl.DataFrame]:
     logger.debug(f"load_patient_cohorts: output_dir = {output_dir}")
     
     cohort_files = {
-        "primary": "f10_2_patients_primary_cohort.feather",
-        "sensitivity1": "f10_2_patients_sensitivity_cohort1.feather",
-        "sensitivity2": "f10_2_patients_sensitivity_cohort2.feather",
-        "all": "f10_2_patients_all.feather"
+        "primary": "f10_2_patients_primary_cohort",
+        "sensitivity1": "f10_2_patients_sensitivity_cohort1",
+        "sensitivity2": "f10_2_patients_sensitivity_cohort2",
+        "all": "f10_2_patients_all"
     }
     logger.debug(f"load_patient_cohorts: cohort_files = {cohort_files}")
     
     cohorts = {}
     for cohort_name, filename in cohort_files.items():
         logger.debug(f"load_patient_cohorts: cohort_name = {cohort_name}, filename = {filename}")
-        file_path = os.path.join(output_dir, filename)
+        # Feather・Parquetのどちらで保存されていても読み込む
+        file_path = find_table(output_dir, filename)
         logger.debug(f"load_patient_cohorts: file_path = {file_path}")
-        if os.path.exists(file_path):
+        if file_path is not None:
             logger.debug(f"load_patient_cohorts: {file_path} が存在します。読み込みます。")
-            cohorts[cohort_name] = pl.read_ipc(file_path)
+            cohorts[cohort_name] = read_table(file_path)
             logger.info(f"{cohort_name} cohort: {len(cohorts[cohort_name])} 患者")
             logger.debug(f"load_patient_cohorts: {cohort_name} の患者数 = {len(cohorts[cohort_name])}")
         else:
-            logger.warning(f"コホートファイルが見つかりません: {file_path}")
+            logger.warning(f"コホートファイルが見つかりません: {os.path.join(output_dir, filename)}")
     
     logger.debug(f"load_patient_cohorts: 戻り値 cohorts のキー = {list(cohorts.keys())}")
     logger.info("患者コホートファイルの読み込みを終了します")
@@ -126,20 +296,24 @@ def load_master_data(base_dir: str) -> Dict[str, pl.DataFrame]:
         "drug_who_atc": "m_drug_who_atc.feather",
         "hco_med": "m_hco_med.feather",
         "hco_specialty": "m_hco_xref_specialty.feather",
-        "disease": "m_disease.feather"
+        "disease": "m_disease.feather",
+        "med_treat": "m_med_treat_all.feather"
     }
     logger.debug(f"load_master_data: master_files = {master_files}")
     
     master_data = {}
     for key, filename in tqdm(master_files.items(), desc="マスターファイル読み込み", unit="file"):
         logger.debug(f"load_master_data: key = {key}, filename = {filename}")
-        file_path = os.path.join(base_dir, filename)
+        master_dir = base_dir
+        if Config.USE_WORKING_COPY:
+            master_dir = resolve_table_dir(table_name(filename), base_dir, Config.WORKING_COPY_DIR)
+        file_path = find_table(master_dir, table_name(filename)) or os.path.join(base_dir, filename)
         logger.debug(f"load_master_data: file_path = {file_path}")
         if os.path.exists(file_path):
             file_size = os.path.getsize(file_path) / (1024 * 1024)  # MB単位
             logger.info(f"{filename} (サイズ: {file_size:.2f} MB) を読み込んでいます")
             logger.debug(f"load_master_data: {file_path} が存在します。読み込みます。サイズ = {file_size:.2f} MB")
-            master_data[key] = pl.read_ipc(file_path)
+            master_data[key] = read_table(file_path)
             logger.debug(f"load_master_data: {key} の読み込み完了")
         else:
             logger.warning(f"{filename}が見つかりません: {file_path}")
@@ -148,21 +322,22 @@ def load_master_data(base_dir: str) -> Dict[str, pl.DataFrame]:
     logger.info("マスターデータの読み込みを終了します")
     return master_data
 
-def get_tekiyo_data(base_dir: str, patient_ids: Set[int]) -> pl.DataFrame:
+def get_tekiyo_data(base_dir: str, cohort_keys: CohortKeys) -> pl.DataFrame:
     """適用（被保険者台帳）データの読み込み"""
     logger.info("適用（被保険者台帳）データの読み込みを開始します")
-    logger.debug(f"get_tekiyo_data: base_dir = {base_dir}, patient_ids 数 = {len(patient_ids)}")
+    logger.debug(f"get_tekiyo_data: base_dir = {base_dir}, 患者数 = {len(cohort_keys)}")
     
-    tekiyo_file = os.path.join(base_dir, "tekiyo.feather")
+    if Config.USE_WORKING_COPY:
+        base_dir = resolve_table_dir("tekiyo", base_dir, Config.WORKING_COPY_DIR)
+    tekiyo_file = find_table(base_dir, "tekiyo")
     logger.debug(f"get_tekiyo_data: tekiyo_file = {tekiyo_file}")
-    if not os.path.exists(tekiyo_file):
-        logger.error(f"適用ファイルが見つかりません: {tekiyo_file}")
+    if tekiyo_file is None:
+        logger.error(f"適用ファイルが見つかりません: {os.path.join(base_dir, 'tekiyo.feather')}")
         logger.debug("get_tekiyo_data: 適用ファイルが存在しないため空のDataFrameを返します")
         return pl.DataFrame()
     
     logger.debug("get_tekiyo_data: 適用ファイルを読み込み、フィルタリングと選択を行います")
-    tekiyo_df = (pl.read_ipc(tekiyo_file)
-                .filter(pl.col("kojin_id").is_in(list(patient_ids))) # SetをListに変換
+    tekiyo_df = (cohort_keys.restrict(scan_table(tekiyo_file))
                 .select([
                     "kojin_id",
                     "birth_ym",
@@ -174,14 +349,34 @@ def get_tekiyo_data(base_dir: str, patient_ids: Set[int]) -> pl.DataFrame:
                     "kazoku_id_riyouka",
                     "oyako_id_riyouka",
                     "kenshin_data_ari",
-                    "chiiki_code"
-                ]))
+                    "chiiki_code",
+                    "observable_end_ym"
+                ])
+                .collect())
     
     logger.info(f"適用データ: {len(tekiyo_df)} レコード")
     logger.debug(f"get_tekiyo_data: 読み込んだ適用データ数 = {len(tekiyo_df)}")
     logger.debug("get_tekiyo_data: 終了")
     return tekiyo_df
 
+def get_follow_up_ends(base_dir: str, patients_df: pl.DataFrame) -> pl.DataFrame:
+    """患者毎の追跡終了日（観察可能終了年月の月末と観察期間の終了日の早い方）
+
+    死亡フラグ（shibou_flg）は日付を持たないが、死亡・資格喪失で観察可能期間は終わるため
+    observable_end_ym で打ち切れば死亡後の期間も追跡に含めない。
+    """
+    observation_end = datetime.strptime(Config.OBSERVATION_END, "%Y-%m-%d").date()
+    follow_up_ends = patients_df.select("kojin_id").unique()
+    tekiyo_df = get_tekiyo_data(base_dir, CohortKeys.from_frame(patients_df))
+    if "observable_end_ym" in tekiyo_df.columns:
+        follow_up_end = follow_up_end_expr("observable_end_ym", tekiyo_df.schema["observable_end_ym"], observation_end)
+        follow_up_ends = follow_up_ends.join(tekiyo_df.select(["kojin_id", follow_up_end.alias("follow_up_end")]),
+                                             on="kojin_id", how="left")
+    else:
+        logger.warning("適用データに観察可能終了年月がないため、追跡終了日は観察期間の終了日とします")
+        follow_up_ends = follow_up_ends.with_columns(pl.lit(None, dtype=pl.Date).alias("follow_up_end"))
+    return follow_up_ends.with_columns(pl.col("follow_up_end").fill_null(pl.lit(observation_end)))
+
 def calculate_age_at_index(tekiyo_df: pl.DataFrame, patients_df: pl.DataFrame) -> pl.DataFrame:
     """インデックス日時点での年齢計算"""
     logger.info("インデックス日時点での年齢計算を開始します")
@@ -195,7 +390,7 @@ def calculate_age_at_index(tekiyo_df: pl.DataFrame, patients_df: pl.DataFrame) -
     age_calculated = merged_df.with_columns([
         pl.when(pl.col("birth_ym").is_not_null())
         .then(
-            pl.col("index_date").str.to_date(format="%Y/%m/%d").dt.year() -
+            date_expr("index_date", merged_df.schema["index_date"]).dt.year() -
             pl.col("birth_ym").str.slice(0, 4).cast(pl.Int32)
         )
         .otherwise(None)
@@ -206,6 +401,15 @@ def calculate_age_at_index(tekiyo_df: pl.DataFrame, patients_df: pl.DataFrame) -
     logger.debug("calculate_age_at_index: 終了")
     return age_calculated
 
+# 健診データの時点（時点名, 最も近い健診を探す方向, 基準日のインデックス日からのずれ, 期間の他端のインデックス日からのずれ）
+# 各時点ではインデックス日に最も近い健診を選ぶため、基準日は期間のインデックス日側の端とする
+EXAM_TIME_POINTS = [
+    ("before_index", "backward", None, "-2y"),   # インデックス日前2年以内
+    ("after_index", "forward", None, "6mo"),     # インデックス日から6か月以内
+    ("year1", "forward", "9mo", "18mo"),         # 9〜18か月後
+    ("year2", "forward", "21mo", "30mo"),        # 21〜30か月後
+]
+
 def get_exam_data_time_series(base_dir: str,
                              patients_df: pl.DataFrame,
                              params: Dict) -> pl.DataFrame:
@@ -213,19 +417,22 @@ def get_exam_data_time_series(base_dir: str,
     logger.info("健診データの時系列取得を開始します")
     logger.debug(f"get_exam_data_time_series: base_dir = {base_dir}, patients_df shape = {patients_df.shape}, params = {params}")
     
-    exam_file = os.path.join(base_dir, "exam_interview_processed.feather")
+    exam_file = find_table(base_dir, "exam_interview_processed")
     logger.debug(f"get_exam_data_time_series: exam_file = {exam_file}")
-    if not os.path.exists(exam_file):
-        logger.error(f"健診ファイルが見つかりません: {exam_file}")
+    if exam_file is None:
+        logger.error(f"健診ファイルが見つかりません: {os.path.join(base_dir, 'exam_interview_processed.feather')}")
         logger.debug("get_exam_data_time_series: 健診ファイルが存在しないため空のDataFrameを返します")
         return pl.DataFrame()
     
-    patient_ids = set(patients_df["kojin_id"].to_list())
-    logger.debug(f"get_exam_data_time_series: patient_ids 数 = {len(patient_ids)}")
+    cohort_keys = CohortKeys.from_frame(patients_df)
+    logger.debug(f"get_exam_data_time_series: 患者数 = {len(cohort_keys)}")
+    
+    if Config.USE_KOJIN_ID_SUMMARY and not select_files_for_patients([exam_file], cohort_keys, load_kojin_id_summary(base_dir)):
+        logger.warning("kojin_idサマリーより、健診ファイルに対象患者が含まれないため読み込みをスキップします")
+        return pl.DataFrame()
     
     logger.debug("get_exam_data_time_series: 健診データを読み込み、フィルタリングします")
-    exam_df = (pl.read_ipc(exam_file)
-              .filter(pl.col("kojin_id").is_in(list(patient_ids)))) # SetをListに変換
+    exam_df = cohort_keys.restrict(scan_table(exam_file)).collect()
     logger.debug(f"get_exam_data_time_series: 読み込んだ健診データ数 = {len(exam_df)}")
     
     if exam_df.is_empty():
@@ -233,60 +440,227 @@ def get_exam_data_time_series(base_dir: str,
         logger.debug("get_exam_data_time_series: 対象患者の健診データが空のため空のDataFrameを返します")
         return pl.DataFrame()
     
-    logger.debug("get_exam_data_time_series: 患者のインデックス日と結合します")
-    exam_with_index = exam_df.join(
-        patients_df.select(["kojin_id", "index_date"]),
-        on="kojin_id",
-        how="inner"
-    )
-    logger.debug(f"get_exam_data_time_series: インデックス日結合後の exam_with_index shape = {exam_with_index.shape}")
-    
-    logger.debug("get_exam_data_time_series: 日付変換を行います")
-    exam_with_index = exam_with_index.with_columns([
-        pl.col("exam_ymd").str.to_date(format="%Y/%m/%d"),
-        pl.col("index_date").str.to_date(format="%Y/%m/%d")
-    ])
+    logger.debug("get_exam_data_time_series: 日付変換を行い、患者・健診日順に並べます")
+    index_dates = with_date_columns(patients_df.select(["kojin_id", "index_date"]), ["index_date"])
+    exam_sorted = (with_date_columns(exam_df, ["exam_ymd"])
+                   .filter(pl.col("exam_ymd").is_not_null())
+                   .sort(["kojin_id", "exam_ymd"]))
     
-    logger.debug("get_exam_data_time_series: 時系列ポイントの定義を行います")
-    exam_time_series = exam_with_index.with_columns([
-        pl.when(
-            (pl.col("exam_ymd") < pl.col("index_date")) &
-            (pl.col("exam_ymd") >= pl.col("index_date").dt.offset_by("-2y"))
-        ).then(pl.lit("before_index"))
-        .when(
-            (pl.col("exam_ymd") >= pl.col("index_date")) &
-            (pl.col("exam_ymd") <= pl.col("index_date").dt.offset_by("6mo"))
-        ).then(pl.lit("after_index"))
-        .when(
-            (pl.col("exam_ymd") >= pl.col("index_date").dt.offset_by("9mo")) &
-            (pl.col("exam_ymd") <= pl.col("index_date").dt.offset_by("18mo"))
-        ).then(pl.lit("year1"))
-        .when(
-            (pl.col("exam_ymd") >= pl.col("index_date").dt.offset_by("21mo")) &
-            (pl.col("exam_ymd") <= pl.col("index_date").dt.offset_by("30mo"))
-        ).then(pl.lit("year2"))
-        .otherwise(None)
-        .alias("time_point")
-    ]).filter(pl.col("time_point").is_not_null())
-    logger.debug(f"get_exam_data_time_series: 時系列ポイント定義後の exam_time_series shape = {exam_time_series.shape}")
+    logger.debug("get_exam_data_time_series: 各時点の基準日から最も近い健診データを as-of 結合で選択します")
+    exam_points = []
+    for time_point, strategy, anchor_offset, limit_offset in EXAM_TIME_POINTS:
+        anchor = pl.col("index_date") if anchor_offset is None else pl.col("index_date").dt.offset_by(anchor_offset)
+        anchors = (index_dates
+                   .with_columns([
+                       anchor.alias("anchor_date"),
+                       pl.col("index_date").dt.offset_by(limit_offset).alias("limit_date")
+                   ])
+                   .sort(["kojin_id", "anchor_date"]))
+        # 患者毎に健診日順に並んでいるため、基準日から前方/後方への線形マージで最も近い健診を選ぶ
+        # インデックス日前はインデックス日当日を含まない
+        matched = anchors.join_asof(exam_sorted,
+                                    left_on="anchor_date",
+                                    right_on="exam_ymd",
+                                    by="kojin_id",
+                                    strategy=strategy,
+                                    allow_exact_matches=(strategy == "forward"),
+                                    check_sortedness=False)
+        in_window = (pl.col("exam_ymd") >= pl.col("limit_date") if strategy == "backward"
+                     else pl.col("exam_ymd") <= pl.col("limit_date"))
+        exam_points.append(matched
+                           .filter(pl.col("exam_ymd").is_not_null() & in_window)
+                           .with_columns(pl.lit(time_point).alias("time_point")))
+        logger.debug(f"get_exam_data_time_series: {time_point} の健診データ数 = {len(exam_points[-1])}")
     
-    logger.debug("get_exam_data_time_series: 各時点で最も近い健診データを選択します")
-    exam_closest = (exam_time_series
+    exam_closest = (pl.concat(exam_points)
                    .with_columns([
-                       pl.when(pl.col("time_point") == "before_index")
-                       .then(pl.col("index_date") - pl.col("exam_ymd"))
-                       .otherwise(pl.col("exam_ymd") - pl.col("index_date"))
-                       .alias("days_diff")
+                       (pl.col("index_date") - pl.col("exam_ymd")).abs().alias("days_diff")
                    ])
-                   .sort(["kojin_id", "time_point", "days_diff"])
-                   .group_by(["kojin_id", "time_point"])
-                   .first())
+                   .select(["kojin_id", "time_point"] +
+                           [col for col in exam_sorted.columns if col != "kojin_id"] +
+                           ["index_date", "days_diff"]))
     logger.debug(f"get_exam_data_time_series: 最も近い健診データ選択後の exam_closest shape = {exam_closest.shape}")
     
     logger.info(f"健診時系列データ: {len(exam_closest)} レコード")
     logger.debug("get_exam_data_time_series: 終了")
     return exam_closest
 
+def summarize_treatment_window(df_merged: pl.DataFrame,
+                               patients_df: pl.DataFrame) -> Optional[pl.DataFrame]:
+    """処方データ（kojin_id, drug_code, shohou_ymd）をインデックス日後52週に限定し、患者毎に集計"""
+    logger.debug("summarize_treatment_window: 患者のインデックス日と結合します")
+    df_with_index = df_merged.join(
+        patients_df.select(["kojin_id", "index_date"]),
+        on="kojin_id",
+        how="inner"
+    )
+    logger.debug(f"summarize_treatment_window: インデックス日結合後の df_with_index shape = {df_with_index.shape}")
+    
+    logger.debug("summarize_treatment_window: 日付変換とフィルタリング（インデックス日から12週以内）を行います")
+    df_filtered = with_date_columns(df_with_index, ["shohou_ymd", "index_date"]).filter(
+        (pl.col("shohou_ymd") >= pl.col("index_date")) &
+        (pl.col("shohou_ymd") <= pl.col("index_date").dt.offset_by("52w")) # 120週から52週に変更
+    )
+    logger.debug(f"summarize_treatment_window: フィルタリング後の df_filtered shape = {df_filtered.shape}")
+    
+    if df_filtered.is_empty():
+        logger.debug("summarize_treatment_window: フィルタリング後のデータが空です")
+        return None
+    
+    logger.debug("summarize_treatment_window: 治療群分類の準備をします")
+    reduction_codes = [Config.DRUG_CODES["nalmefene"]]
+    abstinence_codes = [
+        Config.DRUG_CODES["acamprosate"],
+        Config.DRUG_CODES["disulfiram"],
+        Config.DRUG_CODES["cyanamide"]
+    ]
+    logger.debug(f"summarize_treatment_window: reduction_codes = {reduction_codes}, abstinence_codes = {abstinence_codes}")
+    
+    logger.debug("summarize_treatment_window: 治療群の集計を行います")
+    grouped = (df_filtered
+              .with_columns([
+                  (pl.col("drug_code").is_in(reduction_codes)).alias("is_reduction"),
+                  (pl.col("drug_code").is_in(abstinence_codes)).alias("is_abstinence")
+              ])
+              .group_by("kojin_id")
+              .agg([
+                  pl.col("is_reduction").max().alias("has_reduction"),
+                  pl.col("is_abstinence").max().alias("has_abstinence"),
+                  pl.col("shohou_ymd").min().alias("first_drug_date")
+              ]))
+    logger.debug(f"summarize_treatment_window: 集計後の grouped shape = {grouped.shape}")
+    
+    return grouped
+
+def scan_cohort_prescription_events(cohort_keys: CohortKeys,
+                                    drug_codes: Optional[List] = None) -> Optional[pl.LazyFrame]:
+    """
+    コホートの患者の処方イベントのスキャン（処方イベントデータセットがない場合はNone）
+
+    イベントファイルは作成元の月次ファイルと照合し、一致しない月は作成元から結合する。
+    kojin_idサマリーがある場合は、コホートの患者を含み得るイベントファイルのみを読み込む。
+    """
+    event_files, stale_sources = resolve_prescription_event_sources(Config.PRESCRIPTION_EVENTS_DIR,
+                                                                    Config.PRESCRIPTION_EVENT_SOURCE_DIR)
+    if not event_files and not stale_sources:
+        return None
+    
+    if Config.USE_KOJIN_ID_SUMMARY and event_files:
+        summary = load_kojin_id_summary(Config.PRESCRIPTION_EVENTS_DIR)
+        if summary is not None:
+            n_before = len(event_files)
+            selected = select_files_for_patients(event_files, cohort_keys, summary)
+            logger.info(f"kojin_idサマリーにより処方イベントファイルを {n_before} 件から {len(selected)} 件に絞り込みました")
+            # コホートの患者を含むファイルがない場合も同じ列の空の結果を返せるよう、1件はスキャンに残す
+            event_files = selected if selected or stale_sources else event_files[:1]
+    
+    logger.info(f"処方イベントファイル {len(event_files)} 件（作成元から結合する月 {len(stale_sources)} 件）から読み込みます")
+    return cohort_keys.restrict(scan_prescription_events(event_files, drug_codes, stale_sources))
+
+def collect_event_treatment_results(patients_df: pl.DataFrame, events: pl.LazyFrame) -> List[pl.DataFrame]:
+    """処方イベントデータセットを1回のスキャンで読み込んで処方を集計"""
+    # first_drug_date は薬剤の種類を問わない最初の処方日のため、drug_codeでは絞り込まない
+    df_events = (events
+                 .select(["kojin_id", "drug_code", "shohou_ymd"])
+                 .collect(engine="streaming"))
+    logger.debug(f"collect_event_treatment_results: 読み込み後の df_events shape = {df_events.shape}")
+    
+    if df_events.is_empty():
+        return []
+    
+    grouped = summarize_treatment_window(df_events, patients_df)
+    return [grouped] if grouped is not None else []
+
+def collect_bucketed_treatment_results(patients_df: pl.DataFrame,
+                                       cohort_keys: CohortKeys,
+                                       bucket_layout: Dict) -> List[pl.DataFrame]:
+    """患者バケットレイアウトから、コホートの患者が属するバケットのみを読み込んで処方を集計"""
+    buckets = buckets_for_patients(cohort_keys, bucket_layout["num_buckets"])
+    logger.info(f"患者バケット {len(buckets)}/{bucket_layout['num_buckets']} 件から薬剤データを読み込みます")
+    
+    treatment_results = []
+    for bucket in tqdm(buckets, desc="薬剤バケット処理", unit="bucket"):
+        drug_path = get_bucket_file_path(Config.BUCKET_ROOT_DIR, "receipt_drug", bucket)
+        santei_path = get_bucket_file_path(Config.BUCKET_ROOT_DIR, "receipt_drug_santei_ymd", bucket)
+        if not os.path.exists(drug_path) or not os.path.exists(santei_path):
+            logger.debug(f"collect_bucketed_treatment_results: バケット {bucket} のファイルがないためスキップします")
+            continue
+        
+        # バケット内はkojin_id順に並んでいるため、同じ患者の薬剤と算定日は両ファイルで同じ範囲に集まっている
+        df_drug = (cohort_keys.restrict(pl.scan_ipc(drug_path, memory_map=False))
+                   .select([
+                       "kojin_id",
+                       pl.col("receipt_id").cast(pl.Int64),
+                       pl.col("line_no").cast(pl.Int64),
+                       "drug_code"
+                   ]))
+        df_santei = (cohort_keys.restrict(pl.scan_ipc(santei_path, memory_map=False))
+                     .select([
+                         "kojin_id",
+                         pl.col("receipt_id").cast(pl.Int64),
+                         pl.col("line_no").cast(pl.Int64),
+                         "shohou_ymd"
+                     ]))
+        df_merged = (df_drug
+                     .join(df_santei, on=["kojin_id", "receipt_id", "line_no"], how="inner")
+                     .collect())
+        logger.debug(f"collect_bucketed_treatment_results: バケット {bucket} の結合後の shape = {df_merged.shape}")
+        
+        if df_merged.is_empty():
+            continue
+        
+        grouped = summarize_treatment_window(df_merged, patients_df)
+        if grouped is not None:
+            treatment_results.append(grouped)
+    
+    return treatment_results
+
+def finalize_treatment_groups(patients_df: pl.DataFrame,
+                              treatment_results: List[pl.DataFrame]) -> pl.DataFrame:
+    """患者毎の処方集計を統合し、治療群を判定"""
+    if treatment_results:
+        logger.debug("finalize_treatment_groups: 治療群の統合と最終分類を行います")
+        # 月次ファイル毎の部分集計では同じ患者が複数回現れるため、患者単位に再集計する
+        combined_treatment = (pl.concat(treatment_results)
+                             .group_by("kojin_id")
+                             .agg([
+                                 pl.col("has_reduction").max(),
+                                 pl.col("has_abstinence").max(),
+                                 pl.col("first_drug_date").min()
+                             ]))
+        logger.debug(f"finalize_treatment_groups: 統合後の combined_treatment shape = {combined_treatment.shape}")
+        
+        classified = (patients_df
+                     .join(combined_treatment, on="kojin_id", how="left")
+                     .with_columns([
+                         pl.when(pl.col("has_reduction") == True)
+                         .then(pl.lit(1))  # 飲酒量低減治療群
+                         .when(pl.col("has_abstinence") == True)
+                         .then(pl.lit(2))  # 断酒治療群
+                         .otherwise(pl.lit(3))  # 治療目標不明群
+                         .alias("treatment_group")
+                     ]))
+        logger.debug(f"finalize_treatment_groups: 最終分類後の classified shape = {classified.shape}")
+    else:
+        logger.warning("finalize_treatment_groups: 処理可能な薬剤データがなかったため、全患者を治療目標不明群(3)とします")
+        classified = patients_df.with_columns(pl.lit(3).alias("treatment_group"))
+    
+    logger.debug("finalize_treatment_groups: 治療群分布の表示準備")
+    treatment_counts = (classified
+                       .group_by("treatment_group")
+                       .count()
+                       .sort("treatment_group"))
+    
+    logger.info("治療群分布:")
+    for row in treatment_counts.iter_rows():
+        group, count = row
+        group_name = {1: "飲酒量低減治療群", 2: "断酒治療群", 3: "治療目標不明群"}.get(group, "不明")
+        logger.info(f"  {group_name}: {count} 人")
+        logger.debug(f"finalize_treatment_groups: 治療群 {group_name} ({group}): {count} 人")
+    
+    logger.debug("finalize_treatment_groups: 終了")
+    return classified
+
 def classify_treatment_groups(patients_df: pl.DataFrame,
                              base_dir: str,
                              params: Dict) -> pl.DataFrame:
@@ -294,11 +668,32 @@ def classify_treatment_groups(patients_df: pl.DataFrame,
     logger.info("治療群の分類を開始します")
     logger.debug(f"classify_treatment_groups: patients_df shape = {patients_df.shape}, base_dir = {base_dir}, params = {params}")
     
-    patient_ids = set(patients_df["kojin_id"].to_list())
-    logger.debug(f"classify_treatment_groups: patient_ids 数 = {len(patient_ids)}")
+    cohort_keys = CohortKeys.from_frame(patients_df)
+    logger.debug(f"classify_treatment_groups: 患者数 = {len(cohort_keys)}")
+    
+    if Config.USE_PRESCRIPTION_EVENTS:
+        events = scan_cohort_prescription_events(cohort_keys)
+        if events is not None:
+            treatment_results = collect_event_treatment_results(patients_df, events)
+            return finalize_treatment_groups(patients_df, treatment_results)
+    
+    if Config.USE_PATIENT_BUCKETS:
+        bucket_datasets = ("receipt_drug", "receipt_drug_santei_ymd")
+        bucket_layout = load_bucket_layout(Config.BUCKET_ROOT_DIR)
+        if bucket_layout is not None and all(dataset in bucket_layout["datasets"] for dataset in bucket_datasets):
+            stale_datasets = stale_bucket_datasets(bucket_layout, bucket_datasets)
+            if stale_datasets:
+                # 作成後に追加された月を読み落とさないよう、月次ファイルから読み込む
+                logger.warning(f"患者バケットレイアウトが月次ファイルと一致しないため使用しません"
+                               f"（{', '.join(stale_datasets)}。build_patient_buckets.py を再実行してください）")
+            else:
+                treatment_results = collect_bucketed_treatment_results(patients_df, cohort_keys, bucket_layout)
+                return finalize_treatment_groups(patients_df, treatment_results)
     
     drug_dir = os.path.join(base_dir, "receipt_drug")
     santei_ymd_dir = os.path.join(base_dir, "receipt_drug_santei_ymd")
+    if Config.USE_WORKING_COPY:
+        drug_dir = resolve_table_dir("receipt_drug", drug_dir, Config.WORKING_COPY_DIR)
     logger.debug(f"classify_treatment_groups: drug_dir = {drug_dir}, santei_ymd_dir = {santei_ymd_dir}")
     
     if not os.path.exists(drug_dir) or not os.path.exists(santei_ymd_dir):
@@ -307,14 +702,14 @@ def classify_treatment_groups(patients_df: pl.DataFrame,
         return patients_df.with_columns(pl.lit(3).alias("treatment_group"))
     
     drug_files_all = [os.path.join(drug_dir, f) for f in os.listdir(drug_dir)
-                      if f.startswith("receipt_drug_") and f.endswith(".feather")]
+                      if is_table_file(f, "receipt_drug_")]
     logger.debug(f"classify_treatment_groups: 発見された薬剤ファイル数 = {len(drug_files_all)}")
     
     # ファイル名から年月を抽出し、それでソートして最新のものを選択
     def get_yyyymm_from_filename(filename):
-        # filename is like 'receipt_drug_YYYYMM.feather'
+        # filename is like 'receipt_drug_YYYYMM.feather' (or '.parquet')
         basename = os.path.basename(filename)
-        # Extract YYYYMM part, assuming it's always 6 digits before '.feather'
+        # Extract YYYYMM part, assuming it's always 6 digits before the extension
         yyyymm_str = basename.split('_')[-1].split('.')[0]
         try:
             return int(yyyymm_str)
@@ -327,20 +722,25 @@ def classify_treatment_groups(patients_df: pl.DataFrame,
     drug_files_to_process = drug_files_all # 全ての薬剤ファイルを処理対象とする
     logger.debug(f"classify_treatment_groups: 処理対象の薬剤ファイル数 = {len(drug_files_to_process)}")
 
+    if Config.USE_KOJIN_ID_SUMMARY:
+        drug_files_to_process = select_files_for_patients(drug_files_to_process,
+                                                          cohort_keys,
+                                                          load_kojin_id_summary(drug_dir))
+        logger.debug(f"classify_treatment_groups: kojin_idサマリーによる絞り込み後の薬剤ファイル数 = {len(drug_files_to_process)}")
+
     treatment_results = []
     
     for file_path in tqdm(drug_files_to_process, desc="薬剤ファイル処理", unit="file"):
         logger.debug(f"classify_treatment_groups: 薬剤ファイル処理中: {file_path}")
         try:
             logger.debug(f"classify_treatment_groups: {file_path} を読み込みます")
-            df_drug_raw = pl.read_ipc(file_path)
+            df_drug_raw = scan_table(file_path)
             
-            # kojin_id を文字列型にキャストしてからフィルタリング
-            logger.debug(f"classify_treatment_groups: {file_path} の kojin_id を文字列型にキャストし、フィルタリングします")
-            df_drug = (df_drug_raw
-                      .with_columns(pl.col("kojin_id").cast(pl.String)) # 文字列型にキャスト
-                      .filter(pl.col("kojin_id").is_in(list(patient_ids))) 
-                      .select(["kojin_id", "receipt_id", "line_no", "drug_code"]))
+            # コホートの患者キーで絞り込む（kojin_idがInt64でない場合のみ型を揃える）
+            logger.debug(f"classify_treatment_groups: {file_path} をコホートの患者で絞り込みます")
+            df_drug = (cohort_keys.restrict(df_drug_raw)
+                      .select(["kojin_id", "receipt_id", "line_no", "drug_code"])
+                      .collect())
             logger.debug(f"classify_treatment_groups: {file_path} の薬剤データ数 (フィルタ後) = {len(df_drug)}")
             
             if df_drug.is_empty():
@@ -349,7 +749,9 @@ def classify_treatment_groups(patients_df: pl.DataFrame,
             
             base_filename = os.path.basename(file_path)
             santei_filename = base_filename.replace("receipt_drug_", "receipt_drug_santei_ymd_")
-            santei_file_path = os.path.join(santei_ymd_dir, santei_filename)
+            # 作業コピーは薬剤ファイルのみのため、算定日ファイルは拡張子を問わず探す
+            santei_file_path = (find_table(santei_ymd_dir, table_name(santei_filename))
+                                or os.path.join(santei_ymd_dir, santei_filename))
             logger.debug(f"classify_treatment_groups: 対応する算定日ファイル: {santei_file_path}")
             
             if not os.path.exists(santei_file_path):
@@ -357,14 +759,13 @@ def classify_treatment_groups(patients_df: pl.DataFrame,
                 continue
             
             logger.debug(f"classify_treatment_groups: {santei_file_path} を読み込み、フィルタリングし、データ型を調整します")
-            df_santei = (pl.read_ipc(santei_file_path)
-                        .with_columns([ # kojin_id, receipt_id, line_no を適切な型にキャスト
-                            pl.col("kojin_id").cast(pl.String),
+            df_santei = (cohort_keys.restrict(scan_table(santei_file_path))
+                        .with_columns([ # receipt_id, line_no を適切な型にキャスト
                             pl.col("receipt_id").cast(pl.Int64), # df_drug側がInt64であると仮定 (エラーメッセージより)
                             pl.col("line_no").cast(pl.Int64)     # df_drug側がInt64であると仮定
                         ])
-                        .filter(pl.col("kojin_id").is_in(list(patient_ids)))
-                        .select(["receipt_id", "line_no", "shohou_ymd"]))
+                        .select(["receipt_id", "line_no", "shohou_ymd"])
+                        .collect())
             logger.debug(f"classify_treatment_groups: {santei_file_path} の算定日データ数 = {len(df_santei)}")
             
             logger.debug("classify_treatment_groups: 薬剤情報と処方日を結合します")
@@ -375,51 +776,11 @@ def classify_treatment_groups(patients_df: pl.DataFrame,
                 logger.debug("classify_treatment_groups: 結合後のデータが空のためスキップします")
                 continue
             
-            logger.debug("classify_treatment_groups: 患者のインデックス日と結合します")
-            df_with_index = df_merged.join(
-                patients_df.select(["kojin_id", "index_date"]),
-                on="kojin_id",
-                how="inner"
-            )
-            logger.debug(f"classify_treatment_groups: インデックス日結合後の df_with_index shape = {df_with_index.shape}")
-            
-            logger.debug("classify_treatment_groups: 日付変換とフィルタリング（インデックス日から12週以内）を行います")
-            df_filtered = df_with_index.with_columns([
-                pl.col("shohou_ymd").str.to_date(format="%Y/%m/%d"),
-                pl.col("index_date").str.to_date(format="%Y/%m/%d")
-            ]).filter(
-                (pl.col("shohou_ymd") >= pl.col("index_date")) &
-                (pl.col("shohou_ymd") <= pl.col("index_date").dt.offset_by("52w")) # 120週から52週に変更
-            )
-            logger.debug(f"classify_treatment_groups: フィルタリング後の df_filtered shape = {df_filtered.shape}")
-            
-            if df_filtered.is_empty():
+            grouped = summarize_treatment_window(df_merged, patients_df)
+            if grouped is None:
                 logger.debug("classify_treatment_groups: フィルタリング後のデータが空のためスキップします")
                 continue
             
-            logger.debug("classify_treatment_groups: 治療群分類の準備をします")
-            reduction_codes = [Config.DRUG_CODES["nalmefene"]]
-            abstinence_codes = [
-                Config.DRUG_CODES["acamprosate"],
-                Config.DRUG_CODES["disulfiram"],
-                Config.DRUG_CODES["cyanamide"]
-            ]
-            logger.debug(f"classify_treatment_groups: reduction_codes = {reduction_codes}, abstinence_codes = {abstinence_codes}")
-            
-            logger.debug("classify_treatment_groups: 治療群の集計を行います")
-            grouped = (df_filtered
-                      .with_columns([
-                          (pl.col("drug_code").is_in(reduction_codes)).alias("is_reduction"),
-                          (pl.col("drug_code").is_in(abstinence_codes)).alias("is_abstinence")
-                      ])
-                      .group_by("kojin_id")
-                      .agg([
-                          pl.col("is_reduction").max().alias("has_reduction"),
-                          pl.col("is_abstinence").max().alias("has_abstinence"),
-                          pl.col("shohou_ymd").min().alias("first_drug_date")
-                      ]))
-            logger.debug(f"classify_treatment_groups: 集計後の grouped shape = {grouped.shape}")
-            
             treatment_results.append(grouped)
             logger.debug(f"classify_treatment_groups: treatment_results に {len(grouped)} 件の結果を追加しました")
             
@@ -429,41 +790,7 @@ def classify_treatment_groups(patients_df: pl.DataFrame,
             continue
     
     logger.debug(f"classify_treatment_groups: 薬剤ファイル処理ループ終了。treatment_results の要素数 = {len(treatment_results)}")
-    if treatment_results:
-        logger.debug("classify_treatment_groups: 治療群の統合と最終分類を行います")
-        combined_treatment = pl.concat(treatment_results).unique(subset=["kojin_id"])
-        logger.debug(f"classify_treatment_groups: 統合後の combined_treatment shape = {combined_treatment.shape}")
-        
-        classified = (patients_df
-                     .join(combined_treatment, on="kojin_id", how="left")
-                     .with_columns([
-                         pl.when(pl.col("has_reduction") == True)
-                         .then(pl.lit(1))  # 飲酒量低減治療群
-                         .when(pl.col("has_abstinence") == True)
-                         .then(pl.lit(2))  # 断酒治療群
-                         .otherwise(pl.lit(3))  # 治療目標不明群
-                         .alias("treatment_group")
-                     ]))
-        logger.debug(f"classify_treatment_groups: 最終分類後の classified shape = {classified.shape}")
-    else:
-        logger.warning("classify_treatment_groups: 処理可能な薬剤データがなかったため、全患者を治療目標不明群(3)とします")
-        classified = patients_df.with_columns(pl.lit(3).alias("treatment_group"))
-    
-    logger.debug("classify_treatment_groups: 治療群分布の表示準備")
-    treatment_counts = (classified
-                       .group_by("treatment_group")
-                       .count()
-                       .sort("treatment_group"))
-    
-    logger.info("治療群分布:")
-    for row in treatment_counts.iter_rows():
-        group, count = row
-        group_name = {1: "飲酒量低減治療群", 2: "断酒治療群", 3: "治療目標不明群"}.get(group, "不明")
-        logger.info(f"  {group_name}: {count} 人")
-        logger.debug(f"classify_treatment_groups: 治療群 {group_name} ({group}): {count} 人")
-    
-    logger.debug("classify_treatment_groups: 終了")
-    return classified
+    return finalize_treatment_groups(patients_df, treatment_results)
 
 def get_comorbidities(base_dir: str,
                      patients_df: pl.DataFrame,
@@ -473,165 +800,574 @@ def get_comorbidities(base_dir: str,
     logger.info("併存疾患の取得を開始します")
     logger.debug(f"get_comorbidities: base_dir = {base_dir}, patients_df shape = {patients_df.shape}, master_data keys = {list(master_data.keys())}, params = {params}")
     
-    patient_ids = set(patients_df["kojin_id"].to_list())
-    logger.debug(f"get_comorbidities: patient_ids 数 = {len(patient_ids)}")
+    cohort_keys = CohortKeys.from_frame(patients_df)
+    logger.debug(f"get_comorbidities: 患者数 = {len(cohort_keys)}")
+    
+    # 併存疾患と併存疾患指数のカテゴリは1つの対応表にまとめ、疾患ファイルのスキャンを1回で済ませる
+    category_codes = {**Config.COMORBIDITY_ICD10_CODES, **index_category_codes(Config.COMORBIDITY_INDICES)}
+    logger.debug(f"get_comorbidities: カテゴリ数 = {len(category_codes)} (併存疾患指数: {Config.COMORBIDITY_INDICES})")
     
     icd10_master = master_data.get("icd10")
     if icd10_master is None:
         logger.error("ICD10マスターデータがありません")
         logger.debug("get_comorbidities: ICD10マスターが存在しないため、併存疾患なしとして元のDataFrameを返します")
         # 元のDataFrameに併存疾患カラムを追加して返す方が後続処理でエラーになりにくい
-        patients_with_comorbidities = patients_df.clone() # cloneして元のDFに影響を与えないようにする
-        for disease_key in Config.COMORBIDITY_ICD10_CODES.keys():
-            patients_with_comorbidities = patients_with_comorbidities.with_columns(pl.lit(False).alias(f"has_{disease_key}"))
-        return patients_with_comorbidities
-
-    logger.debug("get_comorbidities: ICD10マスターから併存疾患のレセプト病名コードを取得します")
-    comorbidity_codes = {}
-    for disease, icd10_codes_list in Config.COMORBIDITY_ICD10_CODES.items():
-        logger.debug(f"get_comorbidities: 併存疾患 '{disease}' のICD10コードリスト: {icd10_codes_list}")
-        disease_specific_codes = []
-        for icd10_code_prefix in icd10_codes_list:
-            logger.debug(f"get_comorbidities: ICD10コードプレフィックス '{icd10_code_prefix}' で検索")
-            codes = (icd10_master
-                    .filter(
-                        (pl.col("icd10_code").str.starts_with(icd10_code_prefix)) &
-                        (pl.col("icd10_kbn_code") == "1") # 標準病名マスターのみ
-                    )
-                    .select("diseases_code")
-                    .to_series()
-                    .to_list())
-            logger.debug(f"get_comorbidities: '{icd10_code_prefix}' に一致する diseases_code 数: {len(codes)}")
-            disease_specific_codes.extend(codes)
-        comorbidity_codes[disease] = list(set(disease_specific_codes)) # 重複除去
-        logger.info(f"{disease}: {len(comorbidity_codes[disease])} コード")
-        logger.debug(f"get_comorbidities: 併存疾患 '{disease}' の diseases_code 数 (重複除去後): {len(comorbidity_codes[disease])}")
+        patients_with_comorbidities = patients_df.with_columns([pl.lit(False).alias(f"has_{category}")
+                                                                for category in category_codes])
+        return with_index_scores(patients_with_comorbidities, Config.COMORBIDITY_INDICES)
+
+    logger.debug("get_comorbidities: ICD10マスターから diseases_code → 併存疾患 の対応表を作成します")
+    comorbidity_lookup = build_category_lookup(icd10_master, category_codes)
+    for disease in Config.COMORBIDITY_ICD10_CODES:
+        n_codes = comorbidity_lookup.filter(pl.col("category") == disease).height
+        logger.info(f"{disease}: {n_codes} コード")
+    for index_name in Config.COMORBIDITY_INDICES:
+        index_categories = list(index_category_codes([index_name]))
+        n_codes = comorbidity_lookup.filter(pl.col("category").is_in(index_categories))["diseases_code"].n_unique()
+        logger.info(f"{index_name} index: {len(index_categories)} カテゴリ, {n_codes} コード")
     
     disease_dir = os.path.join(base_dir, "receipt_diseases")
+    if Config.USE_WORKING_COPY:
+        disease_dir = resolve_table_dir("receipt_diseases", disease_dir, Config.WORKING_COPY_DIR)
     logger.debug(f"get_comorbidities: disease_dir = {disease_dir}")
     
-    all_disease_files = [
-        os.path.join(disease_dir, f)
-        for f in os.listdir(disease_dir)
-        if f.startswith("receipt_diseases") and f.endswith(".feather")
-    ]
-    logger.debug(f"get_comorbidities: 発見された全疾患ファイル数 = {len(all_disease_files)}")
+    # インデックス日前の参照期間を判定するため、全期間の疾患ファイルを対象とする
+    disease_files_to_process = list_table_files(disease_dir, "receipt_diseases")
+    logger.info(f"処理対象の疾患ファイル: {len(disease_files_to_process)} 件（参照期間: "
+                f"{'全期間' if Config.COMORBIDITY_LOOKBACK_DAYS is None else f'{Config.COMORBIDITY_LOOKBACK_DAYS}日'}）")
+
+    if Config.USE_DISEASES_CODE_INDEX:
+        disease_files_to_process = select_files_for_codes(disease_files_to_process,
+                                                          comorbidity_lookup["diseases_code"].to_list(),
+                                                          load_diseases_code_index(disease_dir))
+        logger.debug(f"get_comorbidities: インデックスによる絞り込み後の疾患ファイル数 = {len(disease_files_to_process)}")
 
-    # ファイルを最終更新日時でソートし、最新の3ファイルを選択
-    all_disease_files.sort(key=lambda f: os.path.getmtime(f), reverse=True)
-    disease_files_to_process = all_disease_files[:3]
-    logger.info(f"処理対象の疾患ファイル (最新3件): {[os.path.basename(f) for f in disease_files_to_process]}")
-    logger.debug(f"get_comorbidities: 処理対象の疾患ファイル数 = {len(disease_files_to_process)}")
+    if Config.USE_KOJIN_ID_SUMMARY:
+        disease_files_to_process = select_files_for_patients(disease_files_to_process,
+                                                             cohort_keys,
+                                                             load_kojin_id_summary(disease_dir))
+        logger.debug(f"get_comorbidities: kojin_idサマリーによる絞り込み後の疾患ファイル数 = {len(disease_files_to_process)}")
 
-    comorbidity_results = []
+    if not disease_files_to_process:
+        logger.warning("get_comorbidities: 処理可能な併存疾患データが見つかりませんでした。全ての併存疾患フラグはFalseとします。")
     
-    for file_path in tqdm(disease_files_to_process, desc="併存疾患検索", unit="file"):
-        logger.debug(f"get_comorbidities: 併存疾患検索中: {file_path}")
-        try:
-            logger.debug(f"get_comorbidities: {file_path} を読み込み、フィルタリングします")
-            df_diseases = (pl.read_ipc(file_path)
-                          .filter(pl.col("kojin_id").is_in(list(patient_ids)))) # SetをListに変換
-            logger.debug(f"get_comorbidities: {file_path} の疾患データ数 = {len(df_diseases)}")
-            
-            if df_diseases.is_empty():
-                logger.debug(f"get_comorbidities: {file_path} の疾患データが空のためスキップします")
-                continue
-            
-            # 各併存疾患の有無をチェック
-            for disease, codes_list in comorbidity_codes.items():
-                logger.debug(f"get_comorbidities: 併存疾患 '{disease}' の有無をチェック (コード数: {len(codes_list)})")
-                if codes_list: # コードリストが空でない場合のみ処理
-                    disease_patients = (df_diseases
-                                      .filter(pl.col("diseases_code").is_in(codes_list))
-                                      .select("kojin_id")
-                                      .unique()
-                                      .with_columns(pl.lit(True).alias(f"has_{disease}")))
-                    logger.debug(f"get_comorbidities: '{disease}' を持つ患者数 (このファイル内): {len(disease_patients)}")
-                    if not disease_patients.is_empty(): # 結果が空でなければ追加
-                        comorbidity_results.append(disease_patients)
-                        logger.debug(f"get_comorbidities: comorbidity_results に '{disease}' の結果を追加")
-                    
-        except Exception as e:
-            logger.warning(f"併存疾患検索中にエラー ({file_path}): {e}")
-            logger.exception(f"get_comorbidities: エラー詳細:")
-            continue
+    comorbidity_flags = flag_categories(disease_files_to_process,
+                                        patients_df,
+                                        comorbidity_lookup,
+                                        list(category_codes),
+                                        Config.COMORBIDITY_LOOKBACK_DAYS,
+                                        cohort_keys)
+    comorbidity_flags = with_index_scores(comorbidity_flags, Config.COMORBIDITY_INDICES)
+    patients_with_comorbidities = patients_df.join(comorbidity_flags, on="kojin_id", how="left")
+    for disease in Config.COMORBIDITY_ICD10_CODES:
+        logger.debug(f"get_comorbidities: '{disease}' を持つ患者数 = {patients_with_comorbidities[f'has_{disease}'].sum()}")
+    for index_name in Config.COMORBIDITY_INDICES:
+        logger.info(f"{index_name}_index 平均: {patients_with_comorbidities[f'{index_name}_index'].mean()}")
     
-    logger.debug(f"get_comorbidities: 疾患ファイル処理ループ終了。comorbidity_results の要素数 = {len(comorbidity_results)}")
+    logger.debug(f"get_comorbidities: 最終的な併存疾患データ shape = {patients_with_comorbidities.shape}, columns = {patients_with_comorbidities.columns}")
+    logger.debug("get_comorbidities: 終了")
+    return patients_with_comorbidities
+
+def get_treatment_eras(base_dir: str, patients_df: pl.DataFrame) -> pl.DataFrame:
+    """処方イベントデータセットから治療エピソードを作成"""
+    logger.info("治療エピソードの作成を開始します")
+    drug_names = {code: name for name, code in Config.DRUG_CODES.items()}
+    events = scan_cohort_prescription_events(CohortKeys.from_frame(patients_df), list(drug_names))
+    if events is None:
+        logger.warning("処方イベントデータセットがないため治療エピソードは作成しません（build_prescription_events.py を実行してください）")
+        return pl.DataFrame(schema=TREATMENT_ERA_SCHEMA)
     
-    # 患者データに併存疾患フラグを結合
-    patients_with_comorbidities = patients_df.clone() # 元のDFを汚さないようにコピー
+    eras = build_treatment_eras(events,
+                                patients_df,
+                                drug_names,
+                                Config.TREATMENT_ERA_ALLOWED_GAP_DAYS,
+                                Config.TREATMENT_ERA_DEFAULT_DAYS_SUPPLY,
+                                datetime.strptime(Config.OBSERVATION_END, "%Y-%m-%d").date(),
+                                get_follow_up_ends(base_dir, patients_df))
+    logger.info(f"治療エピソード: {len(eras)} 件（{eras['kojin_id'].n_unique()} 患者、打ち切り {eras['censored'].sum()} 件）")
+    return eras
 
-    # まず全ての併存疾患カラムをFalseで初期化
-    for disease_key in Config.COMORBIDITY_ICD10_CODES.keys():
-        patients_with_comorbidities = patients_with_comorbidities.with_columns(
-            pl.lit(False).alias(f"has_{disease_key}")
-        )
-    logger.debug(f"get_comorbidities: 全ての併存疾患カラムをFalseで初期化完了。カラム: {patients_with_comorbidities.columns}")
+def get_care_continuity(base_dir: str,
+                        patients_df: pl.DataFrame,
+                        master_data: Dict[str, pl.DataFrame]) -> Tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    """F10.2 診療継続（月次の算定有無、継続期間、転院）の作成"""
+    logger.info("F10.2 診療継続の作成を開始します")
+    cohort_keys = CohortKeys.from_frame(patients_df)
+    
+    icd10_master = master_data.get("icd10")
+    f10_2_diseases_codes = []
+    if icd10_master is None:
+        logger.error("ICD10マスターデータがないため、F10.2 の算定月は空とします")
+    else:
+        f10_2_diseases_codes = (build_category_lookup(icd10_master, {"f10_2": [Config.F10_2_ICD10_CODE]})
+                                ["diseases_code"].to_list())
+    logger.debug(f"get_care_continuity: F10.2 の diseases_code 数 = {len(f10_2_diseases_codes)}")
+    
+    disease_dir = os.path.join(base_dir, "receipt_diseases")
+    institution_dir = os.path.join(base_dir, "receipt_medical_institution")
+    if Config.USE_WORKING_COPY:
+        disease_dir = resolve_table_dir("receipt_diseases", disease_dir, Config.WORKING_COPY_DIR)
+        institution_dir = resolve_table_dir("receipt_medical_institution", institution_dir, Config.WORKING_COPY_DIR)
+    disease_files = list_table_files(disease_dir, "receipt_diseases")
+    institution_files = list_table_files(institution_dir, "receipt_medical_institution")
+    if Config.USE_DISEASES_CODE_INDEX:
+        disease_files = select_files_for_codes(disease_files, f10_2_diseases_codes, load_diseases_code_index(disease_dir))
+    if Config.USE_KOJIN_ID_SUMMARY:
+        disease_files = select_files_for_patients(disease_files, cohort_keys, load_kojin_id_summary(disease_dir))
+        institution_files = select_files_for_patients(institution_files, cohort_keys,
+                                                      load_kojin_id_summary(institution_dir))
+    logger.info(f"処理対象の疾患ファイル: {len(disease_files)} 件、医療機関ファイル: {len(institution_files)} 件")
+    if not institution_files:
+        logger.warning("レセプト(医療機関)ファイルがないため、転院は判定できません")
+    
+    summary, spells, transfers = build_care_continuity(
+        disease_files,
+        institution_files,
+        f10_2_diseases_codes,
+        patients_df,
+        Config.CARE_CONTINUITY_MAX_GAP_MONTHS,
+        datetime.strptime(Config.OBSERVATION_START, "%Y-%m-%d").date(),
+        datetime.strptime(Config.OBSERVATION_END, "%Y-%m-%d").date(),
+        cohort_keys,
+        get_follow_up_ends(base_dir, patients_df))
+    logger.info(f"F10.2 診療継続: 継続期間 {len(spells)} 件、転院 {len(transfers)} 件、"
+                f"脱落 {summary['dropout_date'].is_not_null().sum()} 患者")
+    return summary, spells, transfers
 
+def load_specialist_facilities(output_dir: str) -> Optional[pl.DataFrame]:
+    """医療機関別F10.2患者数から専門医療機関の (iryokikan_no, fiscal_year) を作成し、分布の分位点を保存"""
+    volume = load_institution_volume(Config.INSTITUTION_VOLUME_PATH)
+    if volume is None:
+        logger.warning(f"医療機関別F10.2患者数がないため、専門医療機関は判定しません"
+                       f"（build_institution_volume.py を実行してください）: {Config.INSTITUTION_VOLUME_PATH}")
+        return None
+    
+    quantiles = volume_quantiles(volume, Config.INSTITUTION_VOLUME_QUANTILES)
+    quantiles_output_path = get_table_path(output_dir, "institution_volume_quantiles", Config.OUTPUT_FORMAT)
+    write_table(quantiles, quantiles_output_path, sort_keys=["fiscal_year", "quantile"])
+    logger.info(f"医療機関別F10.2患者数の分位点を保存: {quantiles_output_path}")
+    
+    threshold = specialist_threshold(volume, Config.SPECIALIST_FACILITY_MIN_PATIENTS, Config.SPECIALIST_FACILITY_QUANTILE)
+    if threshold is None:
+        return None
+    specialists = specialist_facilities(volume, threshold)
+    logger.info(f"専門医療機関の閾値: {threshold} 人/年度（該当する医療機関・年度 {len(specialists)} / {len(volume)} 件）")
+    return specialists
 
-    if comorbidity_results:
-        logger.debug("get_comorbidities: 併存疾患データの統合を開始します")
-        # 最初に全患者IDを持つDataFrameを作成し、それに各疾患の有無をleft joinしていく
-        # これにより、いずれかのファイルにしか登場しない患者も正しく処理される
-        
-        # 統合用のベースとなるDataFrame (kojin_idのみ)
-        # ここでは、patients_dfからkojin_idを使い、それに各疾患情報をマージしていく
-        # 既にpatients_with_comorbiditiesはpatients_dfのコピーで、has_xxxカラムがFalseで初期化されているのでこれを使う
+def get_first_treatment_receipts(patients_df: pl.DataFrame, cohort_keys: CohortKeys) -> pl.DataFrame:
+    """インデックス日以降最初の対象薬剤の処方のレセプトと処方日（処方イベントデータセットから。同日の場合は receipt_id 順）"""
+    schema = {"kojin_id": pl.Int64, "receipt_id": pl.Int64, "institution_date": pl.Date}
+    events = scan_cohort_prescription_events(cohort_keys, list(Config.DRUG_CODES.values()))
+    if events is None:
+        logger.warning("処方イベントデータセットがないため、医療機関は全患者についてインデックスのレセプトから判定します")
+        return pl.DataFrame(schema=schema)
+    
+    index_dates = with_date_columns(patients_df.select(["kojin_id", "index_date"]), ["index_date"])
+    return (events
+            .select(["kojin_id", "shohou_ymd", pl.col("receipt_id").cast(pl.Int64)])
+            .join(index_dates.lazy(), on="kojin_id", how="inner")
+            .filter(pl.col("shohou_ymd") >= pl.col("index_date"))
+            .sort(["kojin_id", "shohou_ymd", "receipt_id"])
+            .group_by("kojin_id")
+            .agg([pl.col("receipt_id").first(), pl.col("shohou_ymd").first().alias("institution_date")])
+            .collect(engine="streaming")
+            .cast(schema))
+
+def get_institution_features(base_dir: str,
+                             patients_df: pl.DataFrame,
+                             master_data: Dict[str, pl.DataFrame]) -> pl.DataFrame:
+    """初回治療（処方がない場合はインデックスのF10.2）のレセプトの医療機関の特徴"""
+    logger.info("医療機関の特徴の取得を開始します")
+    cohort_keys = CohortKeys.from_frame(patients_df)
+    
+    treatment_receipts = get_first_treatment_receipts(patients_df, cohort_keys)
+    index_receipts = (with_date_columns(patients_df, ["index_date"])
+                      .select(["kojin_id",
+                               pl.col("first_receipt_id").cast(pl.Int64).alias("receipt_id"),
+                               pl.col("index_date").alias("institution_date")])
+                      .join(treatment_receipts, on="kojin_id", how="anti"))
+    receipts = pl.concat([
+        treatment_receipts.with_columns(pl.lit("first_treatment").alias("institution_source")),
+        index_receipts.with_columns(pl.lit("index_diagnosis").alias("institution_source")),
+    ])
+    logger.debug(f"get_institution_features: 初回治療のレセプト {len(treatment_receipts)} 件, "
+                 f"インデックスのレセプト {len(index_receipts)} 件")
+    
+    institution_dir = os.path.join(base_dir, "receipt_medical_institution")
+    if Config.USE_WORKING_COPY:
+        institution_dir = resolve_table_dir("receipt_medical_institution", institution_dir, Config.WORKING_COPY_DIR)
+    institution_files = list_table_files(institution_dir, "receipt_medical_institution")
+    if Config.USE_KOJIN_ID_SUMMARY:
+        institution_files = select_files_for_patients(institution_files, cohort_keys,
+                                                      load_kojin_id_summary(institution_dir))
+    if not institution_files:
+        logger.warning("レセプト(医療機関)ファイルが見つからないため、医療機関は全て unknown とします")
+    
+    institutions = classify_institutions(resolve_receipt_institutions(receipts, institution_files, cohort_keys),
+                                         master_data["institution_lookup"])
+    # 専門医療機関: 初回治療（インデックス）の年度に、その医療機関の患者数が閾値以上か
+    specialists = master_data.get("specialist_facilities")
+    if specialists is not None:
+        institutions = flag_specialist_facilities(institutions, specialists, "institution_date")
+    else:
+        institutions = institutions.with_columns(pl.lit(None, dtype=pl.Boolean).alias("is_specialist_facility"))
+    features = (patients_df
+                .select("kojin_id")
+                .join(institutions.select(["kojin_id", "institution_source", "institution_date", "iryokikan_no",
+                                           "institution_type", "bed_size_band", "total_byoshousuu_code",
+                                           "dpc_hosp_code", "is_specialist_facility"]),
+                      on="kojin_id", how="left"))
+    for row in features.group_by("institution_type").len().sort("institution_type").iter_rows():
+        logger.info(f"医療機関種別 {row[0]}: {row[1]} 人")
+    return features
 
-        # 各疾患の結果を統合
-        # comorbidity_resultsには、各ファイル・各疾患で見つかった患者の (kojin_id, has_disease=True) のDFが入っている
-        # これらを疾患ごとに集約し、最終的にpatients_with_comorbiditiesにマージする
+def get_index_procedures(base_dir: str,
+                         patients_df: pl.DataFrame,
+                         master_data: Dict[str, pl.DataFrame]) -> pl.DataFrame:
+    """インデックスのレセプト（first_receipt_id）でインデックス日に算定された診療行為"""
+    logger.info("インデックス日の同時算定診療行為の取得を開始します")
+    # インデックスのレセプトを年月毎にまとめ、その月の診療行為ファイルと receipt_id で結合する
+    index_receipts = patients_df.select([
+        "kojin_id",
+        pl.col("first_receipt_id").cast(pl.Int64).alias("receipt_id"),
+        pl.col("first_receipt_ym").cast(pl.String).str.replace_all(r"[/-]", "").alias("receipt_month"),
+        "index_date",
+    ])
+    practice_files = list_table_files(os.path.join(base_dir, "receipt_medical_practice"), "receipt_medical_practice")
+    santei_files = list_table_files(os.path.join(base_dir, "receipt_medical_practice_santei_ymd"),
+                                    "receipt_medical_practice_santei_ymd")
+    if not practice_files or not santei_files:
+        logger.warning("診療行為ファイルまたは診療行為算定日ファイルが見つからないため、同時算定診療行為は作成しません")
+    
+    procedures = collect_index_procedures(practice_files, santei_files, index_receipts, master_data["practice_names"])
+    logger.info(f"インデックス日の同時算定診療行為: {len(procedures)} 件（{procedures['kojin_id'].n_unique()} 患者、"
+                f"{procedures['medical_practice_code'].n_unique()} コード）")
+    return procedures
 
-        # 疾患ごとの結果を一時的に格納する辞書
-        aggregated_disease_dfs: Dict[str, pl.DataFrame] = {}
+def get_treated_fiscal_years(patients_df: pl.DataFrame) -> Optional[pl.DataFrame]:
+    """処方イベントデータセットから、ヒートマップの対象薬剤の患者・年度毎の処方数
 
-        for res_df in comorbidity_results:
-            # res_dfは (kojin_id, has_DISEASE_NAME=True) の形
-            disease_col_name = [col for col in res_df.columns if col.startswith("has_")][0]
-            
-            if disease_col_name not in aggregated_disease_dfs:
-                aggregated_disease_dfs[disease_col_name] = res_df
-            else:
-                # 既に同じ疾患の結果がある場合はconcatしてunique
-                aggregated_disease_dfs[disease_col_name] = pl.concat([
-                    aggregated_disease_dfs[disease_col_name],
-                    res_df
-                ]).unique(subset=["kojin_id"])
-        
-        logger.debug(f"get_comorbidities: 集約された疾患別DataFrameのキー: {list(aggregated_disease_dfs.keys())}")
-
-        # 集約された疾患別DataFrameをpatients_with_comorbiditiesに結合
-        for disease_col_name, disease_df in aggregated_disease_dfs.items():
-            logger.debug(f"get_comorbidities: '{disease_col_name}' を結合 (shape: {disease_df.shape})")
-            # 一旦既存のhas_DISEASE_NAMEカラムを削除し、新しい情報で更新する
-            # ただし、pl.DataFrame.dropは新しいDFを返すので、再代入が必要
-            if disease_col_name in patients_with_comorbidities.columns:
-                 patients_with_comorbidities = patients_with_comorbidities.drop(disease_col_name)
-            
-            patients_with_comorbidities = patients_with_comorbidities.join(
-                disease_df, on="kojin_id", how="left"
-            ).with_columns(
-                pl.col(disease_col_name).fill_null(False) # joinで見つからなかった場合はFalse
-            )
-            logger.debug(f"get_comorbidities: '{disease_col_name}' 結合後の shape: {patients_with_comorbidities.shape}")
+    分子はコホート（F10.2患者）の処方患者のみで、対象薬剤を処方された加入者全体ではない。
+    処方イベントデータセットがない場合はNone（ヒートマップは作成しない）。
+    """
+    logger.info("ヒートマップの対象薬剤の処方年度の集計を開始します")
+    events = scan_cohort_prescription_events(CohortKeys.from_frame(patients_df), Config.HEATMAP_DRUG_CODES)
+    if events is None:
+        logger.warning("処方イベントデータセットがないため、地域・年度毎の処方患者数は作成しません"
+                       "（build_prescription_events.py を実行してください）")
+        return None
+    
+    treated_years = treated_fiscal_years(events,
+                                         datetime.strptime(Config.OBSERVATION_START, "%Y-%m-%d").date(),
+                                         datetime.strptime(Config.OBSERVATION_END, "%Y-%m-%d").date())
+    logger.info(f"対象薬剤の処方: {treated_years['kojin_id'].n_unique()} 患者（{len(treated_years)} 患者・年度）")
+    return treated_years
+
+def get_enrollment_population(raw_data_dir: str) -> Optional[pl.DataFrame]:
+    """Figure 2 の分母の地域・年度毎の加入者数（保存済みの表がなければ適用ファイルから集計して保存）"""
+    tekiyo_dir = raw_data_dir
+    if Config.USE_WORKING_COPY:
+        tekiyo_dir = resolve_table_dir("tekiyo", tekiyo_dir, Config.WORKING_COPY_DIR)
+    tekiyo_file = find_table(tekiyo_dir, "tekiyo")
+    if tekiyo_file is None:
+        logger.warning(f"適用ファイルが見つからないため、地域・年度毎の加入者数は作成しません: {tekiyo_dir}")
+        return None
+    
+    population = load_enrollment_population(tekiyo_file,
+                                            Config.ENROLLMENT_POPULATION_DIR,
+                                            datetime.strptime(Config.OBSERVATION_START, "%Y-%m-%d").date(),
+                                            datetime.strptime(Config.OBSERVATION_END, "%Y-%m-%d").date(),
+                                            Config.REBUILD_ENROLLMENT_POPULATION)
+    logger.info(f"地域・年度毎の加入者数: {len(population)} 件（地域 {population['chiiki_code'].n_unique()} 件）")
+    return population
 
+def get_interval_treatments(patients_df: pl.DataFrame) -> pl.DataFrame:
+    """処方イベントデータセットから、インデックス日以降の区間毎の治療状態（処方のある区間のみ）"""
+    logger.info("区間毎の治療状態の集計を開始します")
+    drug_states = {Config.DRUG_CODES[drug]: state
+                   for state, drugs in Config.SANKEY_DRUG_STATES.items() for drug in drugs}
+    events = scan_cohort_prescription_events(CohortKeys.from_frame(patients_df), list(drug_states))
+    if events is None:
+        logger.warning("処方イベントデータセットがないため、全区間を処方なしとします（build_prescription_events.py を実行してください）")
+        return pl.DataFrame(schema=INTERVAL_STATE_SCHEMA)
+    
+    treatments = interval_treatments(events,
+                                     patients_df,
+                                     drug_states,
+                                     list(Config.SANKEY_DRUG_STATES),
+                                     Config.SANKEY_INTERVAL_DAYS,
+                                     Config.SANKEY_N_INTERVALS)
+    logger.info(f"処方のある区間: {len(treatments)} 件（{treatments['kojin_id'].n_unique()} 患者）")
+    return treatments
+
+def build_treatment_transitions(baseline_df: pl.DataFrame, interval_treatments_df: pl.DataFrame) -> pl.DataFrame:
+    """全患者×全区間の治療状態を割り当て、隣り合う区間の間の推移を集計"""
+    observation_end = datetime.strptime(Config.OBSERVATION_END, "%Y-%m-%d").date()
+    if "observable_end_ym" in baseline_df.columns:
+        follow_up_end = follow_up_end_expr("observable_end_ym", baseline_df.schema["observable_end_ym"], observation_end)
     else:
-        logger.warning("get_comorbidities: 処理可能な併存疾患データが見つかりませんでした。全ての併存疾患フラグはFalseのままです。")
-        # この場合、既に全てのhas_xxxカラムはFalseで初期化されているので追加の処理は不要
-
-    # 念のため、全てのhas_xxxカラムが存在し、bool型であることを確認・強制
-    for disease_key in Config.COMORBIDITY_ICD10_CODES.keys():
-        col_name = f"has_{disease_key}"
-        if col_name not in patients_with_comorbidities.columns:
-            # このパスは通常通らないはずだが、念のため
-            patients_with_comorbidities = patients_with_comorbidities.with_columns(pl.lit(False).cast(pl.Boolean).alias(col_name))
-        else:
-            # 既存カラムをbool型にキャスト（fill_null(False)の後なので問題ないはず）
-            patients_with_comorbidities = patients_with_comorbidities.with_columns(pl.col(col_name).cast(pl.Boolean))
+        follow_up_end = pl.lit(observation_end)
+    patients = baseline_df.select(["kojin_id", "index_date", follow_up_end.alias("follow_up_end")])
+    states = assign_states(patients, interval_treatments_df, Config.SANKEY_INTERVAL_DAYS, Config.SANKEY_N_INTERVALS)
+    return transition_counts(states)
+
+def get_timeline_fills(patients_df: pl.DataFrame) -> pl.DataFrame:
+    """処方イベントデータセットから、タイムライン用の対象薬剤の処方（kojin_id, shohou_ymd, drug_class）"""
+    schema = {"kojin_id": pl.Int64, "shohou_ymd": pl.Date, "drug_class": pl.String}
+    events = scan_cohort_prescription_events(CohortKeys.from_frame(patients_df), list(Config.DRUG_CODES.values()))
+    if events is None:
+        logger.warning("処方イベントデータセットがないため、タイムラインに処方は含めません（build_prescription_events.py を実行してください）")
+        return pl.DataFrame(schema=schema)
     
-    logger.debug(f"get_comorbidities: 最終的な併存疾患データ shape = {patients_with_comorbidities.shape}, columns = {patients_with_comorbidities.columns}")
-    logger.debug("get_comorbidities: 終了")
-    return patients_with_comorbidities
+    drug_names = pl.DataFrame({"drug_code": list(Config.DRUG_CODES.values()), "drug_class": list(Config.DRUG_CODES)})
+    return (events
+            .select(["kojin_id", "shohou_ymd", "drug_code"])
+            .join(drug_names.lazy().cast({"drug_code": events.collect_schema()["drug_code"]}), on="drug_code", how="inner")
+            .select(list(schema))
+            .collect(engine="streaming")
+            .cast(schema))
+
+def get_timeline_exams(base_dir: str, patients_df: pl.DataFrame) -> pl.DataFrame:
+    """健診ファイルから、タイムライン用のコホートの全健診日（kojin_id, exam_ymd）"""
+    schema = {"kojin_id": pl.Int64, "exam_ymd": pl.Date}
+    exam_file = find_table(base_dir, "exam_interview_processed")
+    if exam_file is None:
+        logger.warning(f"健診ファイルがないため、タイムラインに健診は含めません: "
+                       f"{os.path.join(base_dir, 'exam_interview_processed.feather')}")
+        return pl.DataFrame(schema=schema)
+    
+    cohort_keys = CohortKeys.from_frame(patients_df)
+    exams = (cohort_keys.restrict(scan_table(exam_file))
+             .select(["kojin_id", "exam_ymd"])
+             .collect())
+    return (with_date_columns(exams, ["exam_ymd"])
+            .drop_nulls()
+            .unique()
+            .cast(schema))
+
+def build_patient_timeline(patients_df: pl.DataFrame, results: Dict) -> pl.DataFrame:
+    """各ステージの結果から、患者毎のイベントタイムラインを一度だけ作成"""
+    diagnosis_months = transfers = exams = None
+    if "care_continuity" in results:
+        summary, _, transfers = results["care_continuity"]
+        diagnosis_months = bitmap_months(summary,
+                                         datetime.strptime(Config.OBSERVATION_START, "%Y-%m-%d").date(),
+                                         datetime.strptime(Config.OBSERVATION_END, "%Y-%m-%d").date())
+    if not results["timeline_exams"].is_empty():
+        exams = results["timeline_exams"]
+    events = build_timeline_events(patients_df, diagnosis_months, results["timeline_fills"], exams, transfers,
+                                   list(Config.DRUG_CODES))
+    logger.info(f"イベントタイムライン: {len(events)} 件（{events['kojin_id'].n_unique()} 患者）")
+    return events
+
+def build_demographics(raw_data_dir: str,
+                       patients_df: pl.DataFrame,
+                       cohort_keys: CohortKeys,
+                       cohort_name: str) -> pl.DataFrame:
+    """基本情報（適用データ）の結合と年齢計算"""
+    tekiyo_df = get_tekiyo_data(raw_data_dir, cohort_keys) # 適用データは raw_data_dir から
+    if not tekiyo_df.is_empty():
+        logger.debug(f"build_demographics: ({cohort_name}) 適用データを取得しました. 年齢計算を行います.")
+        return calculate_age_at_index(tekiyo_df, patients_df)
+    logger.warning(f"build_demographics: ({cohort_name}) 適用データが空でした。年齢計算はスキップします。")
+    # 年齢カラムが存在しない可能性があるので、Noneで追加しておく
+    return patients_df.with_columns(pl.lit(None, dtype=pl.Int32).alias("age_at_index"))
+
+def build_cohort_features(cohort_name: str,
+                          patients_df: pl.DataFrame,
+                          raw_data_dir: str,
+                          master_data: Dict[str, pl.DataFrame],
+                          params: Dict) -> Dict[str, pl.DataFrame]:
+    """1コホート分のデータセット（ベースライン、健診時系列、治療エピソード）を作成
+
+    各ステージは患者のkojin_id・index_dateのみに依存するため、互いに独立に実行し、
+    最後にkojin_idで結合する（基本情報 → 治療群 → 併存疾患 → 医療機関の列順）。
+    """
+    cohort_keys = CohortKeys.from_frame(patients_df)
+    logger.debug(f"build_cohort_features: 患者数 = {len(cohort_keys)}")
+    
+    stages = [
+        # 1. 基本情報（適用データ）
+        ("demographics", lambda: build_demographics(raw_data_dir, patients_df, cohort_keys, cohort_name)),
+        # 2. 治療群の分類（薬剤関連データは raw_data_dir から）
+        ("treatment", lambda: classify_treatment_groups(patients_df, raw_data_dir, params)),
+        # 3. 併存疾患の取得
+        ("comorbidities", lambda: get_comorbidities(raw_data_dir, patients_df, master_data, params)),
+        # 4. 健診データの時系列取得
+        ("exam", lambda: get_exam_data_time_series(raw_data_dir, patients_df, params)),
+    ]
+    if Config.BUILD_TREATMENT_ERAS:
+        # 5. 治療エピソード（処方イベントデータセットから）
+        stages.append(("treatment_eras", lambda: get_treatment_eras(raw_data_dir, patients_df)))
+    if Config.BUILD_INSTITUTION_FEATURES:
+        # 6. 医療機関の特徴
+        stages.append(("institution", lambda: get_institution_features(raw_data_dir, patients_df, master_data)))
+    if Config.BUILD_CARE_CONTINUITY:
+        # 7. F10.2 診療継続
+        stages.append(("care_continuity", lambda: get_care_continuity(raw_data_dir, patients_df, master_data)))
+    if Config.BUILD_INDEX_PROCEDURES:
+        # 8. インデックス日の同時算定診療行為
+        stages.append(("index_procedures", lambda: get_index_procedures(raw_data_dir, patients_df, master_data)))
+    if Config.BUILD_PRESCRIPTION_HEATMAP:
+        # 9. 地域・年度毎の処方患者数の分子（処方イベントデータセットから）
+        stages.append(("treated_years", lambda: get_treated_fiscal_years(patients_df)))
+    if Config.BUILD_TREATMENT_TRANSITIONS:
+        # 10. 区間毎の治療状態（処方イベントデータセットから）
+        stages.append(("interval_treatments", lambda: get_interval_treatments(patients_df)))
+    if Config.BUILD_PATIENT_TIMELINES:
+        # 11. タイムライン用の対象薬剤の処方（処方イベントデータセットから）
+        stages.append(("timeline_fills", lambda: get_timeline_fills(patients_df)))
+        # 12. タイムライン用の全健診日（時点毎の健診に限らない）
+        stages.append(("timeline_exams", lambda: get_timeline_exams(raw_data_dir, patients_df)))
+    
+    if Config.RUN_STAGES_CONCURRENTLY:
+        logger.debug(f"build_cohort_features: ({cohort_name}) ステージを並行実行します（同時実行数 {params['stage_workers']}）")
+        results = run_stages(stages, params['stage_workers'], params['memory_budget'])
+    else:
+        results = {name: build() for name, build in stages}
+    
+    logger.debug(f"build_cohort_features: ({cohort_name}) 各ステージの結果を kojin_id で結合します")
+    baseline_df = results["demographics"]
+    for name in ("treatment", "comorbidities", "institution"):
+        if name not in results:
+            continue
+        new_columns = [col for col in results[name].columns if col not in patients_df.columns]
+        baseline_df = baseline_df.join(results[name].select(["kojin_id"] + new_columns), on="kojin_id", how="left")
+    logger.debug(f"build_cohort_features: ({cohort_name}) 結合後の baseline_df shape = {baseline_df.shape}")
+    
+    datasets = {"baseline": baseline_df, "timeseries_exam": results["exam"]}
+    if "treatment_eras" in results:
+        datasets["treatment_eras"] = results["treatment_eras"]
+    if "care_continuity" in results:
+        datasets["care_continuity"], datasets["care_spells"], datasets["care_transfers"] = results["care_continuity"]
+    if "index_procedures" in results:
+        datasets["index_procedures"] = results["index_procedures"]
+    for name in ("treated_years", "interval_treatments"):
+        if results.get(name) is not None:
+            datasets[name] = results[name]
+    if "timeline_fills" in results:
+        # 他のステージの結果（F10.2の算定月、健診、転院）と処方をまとめる
+        datasets["timeline_events"] = build_patient_timeline(patients_df, results)
+    return datasets
+
+def build_exam_panel(patients_df: pl.DataFrame, exam_time_series: pl.DataFrame) -> pl.DataFrame:
+    """健診時系列データ（縦持ち）を、患者1行・"<項目>_<時点>" 列の横持ちパネルに変換"""
+    time_points = [time_point for time_point, _, _, _ in EXAM_TIME_POINTS]
+    available = exam_time_series.columns if not exam_time_series.is_empty() else []
+    panel_columns = [col for col in Config.EXAM_PANEL_COLUMNS if col in available]
+    missing_columns = [col for col in Config.EXAM_PANEL_COLUMNS if col not in available]
+    if missing_columns and available:
+        logger.warning(f"build_exam_panel: 健診データにない項目はパネルから除外します: {missing_columns}")
+    
+    panel = patients_df.select("kojin_id")
+    if panel_columns:
+        # 各患者・時点の健診は1件のため、時点で絞り込んだ最初の値がその時点の値となる
+        wide = (exam_time_series
+                .group_by("kojin_id")
+                .agg([pl.col(col).filter(pl.col("time_point") == time_point).first().alias(f"{col}_{time_point}")
+                      for col in panel_columns for time_point in time_points]))
+        panel = panel.join(wide, on="kojin_id", how="left")
+    logger.debug(f"build_exam_panel: パネル shape = {panel.shape}")
+    return panel
+
+# Figure 5 用のデータセット（データセット名: (並び順のキー, 説明)）。ファイル名は {cohort}_cohort_<データセット名>
+FIGURE5_DATASETS = {
+    "treatment_eras": (["kojin_id", "era_number"], "治療エピソード"),
+    "care_continuity": (["kojin_id"], "F10.2 診療継続（患者毎）"),
+    "care_spells": (["kojin_id", "spell_number"], "F10.2 継続期間"),
+    "care_transfers": (["kojin_id", "transfer_month"], "F10.2 転院"),
+}
+
+def save_cohort_datasets(cohort_name: str,
+                         datasets: Dict[str, pl.DataFrame],
+                         output_dir: str,
+                         enrollment_population: Optional[pl.DataFrame] = None):
+    """1コホート分のデータセットを {cohort}_cohort_<データセット名> として保存"""
+    baseline_df = datasets["baseline"]
+    exam_time_series = datasets["timeseries_exam"]
+    logger.debug(f"save_cohort_datasets: ({cohort_name}) 5. ベースラインデータセットの保存を開始します")
+    baseline_output_path = get_table_path(output_dir, f"{cohort_name}_cohort_baseline", Config.OUTPUT_FORMAT)
+    logger.debug(f"save_cohort_datasets: ({cohort_name}) ベースラインデータ保存先: {baseline_output_path}")
+    write_table(baseline_df, baseline_output_path, sort_keys=["kojin_id"])
+    logger.info(f"{cohort_name} cohort ベースラインデータを保存: {baseline_output_path}")
+    
+    # 6. 時系列データセットの保存
+    logger.debug(f"save_cohort_datasets: ({cohort_name}) 6. 時系列データセットの作成と保存を開始します")
+    if not exam_time_series.is_empty():
+        # exam_time_series は time_point ごとの縦持ちのまま、ベースラインとは別ファイルに保存する
+        timeseries_output_path = get_table_path(output_dir, f"{cohort_name}_cohort_timeseries_exam", Config.OUTPUT_FORMAT)
+        write_table(exam_time_series, timeseries_output_path, sort_keys=["kojin_id", "time_point"])
+        logger.info(f"{cohort_name} cohort 健診時系列データを保存: {timeseries_output_path}")
+        logger.debug(f"save_cohort_datasets: ({cohort_name}) 健診時系列データ保存完了: {timeseries_output_path}")
+    else:
+        logger.warning(f"save_cohort_datasets: ({cohort_name}) 健診時系列データが空のため、保存をスキップします")
+    
+    # 7. Table 7 用の横持ち健診パネルの保存（健診データのない患者も1行として含める）
+    if Config.EXAM_PANEL_COLUMNS:
+        exam_panel = build_exam_panel(baseline_df, exam_time_series)
+        panel_output_path = get_table_path(output_dir, f"{cohort_name}_cohort_exam_panel", Config.OUTPUT_FORMAT)
+        write_table(exam_panel, panel_output_path, sort_keys=["kojin_id"])
+        logger.info(f"{cohort_name} cohort 健診パネルを保存: {panel_output_path} ({exam_panel.shape[1] - 1} 列)")
+    
+    # 8. Figure 5 用の治療エピソード・診療継続の保存（空でも列定義を残すため保存する）
+    for name, (sort_keys, description) in FIGURE5_DATASETS.items():
+        if name not in datasets:
+            continue
+        output_path = get_table_path(output_dir, f"{cohort_name}_cohort_{name}", Config.OUTPUT_FORMAT)
+        write_table(datasets[name], output_path, sort_keys=sort_keys)
+        logger.info(f"{cohort_name} cohort {description}を保存: {output_path}")
+    
+    # 9. Table 4 用のインデックス日の同時算定診療行為（患者毎と、治療群毎の上位の頻度）
+    if "index_procedures" in datasets:
+        procedures_output_path = get_table_path(output_dir, f"{cohort_name}_cohort_index_procedures", Config.OUTPUT_FORMAT)
+        write_table(datasets["index_procedures"], procedures_output_path, sort_keys=["kojin_id", "medical_practice_code"])
+        logger.info(f"{cohort_name} cohort インデックス日の同時算定診療行為を保存: {procedures_output_path}")
+        
+        frequencies = procedure_frequencies(datasets["index_procedures"],
+                                            baseline_df.select(["kojin_id", "treatment_group"]),
+                                            Config.INDEX_PROCEDURE_TOP_N)
+        frequencies_output_path = get_table_path(output_dir, f"{cohort_name}_cohort_index_procedure_frequencies",
+                                                 Config.OUTPUT_FORMAT)
+        write_table(frequencies, frequencies_output_path, sort_keys=["treatment_group", "rank"])
+        logger.info(f"{cohort_name} cohort 治療群毎の同時算定診療行為の頻度を保存: {frequencies_output_path}")
+    
+    # 10. Figure 2 用の地域・年度毎の処方患者数（分母は保存済みの加入者数）
+    if "treated_years" in datasets and enrollment_population is not None and "chiiki_code" not in baseline_df.columns:
+        logger.warning(f"{cohort_name} cohort ベースラインに地域（chiiki_code）がないため、"
+                       f"地域・年度毎の処方患者数は作成しません（適用データを確認してください）")
+    elif "treated_years" in datasets and enrollment_population is not None:
+        heatmap = prescribing_rates(datasets["treated_years"],
+                                    baseline_df.select(["kojin_id", "chiiki_code"]),
+                                    enrollment_population,
+                                    Config.HEATMAP_FISCAL_YEARS)
+        heatmap_output_path = get_table_path(output_dir, f"{cohort_name}_cohort_prescription_heatmap", Config.OUTPUT_FORMAT)
+        write_table(heatmap, heatmap_output_path, sort_keys=["chiiki_code", "fiscal_year"])
+        logger.info(f"{cohort_name} cohort 地域・年度毎の処方患者数を保存: {heatmap_output_path} "
+                    f"（処方患者 延べ {heatmap['n_treated_patients'].sum()} 人・年度）")
+    
+    # 11. Figure 4 用の治療状態の推移（追跡終了はベースラインの観察可能終了年月から判定）
+    if "interval_treatments" in datasets:
+        transitions = build_treatment_transitions(baseline_df, datasets["interval_treatments"])
+        transitions_output_path = get_table_path(output_dir, f"{cohort_name}_cohort_treatment_transitions",
+                                                 Config.OUTPUT_FORMAT)
+        write_table(transitions, transitions_output_path, sort_keys=["from_interval", "from_state", "to_state"])
+        logger.info(f"{cohort_name} cohort 治療状態の推移を保存: {transitions_output_path}")
+    
+    # 12. Figure 3 用のイベントタイムライン（イベントの列はメモリマップで切り出せるよう非圧縮の .arrow、患者はオフセットのみ）
+    if "timeline_events" in datasets:
+        events, offsets = to_timeline_store(datasets["timeline_events"])
+        events_output_path = get_table_path(output_dir, f"{cohort_name}_cohort_timeline_events", "arrow")
+        write_table(events, events_output_path)
+        offsets_output_path = get_table_path(output_dir, f"{cohort_name}_cohort_timeline_offsets", Config.OUTPUT_FORMAT)
+        write_table(offsets, offsets_output_path, sort_keys=["kojin_id"])
+        logger.info(f"{cohort_name} cohort イベントタイムラインを保存: {events_output_path} "
+                    f"（{len(events)} 件、{len(offsets)} 患者）")
+
+def is_subset_cohort(patients_df: pl.DataFrame, superset_df: pl.DataFrame) -> bool:
+    """コホートの全患者が、同じインデックス日で上位コホートに含まれるか"""
+    return patients_df.join(superset_df.select(["kojin_id", "index_date"]),
+                            on=["kojin_id", "index_date"],
+                            how="anti").is_empty()
 
 def create_analysis_datasets(cohorts: Dict[str, pl.DataFrame],
                            base_dir: str, # この引数は実質的に使われなくなる
@@ -645,77 +1381,57 @@ def create_analysis_datasets(cohorts: Dict[str, pl.DataFrame],
     # マスターデータは 'master/' ディレクトリから読み込む
     master_data_dir = "master" 
     master_data = load_master_data(master_data_dir)
+    # 医療機関の分類は、マスターから一度だけ作成した対応表との結合で行う
+    master_data["institution_lookup"] = build_institution_lookup(master_data.get("hco_med"),
+                                                                 master_data.get("hco_specialty"),
+                                                                 Config.PSYCHIATRIC_SPECIALTIES,
+                                                                 Config.BED_SIZE_BANDS)
+    master_data["specialist_facilities"] = load_specialist_facilities(output_dir)
+    # 診療行為名は、改定のある診療行為マスターから一度だけ作成した対応表との結合で付与する
+    master_data["practice_names"] = build_practice_names(master_data.get("med_treat"))
     
     # その他のデータは 'data/raw/' ディレクトリから読み込む
     raw_data_dir = os.path.join(Config.DATA_ROOT_DIR, "raw") # Config.DATA_ROOT_DIR は 'data' を想定
+    if Config.USE_CANONICAL_STORAGE:
+        raw_data_dir = resolve_data_dir(raw_data_dir, Config.CANONICAL_ROOT_DIR)
+    
+    enrollment_population = get_enrollment_population(raw_data_dir) if Config.BUILD_PRESCRIPTION_HEATMAP else None
+    
+    # 上位コホート（全患者）の変数を一度だけ作成し、他のコホートはその絞り込みとして作成する
+    superset_name = Config.SUPERSET_COHORT
+    superset_datasets = None
+    if (Config.DERIVE_COHORTS_FROM_SUPERSET and superset_name in cohorts
+            and not cohorts[superset_name].is_empty()):
+        logger.info(f"\n=== {superset_name.upper()} COHORT の変数を作成し、他のコホートはその絞り込みとして作成します ===")
+        superset_datasets = build_cohort_features(superset_name, cohorts[superset_name],
+                                                  raw_data_dir, master_data, params)
 
     for cohort_name, patients_df_original in cohorts.items():
         logger.info(f"\n=== {cohort_name.upper()} COHORT の処理開始 ===")
         logger.debug(f"create_analysis_datasets: コホート '{cohort_name}' の処理開始. patients_df_original shape = {patients_df_original.shape}")
-        
-        # --- デバッグコード削除: patients_df_original のスキーマ情報は不要になったため削除 ---
-        # logger.info(f"--- スキーマ情報 (patients_df_original for {cohort_name}) ---")
-        # logger.info(patients_df_original.schema)
-        # --- デバッグコード終了 ---
 
         if patients_df_original.is_empty():
             logger.warning(f"create_analysis_datasets: コホート '{cohort_name}' の患者データが空のためスキップします")
             continue
         
-        # 各コホート処理の開始時に元の患者DFをコピーして使用する
-        patients_df = patients_df_original.clone()
-        logger.debug(f"create_analysis_datasets: patients_df をコピーしました. shape = {patients_df.shape}")
-            
-        patient_ids = set(patients_df["kojin_id"].to_list())
-        logger.debug(f"create_analysis_datasets: patient_ids 数 = {len(patient_ids)}")
-        
-        logger.debug(f"create_analysis_datasets: ({cohort_name}) 1. 基本情報（適用データ）の結合を開始します")
-        tekiyo_df = get_tekiyo_data(raw_data_dir, patient_ids) # 適用データは raw_data_dir から
-        if not tekiyo_df.is_empty():
-            logger.debug(f"create_analysis_datasets: ({cohort_name}) 適用データを取得しました. 年齢計算を行います.")
-            patients_with_demo = calculate_age_at_index(tekiyo_df, patients_df)
+        if superset_datasets is not None and is_subset_cohort(patients_df_original, cohorts[superset_name]):
+            # 変数は患者とインデックス日のみで決まるため、上位コホートの結果を患者で絞り込めば同じになる
+            logger.debug(f"create_analysis_datasets: ({cohort_name}) {superset_name} コホートの変数から絞り込みます")
+            cohort_keys = patients_df_original.select("kojin_id")
+            datasets = {name: df.join(cohort_keys, on="kojin_id", how="semi") if not df.is_empty() else df
+                        for name, df in superset_datasets.items()}
         else:
-            logger.warning(f"create_analysis_datasets: ({cohort_name}) 適用データが空でした。年齢計算はスキップします。")
-            # 年齢カラムが存在しない可能性があるので、Noneで追加しておく
-            patients_with_demo = patients_df.with_columns(pl.lit(None, dtype=pl.Int32).alias("age_at_index"))
-        logger.debug(f"create_analysis_datasets: ({cohort_name}) 基本情報結合後の patients_with_demo shape = {patients_with_demo.shape}")
-        
-        logger.debug(f"create_analysis_datasets: ({cohort_name}) 2. 治療群の分類を開始します")
-        patients_with_treatment = classify_treatment_groups(patients_with_demo, raw_data_dir, params) # 薬剤関連データは raw_data_dir から
-        logger.debug(f"create_analysis_datasets: ({cohort_name}) 治療群分類後の patients_with_treatment shape = {patients_with_treatment.shape}")
-        
-        logger.debug(f"create_analysis_datasets: ({cohort_name}) 3. 併存疾患の取得を開始します")
-        # get_comorbidities は master_data を引数に取るので、raw_data_dir も渡す
-        patients_with_comorbidities = get_comorbidities(raw_data_dir, patients_with_treatment, master_data, params) 
-        logger.debug(f"create_analysis_datasets: ({cohort_name}) 併存疾患取得後の patients_with_comorbidities shape = {patients_with_comorbidities.shape}")
+            if superset_datasets is not None:
+                logger.warning(f"{cohort_name} cohort は {superset_name} cohort に含まれない患者を含むため、個別に作成します")
+            # 各コホート処理の開始時に元の患者DFをコピーして使用する
+            patients_df = patients_df_original.clone()
+            logger.debug(f"create_analysis_datasets: patients_df をコピーしました. shape = {patients_df.shape}")
+            datasets = build_cohort_features(cohort_name, patients_df, raw_data_dir, master_data, params)
         
-        logger.debug(f"create_analysis_datasets: ({cohort_name}) 4. 健診データの時系列取得を開始します")
-        exam_time_series = get_exam_data_time_series(raw_data_dir, patients_with_comorbidities, params) # 健診データは raw_data_dir から
-        logger.debug(f"create_analysis_datasets: ({cohort_name}) 健診データ時系列取得後の exam_time_series shape = {exam_time_series.shape}")
-        
-        logger.debug(f"create_analysis_datasets: ({cohort_name}) 5. ベースラインデータセットの保存を開始します")
-        baseline_output_path = os.path.join(output_dir, f"{cohort_name}_cohort_baseline.feather")
-        logger.debug(f"create_analysis_datasets: ({cohort_name}) ベースラインデータ保存先: {baseline_output_path}")
-        patients_with_comorbidities.write_ipc(baseline_output_path, compression="zstd")
-        logger.info(f"{cohort_name} cohort ベースラインデータを保存: {baseline_output_path}")
-        
-        # 6. 時系列データセットの保存 (exam_time_series を patients_with_comorbidities に結合)
-        logger.debug(f"create_analysis_datasets: ({cohort_name}) 6. 時系列データセットの作成と保存を開始します")
-        if not exam_time_series.is_empty():
-            logger.debug(f"create_analysis_datasets: ({cohort_name}) 健診時系列データをベースラインデータに結合します")
-            # 結合キーは kojin_id と time_point だが、ここでは単純に kojin_id で left join し、
-            # exam_time_series の持つ time_point ごとの情報を横持ちにするか、縦持ちのまま別のファイルにするか検討が必要。
-            # 現在のコードでは exam_time_series はそのまま保存されていない。
-            # ここでは、exam_time_series を別途保存する形にする。
-            timeseries_output_path = os.path.join(output_dir, f"{cohort_name}_cohort_timeseries_exam.feather")
-            exam_time_series.write_ipc(timeseries_output_path, compression="zstd")
-            logger.info(f"{cohort_name} cohort 健診時系列データを保存: {timeseries_output_path}")
-            logger.debug(f"create_analysis_datasets: ({cohort_name}) 健診時系列データ保存完了: {timeseries_output_path}")
-        else:
-            logger.warning(f"create_analysis_datasets: ({cohort_name}) 健診時系列データが空のため、保存をスキップします")
+        save_cohort_datasets(cohort_name, datasets, output_dir, enrollment_population)
         
         # ループの最後に処理完了ログを追加
-        logger.info(f"{cohort_name} cohort 処理完了: {len(patients_with_comorbidities)} 患者")
+        logger.info(f"{cohort_name} cohort 処理完了: {len(datasets['baseline'])} 患者")
         logger.info(f"=== {cohort_name.upper()} COHORT の処理終了 ===")
         gc.collect() # メモリ解放
         logger.debug(f"create_analysis_datasets: ({cohort_name}) ガーベッジコレクション実行")
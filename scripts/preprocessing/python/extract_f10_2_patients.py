@@ -24,10 +24,17 @@ from typing import Dict, List, Set, Optional
 import psutil
 from tqdm import tqdm
 import time
+from datetime import datetime
 import tempfile
 import shutil
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from contextlib import contextmanager
 from utils.env_loader import DATA_ROOT_DIR as ENV_DATA_ROOT_DIR, OUTPUT_DIR as ENV_OUTPUT_DIR
+from utils.partition_index import load_diseases_code_index, select_files_for_codes
+from utils.canonical_schema import DEFAULT_CANONICAL_ROOT_DIR, date_expr, resolve_data_dir
+from utils.table_io import find_table, get_table_path, is_table_file, read_table, scan_table, write_table
+from utils.working_copy import DEFAULT_WORKING_COPY_DIR, resolve_table_dir
 
 # Create local logs directory before setting up logging
 os.makedirs("outputs/logs", exist_ok=True)
@@ -46,12 +53,44 @@ class Config:
     DATA_ROOT_DIR = ENV_DATA_ROOT_DIR
     OUTPUT_DIR = ENV_OUTPUT_DIR
     
+    # 疾患ファイル（月次の receipt_diseases）の読み込み元（従来どおり DATA_ROOT_DIR 直下）
+    DISEASE_SOURCE_DIR = os.path.join(ENV_DATA_ROOT_DIR, "receipt_diseases")
+    
+    # 正規化済みデータ・作業コピーの作成元（create_analysis_dataset.py と同じ raw/ 配下）。
+    # これらは DISEASE_SOURCE_DIR がこのディレクトリの receipt_diseases の場合のみ使用する
+    RAW_DATA_DIR = os.path.join(ENV_DATA_ROOT_DIR, "raw")
+    
     F10_2_CODE = "F10.2"
     
     STUDY_PERIOD_START = "2014-04-01"
     STUDY_PERIOD_END = "2023-09-30"
     
     PRIMARY_WASHOUT_WEEKS = 52
+    
+    # 疾患ファイルのスキャン方式
+    # "lazy": 全ファイルを1つの遅延クエリでスキャンし、そのまま患者単位に集計
+    # "incremental": ファイル毎に患者単位の最早レコードへ畳み込み、ピークメモリを患者数に比例させる
+    # "parallel": ファイルをプロセスプールで並列にスキャンし、部分集計をファイル順に統合
+    # "per_file": ファイル毎にcollectし、一時ファイル経由で結合（従来方式）
+    SCAN_MODE = "lazy"
+    
+    # diseases_codeインデックス（build_partition_index.py で作成）がある場合、
+    # F10.2のコードを含み得る月次ファイルのみを読み込む
+    USE_DISEASES_CODE_INDEX = True
+    
+    # 正規化済みデータ（convert_canonical_storage.py で作成）がある場合、
+    # 疾患ファイルはそちらから読み込む（sinryo_start_ymd、index_date はDate型になる。DISEASE_SOURCE_DIR が raw/ の場合のみ）
+    USE_CANONICAL_STORAGE = True
+    CANONICAL_ROOT_DIR = DEFAULT_CANONICAL_ROOT_DIR
+    
+    # 出力形式（"feather" または "parquet"）
+    # "parquet" の場合はkojin_id順に並べ、行グループ毎の統計付きで保存する
+    OUTPUT_FORMAT = "feather"
+    
+    # メモリマップ用作業コピー（build_working_copy.py で作成）がある場合、
+    # 疾患ファイル（DISEASE_SOURCE_DIR が raw/ の場合のみ）とICD10マスターは非圧縮の作業コピーをメモリマップで読み込む
+    USE_WORKING_COPY = True
+    WORKING_COPY_DIR = DEFAULT_WORKING_COPY_DIR
 
 @contextmanager
 def temporary_directory():
@@ -87,13 +126,13 @@ def load_icd10_master(base_dir: str) -> pl.DataFrame:
     """ICD10マスターデータの読み込み"""
     logger.info("ICD10マスターデータの読み込みを開始します")
     
-    file_path = os.path.join(base_dir, "m_icd10.feather")
-    if os.path.exists(file_path):
+    file_path = find_table(base_dir, "m_icd10")
+    if file_path is not None:
         file_size = os.path.getsize(file_path) / (1024 * 1024)  # MB単位
-        logger.info(f"m_icd10.feather (サイズ: {file_size:.2f} MB) を読み込んでいます")
-        return pl.read_ipc(file_path)
+        logger.info(f"{os.path.basename(file_path)} (サイズ: {file_size:.2f} MB) を読み込んでいます")
+        return read_table(file_path)
     else:
-        logger.error(f"ICD10マスターファイルが見つかりません: {file_path}")
+        logger.error(f"ICD10マスターファイルが見つかりません: {os.path.join(base_dir, 'm_icd10.feather')}")
         return pl.DataFrame()
 
 def get_diseases_codes_for_icd10(icd10_master: pl.DataFrame, 
@@ -131,20 +170,173 @@ def get_disease_files(disease_dir: str) -> List[str]:
     if os.path.exists(disease_dir) and os.path.isdir(disease_dir):
         disease_files = [os.path.join(disease_dir, f)
                        for f in os.listdir(disease_dir)
-                       if f.startswith("receipt_diseases") and f.endswith(".feather")]
+                       if is_table_file(f, "receipt_diseases")]
         logger.info(f"疾患ファイル {len(disease_files)} 件を検出しました")
     else:
         logger.warning(f"疾患ファイルディレクトリが見つかりません: {disease_dir}")
     
     return sorted(disease_files)
 
-def extract_f10_2_patients(disease_files: List[str], 
-                          f10_2_diseases_codes: List[str],
-                          params: Dict) -> pl.DataFrame:
-    """F10.2（アルコール依存症）患者の抽出 - メモリ効率最適化版"""
-    start_time = time.time()
-    logger.info("F10.2患者の抽出を開始します（最適化版）")
+# F10.2レコードとして保持するカラム
+F10_2_RECORD_COLUMNS = [
+    "kojin_id",
+    "receipt_id",
+    "receipt_ym",
+    "diseases_code",
+    "sinryo_start_ymd",  # 診療開始日
+    "shubyomei_flg",     # 主病名フラグ
+    "tenki_kbn_code",    # 転帰区分コード
+    "utagai_flg"         # 疑いフラグ
+]
+
+# インデックス日（初回診断）を決める並び順
+INDEX_DATE_SORT_KEYS = ["sinryo_start_ymd", "receipt_ym"]
+
+def scan_f10_2_records(source, f10_2_diseases_codes: List[str]) -> pl.LazyFrame:
+    """疾患ファイル（単一または複数）からF10.2レコードを抽出する遅延クエリを作成"""
+    return (scan_table(source)
+    .filter(pl.col("diseases_code").is_in(f10_2_diseases_codes))
+    .select(F10_2_RECORD_COLUMNS))
+
+def first_record(column: str) -> pl.Expr:
+    """インデックス日の並び順で最初のレコードの値"""
+    return pl.col(column).sort_by(INDEX_DATE_SORT_KEYS, maintain_order=True).first()
+
+def summarize_earliest_records(records: pl.LazyFrame) -> pl.LazyFrame:
+    """患者毎に最も早いF10.2レコードとレコード数を集計"""
+    return (records
+        .group_by("kojin_id")
+        .agg([first_record(column) for column in F10_2_RECORD_COLUMNS if column != "kojin_id"] +
+             [pl.len().alias("total_f10_2_records")]))
+
+def merge_earliest_records(summaries: List[pl.DataFrame]) -> pl.DataFrame:
+    """患者毎の最早レコード集計を統合（レコード数は合算）"""
+    return (pl.concat(summaries)
+        .group_by("kojin_id")
+        .agg([first_record(column) for column in F10_2_RECORD_COLUMNS if column != "kojin_id"] +
+             [pl.col("total_f10_2_records").sum()]))
+
+def to_index_dates(summary: pl.LazyFrame) -> pl.LazyFrame:
+    """最早レコード集計をインデックス日テーブルの形式に変換"""
+    return summary.select([
+        "kojin_id",
+        pl.col("sinryo_start_ymd").alias("index_date"),
+        pl.col("receipt_id").alias("first_receipt_id"),
+        pl.col("receipt_ym").alias("first_receipt_ym"),
+        pl.col("diseases_code").alias("first_diseases_code"),
+        pl.col("shubyomei_flg").alias("first_shubyomei_flg"),
+        pl.col("tenki_kbn_code").alias("first_tenki_kbn_code"),
+        pl.col("utagai_flg").alias("first_utagai_flg"),
+        "total_f10_2_records"  # F10.2関連の総レコード数
+    ])
+
+def aggregate_index_dates(records: pl.LazyFrame) -> pl.LazyFrame:
+    """各患者の初回診断日（インデックス日）と初回レコードの情報を集計"""
+    return to_index_dates(summarize_earliest_records(records))
+
+def extract_index_dates_lazy(disease_files: List[str],
+                             f10_2_diseases_codes: List[str]) -> pl.DataFrame:
+    """全疾患ファイルを1つの遅延クエリでスキャンし、インデックス日まで一括で集計"""
+    logger.info(f"疾患ファイル {len(disease_files)} 件を単一の遅延クエリでスキャンします")
     
+    # diseases_codeのフィルタとカラム選択はスキャンにプッシュダウンされ、
+    # 抽出結果は中間ファイルを介さずに患者単位の集計へストリーミングされる
+    index_dates = (aggregate_index_dates(scan_f10_2_records(disease_files, f10_2_diseases_codes))
+                   .collect(engine="streaming"))
+    
+    if not index_dates.is_empty():
+        logger.info(f"抽出された延べレコード数: {index_dates['total_f10_2_records'].sum()}")
+    
+    return index_dates
+
+def extract_index_dates_incremental(disease_files: List[str],
+                                    f10_2_diseases_codes: List[str]) -> pl.DataFrame:
+    """疾患ファイルを1件ずつ「患者毎の最早レコード」テーブルに畳み込む"""
+    logger.info(f"疾患ファイル {len(disease_files)} 件を患者毎の最早レコードに逐次集約します")
+    
+    # 保持するのは患者数分の行のみで、診断レコード全体は保持しない
+    running: Optional[pl.DataFrame] = None
+    total_records = 0
+    for file_path in tqdm(disease_files, desc="疾患ファイル処理", unit="file"):
+        partial = (summarize_earliest_records(scan_f10_2_records(file_path, f10_2_diseases_codes))
+                   .collect(engine="streaming"))
+        if partial.is_empty():
+            continue
+        
+        total_records += partial["total_f10_2_records"].sum()
+        running = partial if running is None else merge_earliest_records([running, partial])
+        logger.debug(f"{os.path.basename(file_path)}: 累積患者数 {len(running)}")
+    
+    if running is None:
+        return pl.DataFrame()
+    
+    logger.info(f"抽出された延べレコード数: {total_records}")
+    return to_index_dates(running.lazy()).collect()
+
+@contextmanager
+def worker_polars_threads(polars_threads: int):
+    """
+    起動するワーカープロセスのPolarsのスレッド数を制限（ワーカー数に合わせる）
+
+    ワーカーはこのモジュールを読み込む時点でpolarsをimportするため、ワーカー内で環境変数を設定しても効かない。
+    spawnの子プロセスは起動時の環境変数を引き継ぐので、プールの作成前に親プロセスで設定し、終了後に戻す。
+    """
+    previous = os.environ.get("POLARS_MAX_THREADS")
+    os.environ["POLARS_MAX_THREADS"] = str(polars_threads)
+    try:
+        yield
+    finally:
+        if previous is None:
+            os.environ.pop("POLARS_MAX_THREADS", None)
+        else:
+            os.environ["POLARS_MAX_THREADS"] = previous
+
+def summarize_partition(file_path: str, f10_2_diseases_codes: List[str]) -> pl.DataFrame:
+    """ワーカープロセスで1ファイルをスキャンし、患者毎の最早レコードのみを返す"""
+    return (summarize_earliest_records(scan_f10_2_records(file_path, f10_2_diseases_codes))
+            .collect())
+
+def extract_index_dates_parallel(disease_files: List[str],
+                                 f10_2_diseases_codes: List[str],
+                                 params: Dict) -> pl.DataFrame:
+    """疾患ファイルをプロセスプールで並列にスキャンし、部分集計をファイル順に統合"""
+    n_workers = max(1, min(params['n_threads'], len(disease_files)))
+    polars_threads = max(1, params['n_threads'] // n_workers)
+    batch_size = max(n_workers, params['batch_size'])
+    logger.info(f"疾患ファイル {len(disease_files)} 件を {n_workers} プロセスで並列スキャンします"
+                f"（バッチサイズ: {batch_size}, プロセス毎のスレッド数: {polars_threads}）")
+    
+    running: Optional[pl.DataFrame] = None
+    total_records = 0
+    # Polarsはfork後のスレッドプールと相性が悪いため、spawnでワーカーを起動する
+    with worker_polars_threads(polars_threads), \
+         ProcessPoolExecutor(max_workers=n_workers,
+                             mp_context=multiprocessing.get_context("spawn")) as executor:
+        with tqdm(total=len(disease_files), desc="疾患ファイル処理", unit="file") as progress:
+            for batch_start in range(0, len(disease_files), batch_size):
+                batch_files = disease_files[batch_start:batch_start + batch_size]
+                # mapは投入順に結果を返すため、統合順序は実行タイミングに依存しない
+                partials = [partial for partial in executor.map(summarize_partition,
+                                                                batch_files,
+                                                                [f10_2_diseases_codes] * len(batch_files))
+                            if not partial.is_empty()]
+                progress.update(len(batch_files))
+                if not partials:
+                    continue
+                
+                total_records += sum(partial["total_f10_2_records"].sum() for partial in partials)
+                running = merge_earliest_records(partials if running is None else [running] + partials)
+                logger.debug(f"バッチ {batch_start // batch_size + 1}: 累積患者数 {len(running)}")
+    
+    if running is None:
+        return pl.DataFrame()
+    
+    logger.info(f"抽出された延べレコード数: {total_records}")
+    return to_index_dates(running.sort("kojin_id").lazy()).collect()
+
+def extract_index_dates_per_file(disease_files: List[str],
+                                 f10_2_diseases_codes: List[str]) -> pl.DataFrame:
+    """ファイル毎に抽出して一時ファイルに保存し、結合後にインデックス日を集計（従来方式）"""
     with temporary_directory() as temp_dir:
         temp_files = []
         
@@ -153,23 +345,7 @@ def extract_f10_2_patients(disease_files: List[str],
             file_size = os.path.getsize(file_path) / (1024 * 1024)  # MB単位
             logger.info(f"処理中: {os.path.basename(file_path)} (サイズ: {file_size:.2f} MB)")
             
-            df_lazy = (pl.scan_ipc(
-                source=file_path,
-                memory_map=False
-            )
-            .filter(pl.col("diseases_code").is_in(f10_2_diseases_codes))
-            .select([
-                "kojin_id",
-                "receipt_id",
-                "receipt_ym",
-                "diseases_code",
-                "sinryo_start_ymd",  # 診療開始日
-                "shubyomei_flg",     # 主病名フラグ
-                "tenki_kbn_code",    # 転帰区分コード
-                "utagai_flg"         # 疑いフラグ
-            ]))
-            
-            result = df_lazy.collect(streaming=True, n_threads=params['n_threads'])
+            result = scan_f10_2_records(file_path, f10_2_diseases_codes).collect(engine="streaming")
             
             if not result.is_empty():
                 # Log unique disease codes found for F10.2 for verification
@@ -186,7 +362,6 @@ def extract_f10_2_patients(disease_files: List[str],
                 gc.collect()
         
         if not temp_files:
-            logger.warning("F10.2患者が見つかりませんでした")
             return pl.DataFrame()
         
         # 一時ファイルから結果を読み込んで結合
@@ -204,25 +379,38 @@ def extract_f10_2_patients(disease_files: List[str],
         del all_results
         gc.collect()
     
-    # 各患者の初回診断日（インデックス日）を特定
-    index_dates = (patients_df
-        .sort(["kojin_id", "sinryo_start_ymd", "receipt_ym"])
-        .group_by("kojin_id")
-        .agg([
-            pl.col("sinryo_start_ymd").first().alias("index_date"),
-            pl.col("receipt_id").first().alias("first_receipt_id"),
-            pl.col("receipt_ym").first().alias("first_receipt_ym"),
-            pl.col("diseases_code").first().alias("first_diseases_code"),
-            pl.col("shubyomei_flg").first().alias("first_shubyomei_flg"),
-            pl.col("tenki_kbn_code").first().alias("first_tenki_kbn_code"),
-            pl.col("utagai_flg").first().alias("first_utagai_flg"),
-            pl.count().alias("total_f10_2_records")  # F10.2関連の総レコード数
-        ]))
+    return aggregate_index_dates(patients_df.lazy()).collect()
+
+def extract_f10_2_patients(disease_files: List[str], 
+                          f10_2_diseases_codes: List[str],
+                          params: Dict,
+                          scan_mode: Optional[str] = None) -> pl.DataFrame:
+    """F10.2（アルコール依存症）患者の抽出 - メモリ効率最適化版"""
+    start_time = time.time()
+    scan_mode = scan_mode or Config.SCAN_MODE
+    logger.info(f"F10.2患者の抽出を開始します（スキャン方式: {scan_mode}）")
+    
+    if scan_mode == "lazy":
+        index_dates = extract_index_dates_lazy(disease_files, f10_2_diseases_codes)
+    elif scan_mode == "incremental":
+        index_dates = extract_index_dates_incremental(disease_files, f10_2_diseases_codes)
+    elif scan_mode == "parallel":
+        index_dates = extract_index_dates_parallel(disease_files, f10_2_diseases_codes, params)
+    elif scan_mode == "per_file":
+        index_dates = extract_index_dates_per_file(disease_files, f10_2_diseases_codes)
+    else:
+        raise ValueError(f"不明なスキャン方式です: {scan_mode}")
+    
+    if index_dates.is_empty():
+        logger.warning("F10.2患者が見つかりませんでした")
+        return pl.DataFrame()
     
     # 日付フィルタリング（研究期間内）
+    # index_date は文字列（YYYY/MM/DD）またはDate型のため、Date型として比較する
+    index_date = date_expr("index_date", index_dates.schema["index_date"])
     index_dates = index_dates.filter(
-        (pl.col("index_date") >= Config.STUDY_PERIOD_START) &
-        (pl.col("index_date") <= Config.STUDY_PERIOD_END)
+        (index_date >= datetime.strptime(Config.STUDY_PERIOD_START, "%Y-%m-%d").date()) &
+        (index_date <= datetime.strptime(Config.STUDY_PERIOD_END, "%Y-%m-%d").date())
     )
     
     logger.info(f"研究期間内（{Config.STUDY_PERIOD_START}〜{Config.STUDY_PERIOD_END}）の患者数: {len(index_dates)}")
@@ -238,7 +426,7 @@ def apply_washout_criteria(patients_df: pl.DataFrame, washout_weeks: int = 52) -
     
     # index_dateから指定週数前の日付を計算
     filtered_df = patients_df.with_columns([
-        pl.col("index_date").str.to_date(format="%Y/%m/%d").alias("index_date_parsed")
+        date_expr("index_date", patients_df.schema["index_date"]).alias("index_date_parsed")
     ]).filter(
         pl.col("index_date_parsed") >= pl.date(2014, 4, 1).dt.offset_by(f"{washout_weeks}w")
     ).drop("index_date_parsed")
@@ -253,28 +441,28 @@ def save_results(patients_df: pl.DataFrame, output_dir: str):
     
     # Primary cohort (52週ウォッシュアウト)
     primary_cohort = apply_washout_criteria(patients_df, 52)
-    primary_output_path = os.path.join(output_dir, "f10_2_patients_primary_cohort.feather")
-    primary_cohort.write_ipc(primary_output_path, compression="zstd")
+    primary_output_path = get_table_path(output_dir, "f10_2_patients_primary_cohort", Config.OUTPUT_FORMAT)
+    write_table(primary_cohort, primary_output_path, sort_keys=["kojin_id"])
     logger.info(f"Primary cohort (52週ウォッシュアウト) を保存しました: {primary_output_path}")
     logger.info(f"Primary cohort 患者数: {len(primary_cohort)}")
     
     # Sensitivity cohort 1 (26週ウォッシュアウト)
     sensitivity_cohort1 = apply_washout_criteria(patients_df, 26)
-    sens1_output_path = os.path.join(output_dir, "f10_2_patients_sensitivity_cohort1.feather")
-    sensitivity_cohort1.write_ipc(sens1_output_path, compression="zstd")
+    sens1_output_path = get_table_path(output_dir, "f10_2_patients_sensitivity_cohort1", Config.OUTPUT_FORMAT)
+    write_table(sensitivity_cohort1, sens1_output_path, sort_keys=["kojin_id"])
     logger.info(f"Sensitivity cohort 1 (26週ウォッシュアウト) を保存しました: {sens1_output_path}")
     logger.info(f"Sensitivity cohort 1 患者数: {len(sensitivity_cohort1)}")
     
     # Sensitivity cohort 2 (156週ウォッシュアウト)
     sensitivity_cohort2 = apply_washout_criteria(patients_df, 156)
-    sens2_output_path = os.path.join(output_dir, "f10_2_patients_sensitivity_cohort2.feather")
-    sensitivity_cohort2.write_ipc(sens2_output_path, compression="zstd")
+    sens2_output_path = get_table_path(output_dir, "f10_2_patients_sensitivity_cohort2", Config.OUTPUT_FORMAT)
+    write_table(sensitivity_cohort2, sens2_output_path, sort_keys=["kojin_id"])
     logger.info(f"Sensitivity cohort 2 (156週ウォッシュアウト) を保存しました: {sens2_output_path}")
     logger.info(f"Sensitivity cohort 2 患者数: {len(sensitivity_cohort2)}")
     
     # 全患者（ウォッシュアウト適用前）
-    all_output_path = os.path.join(output_dir, "f10_2_patients_all.feather")
-    patients_df.write_ipc(all_output_path, compression="zstd")
+    all_output_path = get_table_path(output_dir, "f10_2_patients_all", Config.OUTPUT_FORMAT)
+    write_table(patients_df, all_output_path, sort_keys=["kojin_id"])
     logger.info(f"全患者データを保存しました: {all_output_path}")
     logger.info(f"全患者数: {len(patients_df)}")
     
@@ -285,6 +473,20 @@ def save_results(patients_df: pl.DataFrame, output_dir: str):
     logger.info(f"Sensitivity cohort 1（26週ウォッシュアウト）: {len(sensitivity_cohort1)}")
     logger.info(f"Sensitivity cohort 2（156週ウォッシュアウト）: {len(sensitivity_cohort2)}")
 
+def resolve_disease_dir() -> str:
+    """疾患ファイルを読み込むディレクトリ（読み込み元と実際に読み込むディレクトリをログに出力）"""
+    disease_dir = Config.DISEASE_SOURCE_DIR
+    raw_disease_dir = os.path.join(Config.RAW_DATA_DIR, "receipt_diseases")
+    if os.path.abspath(disease_dir) == os.path.abspath(raw_disease_dir):
+        if Config.USE_CANONICAL_STORAGE:
+            disease_dir = os.path.join(resolve_data_dir(Config.RAW_DATA_DIR, Config.CANONICAL_ROOT_DIR), "receipt_diseases")
+        if Config.USE_WORKING_COPY:
+            disease_dir = resolve_table_dir("receipt_diseases", disease_dir, Config.WORKING_COPY_DIR)
+    elif Config.USE_CANONICAL_STORAGE or Config.USE_WORKING_COPY:
+        logger.info(f"正規化済みデータ・作業コピーは {raw_disease_dir} から作成されるため、疾患ファイルには使用しません")
+    logger.info(f"疾患ファイルの読み込み元: {Config.DISEASE_SOURCE_DIR}（読み込むディレクトリ: {disease_dir}）")
+    return disease_dir
+
 def main():
     """メイン処理"""
     logger.info("DeSC-Nalmefene F10.2患者抽出を開始します")
@@ -293,7 +495,10 @@ def main():
     logger.info(f"最適化パラメータ: {params}")
     
     # ICD10マスターデータの読み込み
-    icd10_master = load_icd10_master(Config.DATA_ROOT_DIR)
+    icd10_dir = Config.DATA_ROOT_DIR
+    if Config.USE_WORKING_COPY:
+        icd10_dir = resolve_table_dir("m_icd10", icd10_dir, Config.WORKING_COPY_DIR)
+    icd10_master = load_icd10_master(icd10_dir)
     if icd10_master.is_empty():
         logger.error("ICD10マスターデータが読み込めないため処理を終了します")
         return
@@ -305,12 +510,17 @@ def main():
         return
     
     # 疾患ファイルの取得
-    disease_dir = os.path.join(Config.DATA_ROOT_DIR, "receipt_diseases")
+    disease_dir = resolve_disease_dir()
     disease_files = get_disease_files(disease_dir)
     if not disease_files:
         logger.error("疾患ファイルが見つからないため処理を終了します")
         return
     
+    if Config.USE_DISEASES_CODE_INDEX:
+        disease_files = select_files_for_codes(disease_files,
+                                               f10_2_diseases_codes,
+                                               load_diseases_code_index(disease_dir))
+    
     # F10.2患者の抽出
     patients_df = extract_f10_2_patients(disease_files, f10_2_diseases_codes, params)
     if patients_df.is_empty():
@@ -22,6 +22,7 @@ if project_root not in sys.path:
     sys.path.insert(0, project_root)
 
 from utils.env_loader import OUTPUT_DIR
+from utils.table_io import find_table
 
 # Create local logs directory before setting up logging
 os.makedirs("outputs/logs", exist_ok=True)
@@ -81,20 +82,21 @@ def check_output_files() -> dict:
     """出力ファイルの存在確認"""
     logger.info("出力ファイルの確認を開始します")
     
-    # 期待される出力ファイル
+    # 期待される出力ファイル（拡張子なし。Feather・Parquetのどちらでもよい）
     expected_files = {
         "f10_2_extraction": [
-            "f10_2_patients_primary_cohort.feather",
-            "f10_2_patients_sensitivity_cohort1.feather", 
-            "f10_2_patients_sensitivity_cohort2.feather",
-            "f10_2_patients_all.feather"
+            "f10_2_patients_primary_cohort",
+            "f10_2_patients_sensitivity_cohort1", 
+            "f10_2_patients_sensitivity_cohort2",
+            "f10_2_patients_all"
         ],
         "analysis_datasets": [
-            "primary_cohort_baseline.feather",
-            "primary_cohort_longitudinal.feather",
-            "sensitivity1_cohort_baseline.feather",
-            "sensitivity2_cohort_baseline.feather",
-            "all_cohort_baseline.feather"
+            "primary_cohort_baseline",
+            "primary_cohort_longitudinal",
+            "primary_cohort_exam_panel",
+            "sensitivity1_cohort_baseline",
+            "sensitivity2_cohort_baseline",
+            "all_cohort_baseline"
         ]
     }
     
@@ -105,13 +107,13 @@ def check_output_files() -> dict:
         logger.info(f"\n--- {category} ---")
         
         for filename in files:
-            file_path = os.path.join(OUTPUT_DIR, filename)
-            exists = os.path.exists(file_path)
+            file_path = find_table(OUTPUT_DIR, filename)
+            exists = file_path is not None
             file_status[category][filename] = exists
             
             if exists:
                 file_size = os.path.getsize(file_path) / (1024 * 1024)  # MB
-                logger.info(f"✓ {filename} (サイズ: {file_size:.2f} MB)")
+                logger.info(f"✓ {os.path.basename(file_path)} (サイズ: {file_size:.2f} MB)")
             else:
                 logger.warning(f"✗ {filename} が見つかりません")
     
@@ -170,6 +172,11 @@ def main():
     
     # 実行するスクリプトの定義
     scripts = [
+        {
+            "path": "scripts/preprocessing/python/build_partition_index.py",
+            "name": "パーティションインデックス作成",
+            "description": "疾患ファイル毎のdiseases_codeインデックスを差分更新"
+        },
         {
             "path": "scripts/preprocessing/python/extract_f10_2_patients.py",
             "name": "F10.2患者抽出",
@@ -0,0 +1,16 @@
+"""
+テスト共通の設定
+プロジェクトルートを sys.path に追加し、utils.env_loader が作業ツリーに出力ディレクトリを作らないよう
+データ・出力先の既定を一時ディレクトリにします
+"""
+
+import os
+import sys
+import tempfile
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+os.environ.setdefault("DATA_ROOT_DIR", tempfile.mkdtemp(prefix="desc_test_data_"))
+os.environ.setdefault("OUTPUT_DIR", os.path.join(os.environ["DATA_ROOT_DIR"], "output"))
@@ -0,0 +1,56 @@
+"""utils.canonical_schema のテスト（正規化済みデータの参照と raw/ との照合）"""
+
+import os
+
+import polars as pl
+import pytest
+
+from utils.canonical_schema import resolve_data_dir, save_canonical_manifest
+from utils.partition_index import get_file_signature
+
+
+@pytest.fixture
+def data_dirs(tmp_path):
+    """raw/ に月次ファイル2件と単一ファイル1件を置き、変換済みとしてマニフェストを保存"""
+    raw_dir, canonical_root = os.path.join(tmp_path, "raw"), os.path.join(tmp_path, "canonical")
+    os.makedirs(os.path.join(raw_dir, "receipt_diseases"))
+    os.makedirs(canonical_root)
+    relative_paths = [os.path.join("receipt_diseases", "receipt_diseases_202001.feather"),
+                      os.path.join("receipt_diseases", "receipt_diseases_202002.feather"),
+                      "tekiyo.feather"]
+    files = {}
+    for relative_path in relative_paths:
+        path = os.path.join(raw_dir, relative_path)
+        pl.DataFrame({"kojin_id": [1, 2]}).write_ipc(path)
+        size, mtime = get_file_signature(path)
+        files[relative_path] = {"table": "t", "output": relative_path, "source_size": size, "source_mtime": mtime}
+    save_canonical_manifest(canonical_root, {"storage_format": "feather", "files": files})
+    return raw_dir, canonical_root
+
+
+def test_uses_canonical_when_raw_is_unchanged(data_dirs):
+    raw_dir, canonical_root = data_dirs
+    assert resolve_data_dir(raw_dir, canonical_root) == canonical_root
+
+
+def test_without_manifest_uses_raw(tmp_path):
+    assert resolve_data_dir(str(tmp_path), os.path.join(tmp_path, "canonical")) == str(tmp_path)
+
+
+def test_new_month_in_raw_falls_back_to_raw(data_dirs, caplog):
+    raw_dir, canonical_root = data_dirs
+    pl.DataFrame({"kojin_id": [3]}).write_ipc(os.path.join(raw_dir, "receipt_diseases", "receipt_diseases_202003.feather"))
+    assert resolve_data_dir(raw_dir, canonical_root) == raw_dir
+    assert "receipt_diseases_202003.feather" in caplog.text
+
+
+def test_changed_raw_file_falls_back_to_raw(data_dirs):
+    raw_dir, canonical_root = data_dirs
+    pl.DataFrame({"kojin_id": [1, 2, 3]}).write_ipc(os.path.join(raw_dir, "tekiyo.feather"))
+    assert resolve_data_dir(raw_dir, canonical_root) == raw_dir
+
+
+def test_deleted_raw_file_falls_back_to_raw(data_dirs):
+    raw_dir, canonical_root = data_dirs
+    os.remove(os.path.join(raw_dir, "receipt_diseases", "receipt_diseases_202001.feather"))
+    assert resolve_data_dir(raw_dir, canonical_root) == raw_dir
@@ -0,0 +1,83 @@
+"""utils.care_continuity のテスト（継続期間、月次ビット列、打ち切り）"""
+
+import os
+from datetime import date
+
+import polars as pl
+
+from utils.care_continuity import (CARE_SPELL_SCHEMA, bitmap_months, build_care_continuity, continuity_spells,
+                                   month_bitmaps, month_number)
+
+FIRST_MONTH = date(2015, 1, 1)
+LAST_MONTH = date(2021, 12, 31)
+
+
+def months(*values):
+    """(kojin_id, date) の組から collect_f10_2_months と同じ形の表"""
+    return pl.DataFrame({"kojin_id": [kojin_id for kojin_id, _ in values],
+                         "month": [month_number(value) for _, value in values],
+                         "iryokikan_no": [None] * len(values)},
+                        schema={"kojin_id": pl.Int64, "month": pl.Int32, "iryokikan_no": pl.Int64})
+
+
+def test_spells_split_on_gaps_longer_than_allowed():
+    f10_2_months = months((1, date(2019, 12, 1)),  # インデックス月より前は含めない
+                          (1, date(2020, 1, 1)), (1, date(2020, 3, 1)),  # 空白1か月 → 継続
+                          (1, date(2020, 6, 1)))                         # 空白2か月 → 新しい継続期間
+    index_dates = pl.DataFrame({"kojin_id": [1], "index_date": [date(2020, 1, 15)]})
+    spells = continuity_spells(f10_2_months, index_dates, max_gap_months=1)
+
+    assert spells.select(["month", "spell_number"]).rows() == [
+        (month_number(date(2020, 1, 1)), 1),
+        (month_number(date(2020, 3, 1)), 1),
+        (month_number(date(2020, 6, 1)), 2),
+    ]
+    assert spells["prev_month"].to_list() == [None, month_number(date(2020, 1, 1)), None]
+
+
+def test_bitmap_round_trip_across_words():
+    # 観察期間は84か月のため2語。64か月目以降は2語目のビット
+    f10_2_months = months((1, FIRST_MONTH), (1, date(2020, 4, 1)), (1, date(2020, 5, 1)), (1, LAST_MONTH),
+                          (2, date(2016, 7, 1)))
+    bitmaps = month_bitmaps(f10_2_months, FIRST_MONTH, LAST_MONTH)
+
+    assert sorted(col for col in bitmaps.columns if col != "kojin_id") == ["f10_2_months_0", "f10_2_months_1"]
+    assert bitmap_months(bitmaps, FIRST_MONTH, LAST_MONTH).rows() == [
+        (1, date(2015, 1, 1)), (1, date(2020, 4, 1)), (1, date(2020, 5, 1)), (1, date(2021, 12, 1)),
+        (2, date(2016, 7, 1)),
+    ]
+
+
+def write_feather(df: pl.DataFrame, path: str) -> str:
+    df.write_ipc(path)
+    return path
+
+
+def test_spells_are_censored_at_each_patients_follow_up_end(tmp_path):
+    disease_file = write_feather(pl.DataFrame({
+        "kojin_id": [1, 1, 2, 2],
+        "receipt_id": [10, 11, 20, 21],
+        "diseases_code": ["8840001"] * 4,
+        "receipt_ym": ["2020/01", "2020/02", "2020/01", "2020/02"],
+    }), os.path.join(tmp_path, "receipt_diseases_1.feather"))
+    institution_file = write_feather(pl.DataFrame({
+        "kojin_id": [1, 1, 2, 2],
+        "receipt_id": [10, 11, 20, 21],
+        "iryokikan_no": [100, 200, 100, 100],
+    }), os.path.join(tmp_path, "receipt_medical_institution_1.feather"))
+    patients = pl.DataFrame({"kojin_id": [1, 2], "index_date": [date(2020, 1, 10), date(2020, 1, 10)]})
+    # 患者1は観察可能期間が2020/03で終わるため、最終算定月＋2か月が追跡終了月以降となり打ち切り
+    follow_up_ends = pl.DataFrame({"kojin_id": [1], "follow_up_end": [date(2020, 3, 31)]})
+
+    summary, spells, transfers = build_care_continuity([disease_file], [institution_file], ["8840001"], patients,
+                                                       2, FIRST_MONTH, LAST_MONTH, follow_up_ends=follow_up_ends)
+
+    assert spells.schema == pl.Schema(CARE_SPELL_SCHEMA)
+    assert spells.select(["kojin_id", "n_months", "n_institutions", "n_transfers", "censored"]).rows() == [
+        (1, 2, 2, 1, True),
+        (2, 2, 1, 0, False),
+    ]
+    assert transfers.select(["kojin_id", "transfer_month", "from_iryokikan_no", "to_iryokikan_no"]).rows() == [
+        (1, date(2020, 2, 1), 100, 200),
+    ]
+    assert summary.sort("kojin_id")["dropout_date"].to_list() == [None, date(2020, 2, 29)]
@@ -0,0 +1,75 @@
+"""utils.comorbidity_indices のテスト（Quan ICD-10 コードのカテゴリ割当、階層、Charlson / van Walraven の指数）"""
+
+import polars as pl
+import pytest
+
+from utils.comorbidity_engine import build_category_lookup
+from utils.comorbidity_indices import (CHARLSON_WEIGHTS, ELIXHAUSER_WEIGHTS, category_name, expand_icd10_codes,
+                                       index_category_codes, with_index_scores)
+
+INDEX_NAMES = ["charlson", "elixhauser"]
+
+
+def test_expand_icd10_code_ranges():
+    assert expand_icd10_codes(["I425-I429", "I43"]) == ["I425", "I426", "I427", "I428", "I429", "I43"]
+    assert len(expand_icd10_codes(["C00-C26"])) == 27
+    with pytest.raises(ValueError):
+        expand_icd10_codes(["I42-I429"])
+
+
+@pytest.mark.parametrize("icd10_code, categories", [
+    ("I219", {"cci_myocardial_infarction"}),
+    ("F009", {"cci_dementia"}),
+    ("J449", {"cci_chronic_pulmonary_disease", "elix_chronic_pulmonary_disease"}),
+    ("E119", {"cci_diabetes_without_complication", "elix_diabetes_uncomplicated"}),
+    ("E112", {"cci_diabetes_with_complication", "elix_diabetes_complicated"}),
+    # Quan の定義では E106 は Charlson では合併症なし、Elixhauser では合併症ありに入る
+    ("E106", {"cci_diabetes_without_complication", "elix_diabetes_complicated"}),
+    ("I426", {"cci_congestive_heart_failure", "elix_congestive_heart_failure", "elix_alcohol_abuse"}),
+    ("K703", {"cci_mild_liver_disease", "elix_liver_disease", "elix_alcohol_abuse"}),
+    ("K704", {"cci_moderate_severe_liver_disease", "elix_liver_disease"}),
+    ("C787", {"cci_metastatic_solid_tumor", "elix_metastatic_cancer"}),
+    ("F102", {"elix_alcohol_abuse"}),
+    ("Z000", set()),
+])
+def test_quan_icd10_categories(icd10_code, categories):
+    master = pl.DataFrame({"diseases_code": ["1"], "icd10_code": [icd10_code], "icd10_kbn_code": ["1"]})
+    lookup = build_category_lookup(master, index_category_codes(INDEX_NAMES))
+    assert set(lookup["category"].to_list()) == categories
+
+
+def test_unknown_index_is_rejected():
+    with pytest.raises(ValueError):
+        index_category_codes(["unknown"])
+
+
+def make_flags(patients):
+    """患者毎に立てるカテゴリ（指数名, カテゴリ）の集合から has_<カテゴリ名> のフラグ表を作成"""
+    data = {"kojin_id": list(range(1, len(patients) + 1))}
+    for index_name, weights in (("charlson", CHARLSON_WEIGHTS), ("elixhauser", ELIXHAUSER_WEIGHTS)):
+        for category in weights:
+            data[f"has_{category_name(index_name, category)}"] = [(index_name, category) in flags
+                                                                  for flags in patients]
+    return pl.DataFrame(data)
+
+
+def test_index_scores_apply_weights_and_hierarchy():
+    flags = make_flags([
+        # 糖尿病の合併症あり・なしの両方がある場合は合併症ありのみ数える
+        {("charlson", "diabetes_without_complication"), ("charlson", "diabetes_with_complication"),
+         ("elixhauser", "diabetes_uncomplicated"), ("elixhauser", "diabetes_complicated")},
+        {("charlson", "diabetes_without_complication"), ("elixhauser", "diabetes_uncomplicated")},
+        # 悪性腫瘍と転移性腫瘍、軽度と中等度以上の肝疾患
+        {("charlson", "congestive_heart_failure"), ("charlson", "malignancy"), ("charlson", "metastatic_solid_tumor"),
+         ("charlson", "mild_liver_disease"), ("charlson", "moderate_severe_liver_disease"),
+         ("elixhauser", "congestive_heart_failure"), ("elixhauser", "solid_tumor_without_metastasis"),
+         ("elixhauser", "metastatic_cancer"), ("elixhauser", "depression"), ("elixhauser", "obesity")},
+        set(),
+    ])
+
+    scores = with_index_scores(flags, INDEX_NAMES)
+
+    assert scores["charlson_index"].to_list() == [2, 1, 1 + 6 + 3, 0]
+    # van Walraven: 糖尿病は0点、うっ血性心不全7 + 転移性腫瘍12 + うつ病-3 + 肥満-4
+    assert scores["elixhauser_index"].to_list() == [0, 0, 7 + 12 - 3 - 4, 0]
+    assert scores.schema["charlson_index"] == pl.Int32
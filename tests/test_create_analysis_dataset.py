@@ -0,0 +1,57 @@
+"""create_analysis_dataset.py の健診データ時系列（時点毎の as-of 結合）のテスト"""
+
+import os
+from datetime import date, timedelta
+
+import polars as pl
+import pytest
+
+
+@pytest.fixture
+def analysis_module(tmp_path, monkeypatch):
+    """スクリプトを読み込む（読み込み時にカレントディレクトリへ outputs/logs を作るため tmp_path へ移動）"""
+    monkeypatch.chdir(tmp_path)
+    script_dir = os.path.join(os.path.dirname(__file__), "..", "scripts", "preprocessing", "python")
+    monkeypatch.syspath_prepend(os.path.abspath(script_dir))
+    import create_analysis_dataset
+    return create_analysis_dataset
+
+
+def test_exam_time_points_pick_nearest_exam_in_window(analysis_module, tmp_path):
+    patients = pl.DataFrame({"kojin_id": [1, 2, 3, 5], "index_date": ["2020/06/15"] * 4})
+    exams = pl.DataFrame({
+        "kojin_id": [1, 1, 1, 1, 1, 1, 1, 1,
+                     2, 2,
+                     4,
+                     5, 5, 5],
+        "exam_ymd": ["2018/01/01", "2019/06/01", "2020/03/01", "2020/06/15", "2020/10/01", "2021/03/01",
+                     "2021/06/01", "2023/01/10",
+                     # 患者2: どの時点の期間にも入らない
+                     "2017/01/01", "2021/01/01",
+                     # 患者4: コホート外
+                     "2020/06/01",
+                     # 患者5: 期間の端（インデックス日の2年前、6か月後）と、2年前より1日前
+                     "2018/06/14", "2018/06/15", "2020/12/15"],
+        "bmi": [20.0, 21.0, 22.0, 23.0, 24.0, 25.0, 26.0, 27.0, 30.0, 31.0, 40.0, 50.0, 51.0, 52.0],
+    })
+    exams.write_ipc(os.path.join(tmp_path, "exam_interview_processed.feather"))
+
+    result = analysis_module.get_exam_data_time_series(str(tmp_path), patients, {})
+
+    picked = {(row["kojin_id"], row["time_point"]): (row["exam_ymd"], row["days_diff"])
+              for row in result.iter_rows(named=True)}
+    assert picked == {
+        # インデックス日前は当日を含まず直近、インデックス日後は当日を含む
+        (1, "before_index"): (date(2020, 3, 1), timedelta(days=106)),
+        (1, "after_index"): (date(2020, 6, 15), timedelta(days=0)),
+        # year1 は9か月後（2021/03/15）以降で最も近い健診、year2 は期間内に健診なし
+        (1, "year1"): (date(2021, 6, 1), timedelta(days=351)),
+        (5, "before_index"): (date(2018, 6, 15), timedelta(days=731)),
+        (5, "after_index"): (date(2020, 12, 15), timedelta(days=183)),
+    }
+    assert result.columns == ["kojin_id", "time_point", "exam_ymd", "bmi", "index_date", "days_diff"]
+
+
+def test_exam_time_points_without_exam_file(analysis_module, tmp_path):
+    patients = pl.DataFrame({"kojin_id": [1], "index_date": ["2020/06/15"]})
+    assert analysis_module.get_exam_data_time_series(str(tmp_path), patients, {}).is_empty()
@@ -0,0 +1,49 @@
+"""utils.enrollment_population のテスト（年度毎の加入者数と人年、処方患者数の割合）"""
+
+import os
+from datetime import date
+
+import polars as pl
+import pytest
+
+from utils.enrollment_population import ENROLLMENT_POPULATION_SCHEMA, build_enrollment_population, prescribing_rates
+
+
+@pytest.fixture
+def tekiyo_file(tmp_path):
+    path = os.path.join(tmp_path, "tekiyo.feather")
+    pl.DataFrame({
+        "kojin_id": [1, 2, 3, 3, 4],
+        "chiiki_code": ["01", "01", "02", "02", "02"],
+        # 1: 2019/10〜2020/06（2年度にまたがる）、2: 終了年月が空 → 観察期間の最終月まで
+        # 3: 同じ期間の行が2件、4: 観察期間の開始より前に終了
+        "observable_start_ym": ["2019/10", "2020/01", "2019/04", "2019/04", "2010/01"],
+        "observable_end_ym": ["2020/06", None, "2019/09", "2019/09", "2012/12"],
+    }).write_ipc(path)
+    return path
+
+
+def test_person_years_are_split_by_fiscal_year(tekiyo_file):
+    population = build_enrollment_population(tekiyo_file, date(2019, 4, 1), date(2021, 3, 1))
+
+    assert population.schema == pl.Schema(ENROLLMENT_POPULATION_SCHEMA)
+    rows = {(row["chiiki_code"], row["fiscal_year"]): (row["n_enrollees"], row["person_years"])
+            for row in population.iter_rows(named=True)}
+    assert rows == {
+        ("01", 2019): (2, pytest.approx((6 + 3) / 12)),   # 1: 2019/10〜2020/03、2: 2020/01〜2020/03
+        ("01", 2020): (2, pytest.approx((3 + 12) / 12)),  # 1: 2020/04〜2020/06、2: 2020/04〜2021/03
+        ("02", 2019): (1, pytest.approx((6 + 6) / 12)),   # 3 は1人として数える（人年は行毎の月数の合計）
+    }
+
+
+def test_prescribing_rates_fill_regions_without_treated_patients(tekiyo_file):
+    population = build_enrollment_population(tekiyo_file, date(2019, 4, 1), date(2021, 3, 1))
+    treated_years = pl.DataFrame({"kojin_id": [1, 1], "fiscal_year": [2019, 2020], "n_fills": [2, 1]},
+                                 schema={"kojin_id": pl.Int64, "fiscal_year": pl.Int32, "n_fills": pl.UInt32})
+    regions = pl.DataFrame({"kojin_id": [1], "chiiki_code": ["01"]})
+    rates = prescribing_rates(treated_years, regions, population, fiscal_years=[2019])
+
+    assert rates.select(["chiiki_code", "n_treated_patients", "treated_per_100k"]).rows() == [
+        ("01", 1, 50_000.0),
+        ("02", 0, 0.0),
+    ]
@@ -0,0 +1,66 @@
+"""extract_f10_2_patients.py のスキャン方式（lazy / incremental / parallel / per_file）が同じ結果を返すことのテスト"""
+
+import os
+
+import polars as pl
+import pytest
+
+F10_2_CODES = ["3031001", "3031002"]
+
+# 4パーティション。患者1は同じ最早診療開始日が複数パーティションにあり receipt_ym で決まる。
+# 患者2は最早診療開始日と receipt_ym まで同じレコードが2パーティションにあり、ファイル順で先のものを採用する
+PARTITIONS = {
+    "201501": [(1, 101, 201501, "3031001", "2015/01/10", "1", "1", "0"),
+               (2, 201, 201501, "3031002", "2015/01/20", "0", "1", "0"),
+               (3, 301, 201501, "1234567", "2014/05/01", "1", "1", "0")],
+    "201502": [(1, 102, 201502, "3031002", "2015/01/10", "0", "2", "1"),
+               (2, 202, 201501, "3031001", "2015/01/20", "1", "2", "1"),
+               (3, 302, 201502, "3031001", "2015/02/03", "1", "1", "0")],
+    "201503": [(1, 103, 201503, "3031001", "2015/03/01", "1", "1", "0"),
+               (4, 401, 201503, "3031001", "2013/12/31", "1", "1", "0")],
+    "201504": [(2, 203, 201504, "3031001", "2015/04/01", "1", "1", "0"),
+               (3, 303, 201504, "1234567", "2015/04/02", "1", "1", "0")],
+}
+
+
+@pytest.fixture
+def extract_module(tmp_path, monkeypatch):
+    """スクリプトを読み込む（読み込み時にカレントディレクトリへ outputs/logs を作るため tmp_path へ移動）"""
+    monkeypatch.chdir(tmp_path)
+    script_dir = os.path.join(os.path.dirname(__file__), "..", "scripts", "preprocessing", "python")
+    monkeypatch.syspath_prepend(os.path.abspath(script_dir))
+    import extract_f10_2_patients
+    return extract_f10_2_patients
+
+
+@pytest.fixture
+def disease_files(tmp_path):
+    columns = ["kojin_id", "receipt_id", "receipt_ym", "diseases_code", "sinryo_start_ymd",
+               "shubyomei_flg", "tenki_kbn_code", "utagai_flg"]
+    files = []
+    for ym, rows in PARTITIONS.items():
+        path = os.path.join(tmp_path, f"receipt_diseases_{ym}.feather")
+        pl.DataFrame(rows, schema=columns, orient="row").write_ipc(path)
+        files.append(path)
+    return files
+
+
+def test_scan_modes_return_identical_index_dates(extract_module, disease_files):
+    params = {"n_threads": 2, "batch_size": 2}  # parallel は2バッチに分けて統合する
+    results = {mode: extract_module.extract_f10_2_patients(disease_files, F10_2_CODES, params, scan_mode=mode)
+                     .sort("kojin_id")
+               for mode in ("lazy", "incremental", "parallel", "per_file")}
+
+    expected = results["lazy"]
+    # 患者4は研究期間前のため除外
+    assert expected["kojin_id"].to_list() == [1, 2, 3]
+    assert expected["index_date"].to_list() == ["2015/01/10", "2015/01/20", "2015/02/03"]
+    assert expected["first_receipt_id"].to_list() == [101, 201, 302]
+    assert expected["total_f10_2_records"].to_list() == [3, 3, 1]
+    for mode, result in results.items():
+        assert result.equals(expected), mode
+
+
+def test_unknown_scan_mode_is_rejected(extract_module, disease_files):
+    with pytest.raises(ValueError):
+        extract_module.extract_f10_2_patients(disease_files, F10_2_CODES, {}, scan_mode="unknown")
@@ -0,0 +1,55 @@
+"""utils.institution_volume のテスト（分位点の表と専門医療機関の閾値・フラグの一致）"""
+
+from datetime import date
+
+import polars as pl
+
+from utils.institution_volume import (INSTITUTION_VOLUME_SCHEMA, QUANTILE_INTERPOLATION, flag_specialist_facilities,
+                                      specialist_facilities, specialist_threshold, volume_quantiles)
+
+
+def make_volume():
+    return pl.DataFrame({
+        "iryokikan_no": [1, 2, 3, 1, 2, 3],
+        "fiscal_year": [2020, 2020, 2020, 2021, 2021, 2021],
+        "distinct_patients": [1, 2, 20, 3, 4, 10],
+    }, schema=INSTITUTION_VOLUME_SCHEMA)
+
+
+def test_threshold_matches_quantile_table():
+    volume = make_volume()
+    quantiles = volume_quantiles(volume, [0.5, 0.9])
+    overall = quantiles.filter(pl.col("fiscal_year").is_null())
+
+    threshold = specialist_threshold(volume, None, 0.9)
+
+    # 線形補間では 15 となる分位点が、実際の患者数（20）になる
+    assert QUANTILE_INTERPOLATION == "higher"
+    assert threshold == 20
+    assert overall.filter(pl.col("quantile") == 0.9)["distinct_patients"].item() == threshold
+    assert overall.filter(pl.col("quantile") == 0.5)["distinct_patients"].item() == 4
+    by_year = quantiles.filter(pl.col("fiscal_year").is_not_null() & (pl.col("quantile") == 0.5))
+    assert by_year["distinct_patients"].to_list() == [2, 4]
+    assert set(quantiles["distinct_patients"].to_list()) <= set(volume["distinct_patients"].cast(pl.Float64).to_list())
+
+    assert specialist_facilities(volume, threshold).rows() == [(3, 2020)]
+
+
+def test_min_patients_overrides_quantile():
+    volume = make_volume()
+    assert specialist_threshold(volume, 4, 0.9) == 4
+    assert sorted(specialist_facilities(volume, 4).rows()) == [(2, 2021), (3, 2020), (3, 2021)]
+    assert specialist_threshold(volume.clear(), None, 0.9) is None
+
+
+def test_flag_uses_fiscal_year_of_date():
+    specialists = specialist_facilities(make_volume(), 20)
+    institutions = pl.DataFrame({
+        "iryokikan_no": [3, 3, 2, None],
+        "institution_date": [date(2021, 3, 31), date(2021, 4, 1), date(2020, 6, 1), date(2020, 6, 1)],
+    })
+
+    flagged = flag_specialist_facilities(institutions, specialists, "institution_date")
+
+    # 2021/03/31 は2020年度
+    assert flagged["is_specialist_facility"].to_list() == [True, False, False, None]
@@ -0,0 +1,71 @@
+"""utils.partition_index のテスト（kojin_idサマリーのmin/max・Bloomフィルタによる絞り込み）"""
+
+import os
+
+import polars as pl
+import pytest
+
+from utils.partition_index import (bloom_may_contain, build_bloom_bits, select_files_for_patients,
+                                   update_kojin_id_summary)
+
+
+def test_bloom_filter_has_no_false_negatives():
+    kojin_ids = pl.Series("kojin_id", list(range(-500, 500)) + [2**62, 10**12 + 7, 123456789], dtype=pl.Int64)
+    num_bits, bits = build_bloom_bits(kojin_ids)
+
+    assert num_bits >= len(kojin_ids) * 10
+    assert bloom_may_contain(num_bits, bits, kojin_ids).all()
+
+
+@pytest.fixture
+def monthly_files(tmp_path):
+    """kojin_idの範囲が重ならない3ファイルと、kojin_idが全てnullのファイル"""
+    ranges = {"receipt_202001.feather": range(1, 101),
+              "receipt_202002.feather": range(200, 301, 2),
+              "receipt_202003.feather": range(1000, 1101)}
+    paths = []
+    for filename, ids in ranges.items():
+        path = os.path.join(tmp_path, filename)
+        # 同じ患者の複数行も含める
+        pl.DataFrame({"kojin_id": list(ids) * 2}).write_ipc(path)
+        paths.append(path)
+    empty_path = os.path.join(tmp_path, "receipt_202004.feather")
+    pl.DataFrame({"kojin_id": [None, None]}, schema={"kojin_id": pl.Int64}).write_ipc(empty_path)
+    return paths + [empty_path]
+
+
+def test_summary_reports_every_inserted_id(monthly_files, tmp_path):
+    summary = update_kojin_id_summary(str(tmp_path), monthly_files)
+
+    assert summary.select(["file_name", "n_kojin_ids", "kojin_id_min", "kojin_id_max"]).rows() == [
+        ("receipt_202001.feather", 100, 1, 100),
+        ("receipt_202002.feather", 51, 200, 300),
+        ("receipt_202003.feather", 101, 1000, 1100),
+        ("receipt_202004.feather", 0, None, None),
+    ]
+    for path, row in zip(monthly_files[:3], summary.head(3).iter_rows(named=True)):
+        ids = pl.read_ipc(path).get_column("kojin_id").unique()
+        assert bloom_may_contain(row["bloom_num_bits"], pl.Series(row["bloom_bits"], dtype=pl.UInt8), ids).all()
+        # 各ファイルの全患者で絞り込むと、そのファイルは必ず残る
+        assert path in select_files_for_patients(monthly_files, ids, summary)
+
+
+@pytest.mark.parametrize("patient_ids, expected", [
+    ([50, 250], ["receipt_202001.feather", "receipt_202002.feather"]),
+    ([1100], ["receipt_202003.feather"]),
+    ([150, 500, 5000], []),  # どのファイルのmin/max範囲にも入らない
+])
+def test_pruning_keeps_files_whose_range_covers_the_ids(monthly_files, tmp_path, patient_ids, expected):
+    summary = update_kojin_id_summary(str(tmp_path), monthly_files)
+    selected = select_files_for_patients(monthly_files, patient_ids, summary)
+
+    assert [os.path.basename(f) for f in selected] == expected
+
+
+def test_files_changed_after_the_summary_are_always_read(monthly_files, tmp_path):
+    summary = update_kojin_id_summary(str(tmp_path), monthly_files)
+    pl.DataFrame({"kojin_id": [5000]}).write_ipc(monthly_files[0])
+
+    selected = select_files_for_patients(monthly_files, [5000], summary)
+    assert [os.path.basename(f) for f in selected] == ["receipt_202001.feather"]
+    assert select_files_for_patients(monthly_files, [5000], None) == monthly_files
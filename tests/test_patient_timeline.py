@@ -0,0 +1,43 @@
+"""utils.patient_timeline のテスト（イベントの作成とCSRオフセットによる切り出し）"""
+
+from datetime import date
+
+import polars as pl
+
+from utils.patient_timeline import build_timeline_events, slice_timelines, to_timeline_store
+
+DRUG_CLASSES = ["nalmefene", "acamprosate"]
+
+
+def make_events():
+    index_dates = pl.DataFrame({"kojin_id": [3, 1, 2], "index_date": [date(2020, 1, 10)] * 3})
+    fills = pl.DataFrame({"kojin_id": [1, 1, 3], "shohou_ymd": [date(2020, 1, 10), date(2020, 2, 1), date(2020, 1, 5)],
+                          "drug_class": ["acamprosate", "nalmefene", "nalmefene"]})
+    exams = pl.DataFrame({"kojin_id": [1], "exam_ymd": [date(2019, 12, 31)]})
+    return build_timeline_events(index_dates, None, fills, exams, None, DRUG_CLASSES)
+
+
+def test_offsets_slice_each_patients_events():
+    events, offsets = to_timeline_store(make_events())
+
+    assert "kojin_id" not in events.columns
+    assert offsets.rows() == [(1, 0, 4), (2, 4, 1), (3, 5, 2)]
+
+    sliced = slice_timelines(events, offsets, [3, 1, 99])
+    assert sliced.select(["kojin_id", "event_type", "day_offset", "drug_class"]).cast(
+        {"event_type": pl.String, "drug_class": pl.String}).rows() == [
+        (3, "prescription", -5, "nalmefene"),
+        (3, "index_diagnosis", 0, None),
+        (1, "exam", -10, None),
+        (1, "index_diagnosis", 0, None),
+        (1, "prescription", 0, "acamprosate"),
+        (1, "prescription", 22, "nalmefene"),
+    ]
+
+
+def test_slice_without_matching_patients_is_empty():
+    events, offsets = to_timeline_store(make_events())
+    sliced = slice_timelines(events, offsets, [99])
+
+    assert sliced.is_empty()
+    assert sliced.columns == ["kojin_id"] + events.columns
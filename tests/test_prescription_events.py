@@ -0,0 +1,67 @@
+"""utils.prescription_events のテスト（作成元・イベントファイルの一覧と古い形式のイベントファイル）"""
+
+import os
+from datetime import date
+
+import polars as pl
+
+from utils.patient_buckets import list_monthly_files
+from utils.prescription_events import (PRESCRIPTION_EVENT_COLUMNS, get_event_file_path, list_prescription_event_files,
+                                       resolve_prescription_event_sources, scan_prescription_events)
+
+
+def write_source_month(source_dir: str, ym: str, extension: str):
+    """1か月分の薬剤ファイルと算定日ファイル（extension の形式）"""
+    drug = pl.DataFrame({"kojin_id": [1], "receipt_id": [10], "line_no": [1], "drug_code": [101]})
+    santei = pl.DataFrame({"kojin_id": [1], "receipt_id": [10], "line_no": [1],
+                           "shohou_ymd": [f"{ym[:4]}/{ym[4:]}/01"], "kaisuu": ["14"]})
+    for table, df in (("receipt_drug", drug), ("receipt_drug_santei_ymd", santei)):
+        directory = os.path.join(source_dir, table)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{table}_{ym}{extension}")
+        df.write_parquet(path) if extension == ".parquet" else df.write_ipc(path)
+
+
+def test_parquet_sources_are_listed_and_joined(tmp_path):
+    source_dir, events_dir = os.path.join(tmp_path, "canonical"), os.path.join(tmp_path, "events")
+    write_source_month(source_dir, "202001", ".parquet")
+    write_source_month(source_dir, "202002", ".feather")
+
+    current, stale = resolve_prescription_event_sources(events_dir, source_dir)
+    assert current == [] and stale == []  # イベントファイルが未作成
+
+    os.makedirs(events_dir)
+    drug_file = os.path.join(source_dir, "receipt_drug", "receipt_drug_202001.parquet")
+    assert get_event_file_path(drug_file, events_dir) == os.path.join(events_dir, "prescription_events_202001.feather")
+    # 補助ファイルは一覧に含めない
+    pl.DataFrame({"kojin_id": [1]}).write_ipc(os.path.join(events_dir, "_kojin_id_summary.feather"))
+    pl.DataFrame({"kojin_id": [9]}).write_parquet(os.path.join(events_dir, "prescription_events_201912.parquet"))
+    assert list_prescription_event_files(events_dir) == [os.path.join(events_dir, "prescription_events_201912.parquet")]
+
+    # 作成元の2か月とも未作成として作成元から結合し、作成元のない月のイベントファイルは読まない
+    current, stale = resolve_prescription_event_sources(events_dir, source_dir)
+    assert current == []
+    assert [os.path.basename(santei_file) for _, santei_file in stale] == [
+        "receipt_drug_santei_ymd_202001.parquet", "receipt_drug_santei_ymd_202002.feather"]
+    events = scan_prescription_events(current, stale_sources=stale).collect().sort("shohou_ymd")
+    assert events.select(["shohou_ymd", "days_supply"]).rows() == [(date(2020, 1, 1), 14.0), (date(2020, 2, 1), 14.0)]
+
+
+def test_event_files_without_days_supply_are_read_as_null(tmp_path):
+    old = pl.DataFrame({"kojin_id": [1], "shohou_ymd": [date(2020, 1, 1)], "drug_code": [101],
+                        "receipt_id": [10], "line_no": [1]})
+    new = old.with_columns(pl.lit(30.0).alias("days_supply"))
+    old_file, new_file = os.path.join(tmp_path, "old.feather"), os.path.join(tmp_path, "new.feather")
+    old.write_ipc(old_file)
+    new.write_ipc(new_file)
+
+    events = scan_prescription_events([old_file, new_file]).collect()
+    assert events.columns == PRESCRIPTION_EVENT_COLUMNS
+    assert events["days_supply"].to_list() == [None, 30.0]
+
+
+def test_monthly_files_for_buckets_include_parquet(tmp_path):
+    for filename in ("receipt_diseases_202001.parquet", "receipt_diseases_202002.feather", "_diseases_code_index.feather"):
+        pl.DataFrame({"kojin_id": [1]}).write_ipc(os.path.join(tmp_path, filename))
+    assert [os.path.basename(f) for f in list_monthly_files(str(tmp_path), "receipt_diseases")] == [
+        "receipt_diseases_202001.parquet", "receipt_diseases_202002.feather"]
@@ -0,0 +1,91 @@
+"""utils.treatment_eras のテスト（治療エピソードの連結と打ち切り）"""
+
+from datetime import date
+
+import polars as pl
+
+from utils.treatment_eras import TREATMENT_ERA_SCHEMA, build_treatment_eras
+
+DRUG_NAMES = {101: "nalmefene", 102: "acamprosate"}
+OBSERVATION_END = date(2020, 12, 31)
+
+
+def make_events(rows):
+    """(kojin_id, shohou_ymd, drug_code, days_supply) の処方イベント"""
+    return pl.LazyFrame(rows, schema={"kojin_id": pl.Int64, "shohou_ymd": pl.Date,
+                                      "drug_code": pl.Int64, "days_supply": pl.Float64}, orient="row")
+
+
+def make_index_dates(rows):
+    return pl.DataFrame(rows, schema={"kojin_id": pl.Int64, "index_date": pl.Date}, orient="row")
+
+
+def build(events, index_dates, follow_up_ends=None, allowed_gap_days=30):
+    return build_treatment_eras(events, index_dates, DRUG_NAMES, allowed_gap_days, 28, OBSERVATION_END,
+                                follow_up_ends)
+
+
+def test_fills_within_gap_are_bridged_into_one_era():
+    events = make_events([
+        (1, date(2020, 1, 1), 101, 30.0),   # 1/31 まで
+        (1, date(2020, 2, 20), 101, 30.0),  # 終了日から20日後 → 同じエピソード
+        (1, date(2020, 5, 1), 102, 10.0),   # 3/21 から41日後 → 新しいエピソード
+    ])
+    eras = build(events, make_index_dates([(1, date(2020, 1, 1))]))
+
+    assert eras.schema == pl.Schema(TREATMENT_ERA_SCHEMA)
+    assert eras.select(["era_number", "era_start", "era_end", "n_fills", "first_drug"]).rows() == [
+        (1, date(2020, 1, 1), date(2020, 3, 21), 2, "nalmefene"),
+        (2, date(2020, 5, 1), date(2020, 5, 11), 1, "acamprosate"),
+    ]
+    assert eras["duration_days"].to_list() == [80, 10]
+    assert eras["censored"].to_list() == [False, False]
+
+
+def test_overlapping_fill_extends_coverage_for_the_gap():
+    # 2件目は1件目の途中で終わるが、カバー期間は1件目の終了日（3/31）まで続く
+    events = make_events([
+        (1, date(2020, 1, 1), 101, 90.0),
+        (1, date(2020, 1, 10), 102, 5.0),
+        (1, date(2020, 4, 20), 101, 10.0),
+    ])
+    eras = build(events, make_index_dates([(1, date(2020, 1, 1))]))
+
+    assert eras["era_number"].to_list() == [1]
+    assert eras["n_fills"].to_list() == [3]
+
+
+def test_fills_before_index_and_missing_days_supply():
+    events = make_events([
+        (1, date(2019, 12, 1), 101, 30.0),  # インデックス日前は含めない
+        (1, date(2020, 1, 1), 101, None),   # 欠損は既定の28日
+        (1, date(2020, 1, 1), 999, 30.0),   # 対象外の薬剤
+    ])
+    eras = build(events, make_index_dates([(1, date(2020, 1, 1))]))
+
+    assert eras.select(["era_start", "era_end", "n_fills"]).rows() == [(date(2020, 1, 1), date(2020, 1, 29), 1)]
+
+
+def test_eras_are_censored_at_each_patients_follow_up_end():
+    events = make_events([
+        (1, date(2020, 3, 1), 101, 30.0),
+        (1, date(2020, 6, 15), 101, 30.0),   # 追跡終了後の処方は使わない
+        (2, date(2020, 3, 1), 101, 30.0),
+        (3, date(2020, 12, 20), 101, 30.0),  # 追跡終了日の指定なし → 観察期間の終了日で打ち切り
+    ])
+    index_dates = make_index_dates([(1, date(2020, 3, 1)), (2, date(2020, 3, 1)), (3, date(2020, 12, 1))])
+    follow_up_ends = pl.DataFrame({"kojin_id": [1, 2], "follow_up_end": [date(2020, 3, 31), date(2020, 12, 31)]})
+    eras = build(events, index_dates, follow_up_ends)
+
+    assert eras.select(["kojin_id", "era_end", "censored"]).rows() == [
+        (1, date(2020, 3, 31), True),
+        (2, date(2020, 3, 31), False),
+        (3, OBSERVATION_END, True),
+    ]
+
+
+def test_no_fills_returns_empty_frame_with_schema():
+    eras = build(make_events([]), make_index_dates([(1, date(2020, 1, 1))]))
+
+    assert eras.is_empty()
+    assert eras.schema == pl.Schema(TREATMENT_ERA_SCHEMA)
@@ -0,0 +1,47 @@
+"""utils.treatment_states のテスト（区間毎の治療状態と推移）"""
+
+from datetime import date
+
+import polars as pl
+
+from utils.treatment_states import (INTERVAL_STATE_SCHEMA, LOST_STATE, NO_TREATMENT_STATE, assign_states,
+                                    follow_up_end_expr, interval_treatments, transition_counts)
+
+DRUG_STATES = {101: "nalmefene", 201: "abstinence"}
+STATE_ORDER = ["nalmefene", "abstinence"]
+
+
+def test_interval_state_uses_first_class_in_priority_order():
+    events = pl.LazyFrame({
+        "kojin_id": [1, 1, 1, 1, 1],
+        "shohou_ymd": [date(2020, 1, 1), date(2020, 1, 20), date(2020, 2, 15), date(2019, 12, 1), date(2020, 6, 1)],
+        "drug_code": [201, 101, 201, 101, 101],
+    })
+    index_dates = pl.DataFrame({"kojin_id": [1], "index_date": [date(2020, 1, 1)]})
+    treatments = interval_treatments(events, index_dates, DRUG_STATES, STATE_ORDER, interval_days=30, n_intervals=3)
+
+    # 区間1に両方の区分 → 先の nalmefene。インデックス日前・最終区間より後は含めない
+    assert treatments.rows() == [(1, 1, "nalmefene"), (1, 2, "abstinence")]
+
+
+def test_intervals_after_follow_up_end_are_lost():
+    baseline = pl.DataFrame({"kojin_id": [1, 2], "index_date": [date(2020, 1, 1), date(2020, 1, 1)],
+                             "observable_end_ym": ["2020/02", None]})
+    patients = baseline.select(["kojin_id", "index_date",
+                                follow_up_end_expr("observable_end_ym", pl.String, date(2020, 12, 31))
+                                .alias("follow_up_end")])
+    treatments = pl.DataFrame({"kojin_id": [1, 2], "interval_number": [1, 2], "state": ["nalmefene", "abstinence"]},
+                              schema=INTERVAL_STATE_SCHEMA)
+    states = assign_states(patients, treatments, interval_days=30, n_intervals=3)
+
+    # 患者1の区間3の開始日（3/1）は追跡終了日（2/29）より後
+    assert states.rows() == [
+        (1, 1, "nalmefene"), (1, 2, NO_TREATMENT_STATE), (1, 3, LOST_STATE),
+        (2, 1, NO_TREATMENT_STATE), (2, 2, "abstinence"), (2, 3, NO_TREATMENT_STATE),
+    ]
+
+    transitions = transition_counts(states)
+    assert transitions.filter(pl.col("from_interval") == 2).select(["from_state", "to_state", "n_patients"]).rows() == [
+        ("abstinence", NO_TREATMENT_STATE, 1),
+        (NO_TREATMENT_STATE, LOST_STATE, 1),
+    ]
@@ -0,0 +1,201 @@
+"""
+正規化済みデータ（canonical storage）用ユーティリティ
+master/optimized_database_schema.json のカラム定義から各テーブルの正規の型を決め、
+読み込み時の型変換・日付の文字列解析を一度だけ行ったデータセットを作成・参照します
+"""
+
+import os
+import json
+import logging
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Union
+
+import polars as pl
+
+from utils.env_loader import DATA_ROOT_DIR
+from utils.partition_index import get_file_signature
+
+logger = logging.getLogger(__name__)
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+DEFAULT_SCHEMA_PATH = os.path.join(PROJECT_ROOT, "master", "optimized_database_schema.json")
+
+# 正規化済みデータセットの既定の出力先（raw/ と同じディレクトリ構成）
+DEFAULT_CANONICAL_ROOT_DIR = os.path.join(DATA_ROOT_DIR, "canonical")
+
+# 全ファイルの変換完了後に書き込むマニフェスト（これがある場合のみ読み込み側が利用する）
+CANONICAL_MANIFEST_FILENAME = "_canonical_manifest.json"
+
+DATE_FORMAT = "%Y/%m/%d"
+
+# この長さ以下の char/varchar のコード・フラグ列はCategoricalにする
+CATEGORICAL_MAX_LENGTH = 3
+
+# スキーマ定義より優先する型（drug_codeは実データ・Config.DRUG_CODESとも数値型レセコード）
+DTYPE_OVERRIDES: Dict[str, pl.DataType] = {
+    "drug_code": pl.Int64,
+}
+
+Frame = Union[pl.DataFrame, pl.LazyFrame]
+
+
+@lru_cache(maxsize=None)
+def load_schema_tables(schema_path: str = DEFAULT_SCHEMA_PATH) -> Dict:
+    """スキーマ定義のテーブル一覧を読み込み"""
+    with open(schema_path, "r", encoding="utf-8") as f:
+        return json.load(f)["tables"]
+
+
+def canonical_dtype(column: str, spec: Dict) -> pl.DataType:
+    """カラム定義から正規の型を決定"""
+    if column in DTYPE_OVERRIDES:
+        return DTYPE_OVERRIDES[column]
+
+    column_type = spec.get("type")
+    length = spec.get("length")
+    comment = spec.get("comment") or ""
+
+    if column_type == "integer":
+        return pl.Int64
+    if column_type == "numeric":
+        return pl.Float64
+    if length == 10 and comment.startswith("YYYY/MM/DD"):
+        return pl.Date
+    if isinstance(length, int) and length <= CATEGORICAL_MAX_LENGTH:
+        return pl.Categorical
+    return pl.String
+
+
+def get_canonical_dtypes(table: str, schema_path: str = DEFAULT_SCHEMA_PATH) -> Dict[str, pl.DataType]:
+    """テーブルの全カラムの正規の型（スキーマ定義にないテーブルは空）"""
+    tables = load_schema_tables(schema_path)
+    if table not in tables:
+        return {}
+    return {column: canonical_dtype(column, spec) for column, spec in tables[table]["columns"].items()}
+
+
+def date_expr(column: str, dtype: pl.DataType, strict: bool = True) -> pl.Expr:
+    """
+    列をDate型として参照する式（文字列 YYYY/MM/DD の場合のみ解析する）
+
+    strict=True の場合、解析できない値があると実行時にエラーとする。
+    strict=False の場合は null とするため、呼び出し側で該当行数を確認・記録すること。
+    """
+    if dtype == pl.Date:
+        return pl.col(column)
+    if dtype == pl.Datetime:
+        return pl.col(column).dt.date()
+    return pl.col(column).cast(pl.String).str.to_date(format=DATE_FORMAT, strict=strict)
+
+
+def with_date_columns(frame: Frame, columns: List[str], strict: bool = True) -> Frame:
+    """指定列をDate型に揃える（正規化済みデータでは何もしない。strict は date_expr と同じ）"""
+    schema = frame.collect_schema()
+    exprs = [date_expr(column, schema[column], strict) for column in columns if schema[column] != pl.Date]
+    return frame.with_columns(exprs) if exprs else frame
+
+
+def canonical_exprs(schema: pl.Schema, table: str, schema_path: str = DEFAULT_SCHEMA_PATH) -> Dict[str, pl.Expr]:
+    """
+    スキーマ定義に従って型を変える列毎の変換式（定義にない列・既に正規の型の列は含めない）
+
+    変換できない値（数値でないid、YYYY/MM/DD でない日付）は null とする。
+    """
+    dtypes = get_canonical_dtypes(table, schema_path)
+    exprs = {}
+    for column, current in schema.items():
+        target = dtypes.get(column)
+        if target is None or current == target:
+            continue
+        if target == pl.Date:
+            exprs[column] = date_expr(column, current, strict=False)
+        elif target == pl.Categorical:
+            exprs[column] = pl.col(column).cast(pl.String).cast(pl.Categorical)
+        else:
+            exprs[column] = pl.col(column).cast(target, strict=False)
+    return exprs
+
+
+def canonicalize(frame: Frame, table: str, schema_path: str = DEFAULT_SCHEMA_PATH) -> Frame:
+    """スキーマ定義に従って各列を正規の型に変換（定義にない列はそのまま。変換できない値は null）"""
+    exprs = canonical_exprs(frame.collect_schema(), table, schema_path)
+    return frame.with_columns(list(exprs.values())) if exprs else frame
+
+
+def conversion_null_counts(frame: Frame, table: str, schema_path: str = DEFAULT_SCHEMA_PATH) -> Frame:
+    """
+    canonicalize で値があるのに null になる（正規の型に変換できない）行数を列毎に集計
+
+    Returns:
+        1行の表（列は型を変える列。型を変える列がない場合は列のない表）
+    """
+    exprs = canonical_exprs(frame.collect_schema(), table, schema_path)
+    return frame.select([(pl.col(column).is_not_null() & expr.is_null()).sum().alias(column)
+                         for column, expr in exprs.items()])
+
+
+def list_raw_files(raw_dir: str) -> List[Tuple[str, str]]:
+    """変換対象の (テーブル名, raw_dir からの相対パス) のリスト
+
+    raw/ 直下のファイルはファイル名、サブディレクトリ内の月次ファイルはディレクトリ名をテーブル名とする。
+    インデックス等の補助ファイル（"_" で始まるもの）は対象外。
+    """
+    sources = []
+    for entry in sorted(os.listdir(raw_dir)):
+        entry_path = os.path.join(raw_dir, entry)
+        if os.path.isdir(entry_path):
+            for f in sorted(os.listdir(entry_path)):
+                if f.endswith(".feather") and not f.startswith("_"):
+                    sources.append((entry, os.path.join(entry, f)))
+        elif entry.endswith(".feather") and not entry.startswith("_"):
+            sources.append((entry[:-len(".feather")], entry))
+    return sources
+
+
+def load_canonical_manifest(canonical_root: str) -> Optional[Dict]:
+    """マニフェストの読み込み（正規化済みデータが未作成の場合はNone）"""
+    manifest_path = os.path.join(canonical_root, CANONICAL_MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_canonical_manifest(canonical_root: str, manifest: Dict):
+    """マニフェストの保存（全ファイルの変換完了後に呼び出す）"""
+    manifest_path = os.path.join(canonical_root, CANONICAL_MANIFEST_FILENAME)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+def stale_canonical_files(raw_dir: str, manifest: Dict) -> List[str]:
+    """
+    正規化後に raw_dir で追加・更新・削除されたファイル（raw_dir からの相対パス）
+
+    マニフェストに記録した変換元のサイズ・更新時刻と、現在の raw_dir のファイルを照合する。
+    """
+    recorded = manifest["files"]
+    current = {relative_path for _, relative_path in list_raw_files(raw_dir)} if os.path.isdir(raw_dir) else set()
+    stale = [relative_path for relative_path in sorted(current - set(recorded))]
+    for relative_path, entry in sorted(recorded.items()):
+        source_path = os.path.join(raw_dir, relative_path)
+        if (relative_path not in current
+                or get_file_signature(source_path) != (entry["source_size"], entry["source_mtime"])):
+            stale.append(relative_path)
+    return stale
+
+
+def resolve_data_dir(raw_dir: str, canonical_root: str = DEFAULT_CANONICAL_ROOT_DIR) -> str:
+    """正規化済みデータがあり、raw_dir の現在のファイルと一致すればそのディレクトリを、なければ raw_dir を返す"""
+    manifest = load_canonical_manifest(canonical_root)
+    if manifest is None:
+        return raw_dir
+    stale = stale_canonical_files(raw_dir, manifest)
+    if stale:
+        # 正規化後に追加・更新されたデータを読み落とさないよう、raw/ から読み込む
+        logger.warning(f"正規化済みデータが raw/ と一致しないため使用しません（{len(stale)} ファイル、例: {stale[0]}。"
+                       f"convert_canonical_storage.py を再実行してください）: {canonical_root}")
+        return raw_dir
+    logger.info(f"正規化済みデータを使用します: {canonical_root}")
+    return canonical_root
@@ -0,0 +1,288 @@
+"""
+F10.2 診療継続（転院後も F10.2 の算定が続く場合は継続とみなす）の作成ユーティリティ
+疾患ファイルのF10.2レコードをレセプトの医療機関（receipt_medical_institution.iryokikan_no）と結合して
+患者×月×医療機関の表にまとめ、患者毎の月次の算定有無をUInt64のビット列として保持します。
+継続期間（spell）・転院・脱落日は、患者毎の前月との差分（shift）と累積和による列演算で求めます
+"""
+
+import logging
+from datetime import date
+from typing import List, Optional, Tuple
+
+import polars as pl
+
+from utils.canonical_schema import with_date_columns
+from utils.cohort_keys import CohortKeys
+from utils.table_io import scan_table
+
+logger = logging.getLogger(__name__)
+
+# 月次ビット列の1語あたりの月数
+MONTHS_PER_WORD = 64
+
+CARE_SPELL_SCHEMA = {
+    "kojin_id": pl.Int64,
+    "spell_number": pl.UInt32,
+    "spell_start": pl.Date,
+    "spell_end": pl.Date,
+    "n_months": pl.UInt32,
+    "n_institutions": pl.UInt32,
+    "n_transfers": pl.UInt32,
+    "censored": pl.Boolean,
+}
+
+CARE_TRANSFER_SCHEMA = {
+    "kojin_id": pl.Int64,
+    "spell_number": pl.UInt32,
+    "transfer_month": pl.Date,
+    "from_iryokikan_no": pl.Int64,
+    "to_iryokikan_no": pl.Int64,
+}
+
+
+def month_number(value: date) -> int:
+    """月の通し番号（年×12＋月−1）"""
+    return value.year * 12 + value.month - 1
+
+
+def month_number_expr(month_start: pl.Expr) -> pl.Expr:
+    """月初日（Date）の列から月の通し番号を求める式"""
+    return month_start.dt.year().cast(pl.Int32) * 12 + month_start.dt.month().cast(pl.Int32) - 1
+
+
+def month_start_expr(number: pl.Expr) -> pl.Expr:
+    """月の通し番号から月初日（Date）を求める式"""
+    return pl.date(number // 12, number % 12 + 1, 1)
+
+
+def bitmap_word_count(first_month: date, last_month: date) -> int:
+    """観察期間の月次ビット列の語数"""
+    n_months = month_number(last_month) - month_number(first_month) + 1
+    return (n_months + MONTHS_PER_WORD - 1) // MONTHS_PER_WORD
+
+
+def collect_f10_2_months(disease_files: List[str],
+                         institution_files: List[str],
+                         f10_2_diseases_codes: List[str],
+                         cohort_keys: CohortKeys,
+                         first_month: date,
+                         last_month: date) -> pl.DataFrame:
+    """
+    観察期間内にF10.2が算定された患者×月×医療機関の表を作成
+
+    Returns:
+        pl.DataFrame: kojin_id, month（月の通し番号, Int32）, iryokikan_no（医療機関が不明の場合はnull）
+    """
+    schema = {"kojin_id": pl.Int64, "month": pl.Int32, "iryokikan_no": pl.Int64}
+    if not disease_files or not f10_2_diseases_codes:
+        return pl.DataFrame(schema=schema)
+
+    codes = pl.DataFrame({"diseases_code": f10_2_diseases_codes}, schema={"diseases_code": pl.String})
+    receipt_month = (pl.col("receipt_ym").cast(pl.String) + "/01").str.to_date("%Y/%m/%d")
+    records = (cohort_keys.restrict(scan_table(disease_files))
+               .select(["kojin_id",
+                        pl.col("receipt_id").cast(pl.Int64),
+                        pl.col("diseases_code").cast(pl.String),
+                        month_number_expr(receipt_month).alias("month")])
+               .join(codes.lazy(), on="diseases_code", how="semi")
+               .filter(pl.col("month").is_between(month_number(first_month), month_number(last_month)))
+               .drop("diseases_code"))
+
+    if institution_files:
+        # レセプトの医療機関は receipt_id（主キー）で1件に決まる
+        institutions = (cohort_keys.restrict(scan_table(institution_files))
+                        .select(["kojin_id",
+                                 pl.col("receipt_id").cast(pl.Int64),
+                                 pl.col("iryokikan_no").cast(pl.Int64)]))
+        records = records.join(institutions, on=["kojin_id", "receipt_id"], how="left")
+    else:
+        records = records.with_columns(pl.lit(None, dtype=pl.Int64).alias("iryokikan_no"))
+
+    months = (records
+              .select(["kojin_id", "month", "iryokikan_no"])
+              .unique()
+              .sort(["kojin_id", "month", "iryokikan_no"])
+              .collect(engine="streaming"))
+    logger.debug(f"collect_f10_2_months: F10.2 算定の (患者, 月, 医療機関) 数 = {len(months)}")
+    return months.cast(schema)
+
+
+def month_bitmaps(f10_2_months: pl.DataFrame, first_month: date, last_month: date) -> pl.DataFrame:
+    """
+    患者毎の月次のF10.2算定有無をビット列に変換
+
+    Returns:
+        pl.DataFrame: kojin_id, f10_2_months_<語番号>（UInt64）。語 w のビット b は観察期間の
+                      (64w + b) か月目（0始まり）の算定有無
+    """
+    n_words = bitmap_word_count(first_month, last_month)
+    offsets = list(range(month_number(last_month) - month_number(first_month) + 1))
+    # 月毎の (語番号, ビット値) の表。各患者・月は1行のため、ビット値の和がビット和と等しい
+    bits = pl.DataFrame({
+        "month": [month_number(first_month) + offset for offset in offsets],
+        "word": [offset // MONTHS_PER_WORD for offset in offsets],
+        "bit": [1 << (offset % MONTHS_PER_WORD) for offset in offsets],
+    }, schema={"month": pl.Int32, "word": pl.Int32, "bit": pl.UInt64})
+    return (f10_2_months
+            .select(["kojin_id", "month"])
+            .unique()
+            .join(bits, on="month", how="inner")
+            .group_by("kojin_id")
+            .agg([pl.col("bit").filter(pl.col("word") == word).sum().alias(f"f10_2_months_{word}")
+                  for word in range(n_words)]))
+
+
+def bitmap_months(bitmaps: pl.DataFrame, first_month: date, last_month: date) -> pl.DataFrame:
+    """
+    月次ビット列（month_bitmaps の結果）から、F10.2算定のある患者×月を復元
+
+    Returns:
+        pl.DataFrame: kojin_id, month_start（Date）
+    """
+    offsets = list(range(month_number(last_month) - month_number(first_month) + 1))
+    bits = pl.DataFrame({
+        "word": [offset // MONTHS_PER_WORD for offset in offsets],
+        "bit": [1 << (offset % MONTHS_PER_WORD) for offset in offsets],
+        "month": [month_number(first_month) + offset for offset in offsets],
+    }, schema={"word": pl.Int32, "bit": pl.UInt64, "month": pl.Int32})
+    word_columns = [col for col in bitmaps.columns if col.startswith("f10_2_months_")]
+    return (bitmaps
+            .unpivot(index="kojin_id", on=word_columns, variable_name="word", value_name="value")
+            .with_columns(pl.col("word").str.strip_prefix("f10_2_months_").cast(pl.Int32))
+            .filter(pl.col("value").fill_null(0) != 0)
+            .join(bits, on="word", how="inner")
+            .filter((pl.col("value") & pl.col("bit")) != 0)
+            .select(["kojin_id", month_start_expr(pl.col("month")).alias("month_start")])
+            .sort(["kojin_id", "month_start"]))
+
+
+def continuity_spells(f10_2_months: pl.DataFrame,
+                      index_dates: pl.DataFrame,
+                      max_gap_months: int) -> pl.DataFrame:
+    """
+    インデックス月以降のF10.2算定月を継続期間（spell）に割り当てる
+
+    医療機関を問わず、前の算定月からの空白が max_gap_months か月以内であれば同じ継続期間とする。
+
+    Returns:
+        pl.DataFrame: kojin_id, month, spell_number（1始まり）, prev_month（同じ継続期間の前の算定月。
+                      継続期間の最初の月はnull）の患者×算定月の表
+    """
+    index_month = month_number_expr(pl.col("index_date").dt.month_start()).alias("index_month")
+    index_months = (with_date_columns(index_dates.select(["kojin_id", "index_date"]), ["index_date"])
+                    .select(["kojin_id", index_month]))
+    previous = pl.col("month").shift(1).over("kojin_id")
+    new_spell = previous.is_null() | (pl.col("month") - previous > max_gap_months + 1)
+    patient_months = (f10_2_months
+                      .select(["kojin_id", "month"])
+                      .unique()
+                      .join(index_months, on="kojin_id", how="inner")
+                      .filter(pl.col("month") >= pl.col("index_month"))
+                      .sort(["kojin_id", "month"])
+                      .with_columns([new_spell.alias("new_spell"), previous.alias("prev_month")])
+                      .with_columns([
+                          pl.col("new_spell").cast(pl.UInt32).cum_sum().over("kojin_id").alias("spell_number"),
+                          pl.when(pl.col("new_spell")).then(None).otherwise(pl.col("prev_month")).alias("prev_month"),
+                      ])
+                      .select(["kojin_id", "month", "spell_number", "prev_month"]))
+    return patient_months
+
+
+def build_care_continuity(disease_files: List[str],
+                          institution_files: List[str],
+                          f10_2_diseases_codes: List[str],
+                          patients_df: pl.DataFrame,
+                          max_gap_months: int,
+                          first_month: date,
+                          last_month: date,
+                          cohort_keys: Optional[CohortKeys] = None,
+                          follow_up_ends: Optional[pl.DataFrame] = None) -> Tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+    """
+    F10.2 診療継続のデータセットを作成
+
+    最後の算定月＋max_gap_months が患者の追跡終了月（follow_up_ends の kojin_id, follow_up_end。
+    ない患者は観察期間の最終月）以降の継続期間は、脱落が観察できないため打ち切りとする。
+
+    Returns:
+        Tuple[pl.DataFrame, pl.DataFrame, pl.DataFrame]:
+            - 患者毎の要約（patients_df の全患者）: kojin_id, f10_2_months_<語番号>, n_spells,
+              dropout_date（インデックス後最初の継続期間の最終算定月の末日。打ち切りの場合はnull）,
+              n_transfers（インデックス後最初の継続期間内の転院回数）
+            - 継続期間（CARE_SPELL_SCHEMA）
+            - 転院（CARE_TRANSFER_SCHEMA）: 前の算定月の医療機関をいずれも含まない算定月。
+              医療機関が複数ある場合は番号の小さい方を from/to とする
+    """
+    cohort_keys = cohort_keys or CohortKeys.from_frame(patients_df)
+    f10_2_months = collect_f10_2_months(disease_files, institution_files, f10_2_diseases_codes,
+                                        cohort_keys, first_month, last_month)
+    patient_months = continuity_spells(f10_2_months, patients_df, max_gap_months)
+
+    # 転院: 同じ継続期間の前の算定月と共通の医療機関がない月
+    institutions = f10_2_months.drop_nulls("iryokikan_no")
+    previous_institutions = (patient_months
+                             .drop_nulls("prev_month")
+                             .join(institutions.rename({"month": "prev_month"}), on=["kojin_id", "prev_month"],
+                                   how="inner"))
+    current_institutions = patient_months.join(institutions, on=["kojin_id", "month"], how="inner")
+    continued = current_institutions.join(previous_institutions, on=["kojin_id", "month", "iryokikan_no"],
+                                          how="semi")
+    transfers = (current_institutions
+                 .filter(pl.col("prev_month").is_not_null())
+                 .join(continued.select(["kojin_id", "month"]).unique(), on=["kojin_id", "month"], how="anti")
+                 .join(previous_institutions
+                       .group_by(["kojin_id", "month"])
+                       .agg(pl.col("iryokikan_no").min().alias("from_iryokikan_no")),
+                       on=["kojin_id", "month"], how="inner")
+                 .group_by(["kojin_id", "spell_number", "month"])
+                 .agg([pl.col("from_iryokikan_no").first(), pl.col("iryokikan_no").min().alias("to_iryokikan_no")])
+                 .with_columns(month_start_expr(pl.col("month")).alias("transfer_month"))
+                 .select(list(CARE_TRANSFER_SCHEMA))
+                 .sort(["kojin_id", "transfer_month"])
+                 .cast(CARE_TRANSFER_SCHEMA))
+
+    last = month_number(last_month)
+    if follow_up_ends is not None:
+        follow_up_months = (with_date_columns(follow_up_ends.select(["kojin_id", "follow_up_end"]), ["follow_up_end"])
+                            .select(["kojin_id",
+                                     pl.min_horizontal(month_number_expr(pl.col("follow_up_end").dt.month_start()),
+                                                       pl.lit(last, dtype=pl.Int32)).alias("last_month")]))
+    else:
+        follow_up_months = patients_df.select(["kojin_id", pl.lit(last, dtype=pl.Int32).alias("last_month")])
+    spells = (patient_months
+              .join(f10_2_months, on=["kojin_id", "month"], how="left")
+              .group_by(["kojin_id", "spell_number"])
+              .agg([
+                  pl.col("month").min().alias("start_month"),
+                  pl.col("month").max().alias("end_month"),
+                  pl.col("month").n_unique().alias("n_months"),
+                  pl.col("iryokikan_no").drop_nulls().n_unique().alias("n_institutions"),
+              ])
+              .join(transfers.group_by(["kojin_id", "spell_number"]).agg(pl.len().alias("n_transfers")),
+                    on=["kojin_id", "spell_number"], how="left")
+              .join(follow_up_months.unique("kojin_id"), on="kojin_id", how="left")
+              .with_columns([
+                  month_start_expr(pl.col("start_month")).alias("spell_start"),
+                  month_start_expr(pl.col("end_month")).dt.month_end().alias("spell_end"),
+                  pl.col("n_transfers").fill_null(0),
+                  (pl.col("end_month") + max_gap_months >= pl.col("last_month").fill_null(last)).alias("censored"),
+              ])
+              .select(list(CARE_SPELL_SCHEMA))
+              .sort(["kojin_id", "spell_number"])
+              .cast(CARE_SPELL_SCHEMA))
+
+    first_spell = (spells
+                   .filter(pl.col("spell_number") == 1)
+                   .select(["kojin_id",
+                            pl.when(pl.col("censored")).then(None).otherwise(pl.col("spell_end")).alias("dropout_date"),
+                            "n_transfers"]))
+    n_spells = spells.group_by("kojin_id").agg(pl.len().cast(pl.UInt32).alias("n_spells"))
+    bitmaps = month_bitmaps(f10_2_months, first_month, last_month)
+    word_columns = [col for col in bitmaps.columns if col != "kojin_id"]
+    summary = (patients_df
+               .select("kojin_id")
+               .join(bitmaps, on="kojin_id", how="left")
+               .join(n_spells, on="kojin_id", how="left")
+               .join(first_spell, on="kojin_id", how="left")
+               .with_columns([pl.col(col).fill_null(0) for col in word_columns + ["n_spells", "n_transfers"]]))
+    logger.debug(f"build_care_continuity: 継続期間 {len(spells)} 件, 転院 {len(transfers)} 件")
+    return summary, spells, transfers
@@ -0,0 +1,60 @@
+"""
+コホートの患者キー（kojin_id）のユーティリティ
+コホートの患者IDを重複なし・ソート済みのInt64のDataFrameとして一度だけ作成し、
+各ファイルのスキャンにはリテラルの is_in ではなく semi-join で適用します
+"""
+
+import logging
+from typing import Iterable, Union
+
+import polars as pl
+
+logger = logging.getLogger(__name__)
+
+KEY_COLUMN = "kojin_id"
+
+
+class CohortKeys:
+    """コホートの患者ID（重複なし・ソート済みのInt64）"""
+
+    def __init__(self, ids: pl.Series):
+        self.frame = (pl.DataFrame({KEY_COLUMN: ids.cast(pl.Int64, strict=False)})
+                      .drop_nulls()
+                      .unique()
+                      .sort(KEY_COLUMN))
+        self.min_id = self.frame[KEY_COLUMN].min()
+        self.max_id = self.frame[KEY_COLUMN].max()
+
+    @classmethod
+    def from_frame(cls, df: pl.DataFrame, column: str = KEY_COLUMN) -> "CohortKeys":
+        """患者データのkojin_id列から作成"""
+        return cls(df.get_column(column))
+
+    @property
+    def ids(self) -> pl.Series:
+        """患者IDのSeries（ソート済み）"""
+        return self.frame.get_column(KEY_COLUMN)
+
+    def __len__(self) -> int:
+        return len(self.frame)
+
+    def restrict(self, lf: pl.LazyFrame, column: str = KEY_COLUMN) -> pl.LazyFrame:
+        """LazyFrameをコホートの患者の行に絞り込む
+
+        kojin_idがInt64でないファイル（未正規化のraw等）のみ型を揃える。
+        semi-joinの前にmin/max範囲の条件を付けるため、Parquetでは範囲外の行グループを読み飛ばせる。
+        """
+        if lf.collect_schema()[column] != pl.Int64:
+            lf = lf.with_columns(pl.col(column).cast(pl.Int64, strict=False))
+        if self.frame.is_empty():
+            return lf.filter(pl.lit(False))
+        return (lf
+                .filter(pl.col(column).is_between(self.min_id, self.max_id))
+                .join(self.frame.lazy().rename({KEY_COLUMN: column}), on=column, how="semi"))
+
+
+def as_id_series(patient_ids: Union[CohortKeys, Iterable]) -> pl.Series:
+    """CohortKeysまたは患者IDの集合をInt64のSeriesに変換"""
+    if isinstance(patient_ids, CohortKeys):
+        return patient_ids.ids
+    return pl.Series(KEY_COLUMN, list(patient_ids)).cast(pl.Int64, strict=False).drop_nulls().unique()
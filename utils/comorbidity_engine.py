@@ -0,0 +1,93 @@
+"""
+併存疾患フラグの作成ユーティリティ
+ICD10マスターから diseases_code → 疾患カテゴリ の対応表を一度だけ作成し、
+全ての疾患ファイルを1回のスキャンで対応表と結合して、インデックス日前の参照期間内の
+疾患カテゴリ毎のフラグ（has_<カテゴリ>）を患者単位で作成します
+"""
+
+import logging
+from typing import Dict, List, Optional
+
+import polars as pl
+
+from utils.canonical_schema import date_expr, with_date_columns
+from utils.cohort_keys import CohortKeys
+from utils.table_io import scan_table
+
+logger = logging.getLogger(__name__)
+
+# 標準病名マスターのICD10区分コード
+STANDARD_ICD10_KBN_CODE = "1"
+
+
+def build_category_lookup(icd10_master: pl.DataFrame,
+                          category_icd10_codes: Dict[str, List[str]]) -> pl.DataFrame:
+    """diseases_code → 疾患カテゴリ の対応表（1つのコードが複数のカテゴリに属する場合は複数行）"""
+    standard = icd10_master.filter(pl.col("icd10_kbn_code").cast(pl.String) == STANDARD_ICD10_KBN_CODE)
+    parts = []
+    for category, prefixes in category_icd10_codes.items():
+        if not prefixes:
+            continue
+        matched = pl.any_horizontal([pl.col("icd10_code").str.starts_with(prefix) for prefix in prefixes])
+        parts.append(standard
+                     .filter(matched)
+                     .select(pl.col("diseases_code").cast(pl.String), pl.lit(category).alias("category")))
+    if not parts:
+        return pl.DataFrame(schema={"diseases_code": pl.String, "category": pl.String})
+    return pl.concat(parts).unique().sort(["category", "diseases_code"])
+
+
+def lookback_start_expr(index_date: pl.Expr, lookback_days: Optional[int]) -> Optional[pl.Expr]:
+    """参照期間の開始月（Noneの場合は期間の制限なし）"""
+    if lookback_days is None:
+        return None
+    return (index_date - pl.duration(days=lookback_days)).dt.month_start()
+
+
+def flag_categories(disease_files: List[str],
+                    patients_df: pl.DataFrame,
+                    lookup: pl.DataFrame,
+                    categories: List[str],
+                    lookback_days: Optional[int],
+                    cohort_keys: Optional[CohortKeys] = None) -> pl.DataFrame:
+    """
+    疾患カテゴリ毎のフラグを患者単位で作成
+
+    レセプト年月がインデックス日以前、かつ参照期間の開始月以降のレセプトに、
+    インデックス日以前に診療を開始した（診療開始日が空の場合を含む）カテゴリの病名がある場合にTrueとする。
+
+    Returns:
+        pl.DataFrame: patients_df の全患者について kojin_id と categories の順の has_<カテゴリ>（Boolean）
+    """
+    cohort_keys = cohort_keys or CohortKeys.from_frame(patients_df)
+    index_dates = with_date_columns(patients_df.select(["kojin_id", "index_date"]), ["index_date"])
+
+    found = pl.DataFrame(schema={"kojin_id": pl.Int64, "category": pl.String})
+    if disease_files and not lookup.is_empty():
+        records = cohort_keys.restrict(scan_table(disease_files))
+        schema = records.collect_schema()
+        receipt_month = (pl.col("receipt_ym").cast(pl.String) + "/01").str.to_date("%Y/%m/%d")
+        started = date_expr("sinryo_start_ymd", schema["sinryo_start_ymd"]) <= pl.col("index_date")
+        in_window = (receipt_month <= pl.col("index_date")) & started.fill_null(True)
+        window_start = lookback_start_expr(pl.col("index_date"), lookback_days)
+        if window_start is not None:
+            in_window = in_window & (receipt_month >= window_start)
+
+        # 全ファイルを1つの遅延クエリで読み、カテゴリの対応表との1回の結合で判定する
+        found = (records
+                 .select(["kojin_id", pl.col("diseases_code").cast(pl.String), "receipt_ym", "sinryo_start_ymd"])
+                 .join(lookup.lazy(), on="diseases_code", how="inner")
+                 .join(index_dates.lazy(), on="kojin_id", how="inner")
+                 .filter(in_window)
+                 .select(["kojin_id", "category"])
+                 .unique()
+                 .collect(engine="streaming"))
+    logger.debug(f"flag_categories: 参照期間内のカテゴリ該当 (患者, カテゴリ) 数 = {len(found)}")
+
+    flags = (found
+             .group_by("kojin_id")
+             .agg([(pl.col("category") == category).any().alias(f"has_{category}") for category in categories]))
+    return (patients_df
+            .select("kojin_id")
+            .join(flags, on="kojin_id", how="left")
+            .with_columns([pl.col(f"has_{category}").fill_null(False).cast(pl.Boolean) for category in categories]))
@@ -0,0 +1,215 @@
+"""
+Charlson / Elixhauser 併存疾患指数のユーティリティ
+Quan et al. (Med Care 2005) のICD-10コーディングアルゴリズムによる疾患カテゴリと重みを表として持ち、
+comorbidity_engine の対応表・フラグ作成にそのまま渡せる形で提供します。
+指数は、カテゴリ毎のフラグに重みを掛けた和として列演算で計算します
+"""
+
+import logging
+from typing import Dict, List
+
+import polars as pl
+
+logger = logging.getLogger(__name__)
+
+# ICD-10コードはマスター（m_icd10.icd10_code）と同じくピリオドなしで記載する。
+# "I425-I429" のような範囲は、同じ桁数の前方一致コードに展開する
+
+# Charlson（17カテゴリ）
+CHARLSON_ICD10_CODES: Dict[str, List[str]] = {
+    "myocardial_infarction": ["I21", "I22", "I252"],
+    "congestive_heart_failure": ["I099", "I110", "I130", "I132", "I255", "I420", "I425-I429", "I43", "I50", "P290"],
+    "peripheral_vascular_disease": ["I70", "I71", "I731", "I738", "I739", "I771", "I790", "I792",
+                                    "K551", "K558", "K559", "Z958", "Z959"],
+    "cerebrovascular_disease": ["G45", "G46", "H340", "I60-I69"],
+    "dementia": ["F00-F03", "F051", "G30", "G311"],
+    "chronic_pulmonary_disease": ["I278", "I279", "J40-J47", "J60-J67", "J684", "J701", "J703"],
+    "rheumatic_disease": ["M05", "M06", "M315", "M32-M34", "M351", "M353", "M360"],
+    "peptic_ulcer_disease": ["K25-K28"],
+    "mild_liver_disease": ["B18", "K700-K703", "K709", "K713-K715", "K717", "K73", "K74", "K760",
+                           "K762-K764", "K768", "K769", "Z944"],
+    "diabetes_without_complication": ["E100", "E101", "E106", "E108", "E109", "E110", "E111", "E116", "E118", "E119",
+                                      "E120", "E121", "E126", "E128", "E129", "E130", "E131", "E136", "E138", "E139",
+                                      "E140", "E141", "E146", "E148", "E149"],
+    "diabetes_with_complication": ["E102-E105", "E107", "E112-E115", "E117", "E122-E125", "E127",
+                                   "E132-E135", "E137", "E142-E145", "E147"],
+    "hemiplegia_paraplegia": ["G041", "G114", "G801", "G802", "G81", "G82", "G830-G834", "G839"],
+    "renal_disease": ["I120", "I131", "N032-N037", "N052-N057", "N18", "N19", "N250", "Z490-Z492", "Z940", "Z992"],
+    "malignancy": ["C00-C26", "C30-C34", "C37-C41", "C43", "C45-C58", "C60-C76", "C81-C85", "C88", "C90-C97"],
+    "moderate_severe_liver_disease": ["I850", "I859", "I864", "I982", "K704", "K711", "K721", "K729",
+                                      "K765", "K766", "K767"],
+    "metastatic_solid_tumor": ["C77-C80"],
+    "aids_hiv": ["B20-B22", "B24"],
+}
+
+# Charlson et al. (1987) の重み
+CHARLSON_WEIGHTS: Dict[str, int] = {
+    "myocardial_infarction": 1,
+    "congestive_heart_failure": 1,
+    "peripheral_vascular_disease": 1,
+    "cerebrovascular_disease": 1,
+    "dementia": 1,
+    "chronic_pulmonary_disease": 1,
+    "rheumatic_disease": 1,
+    "peptic_ulcer_disease": 1,
+    "mild_liver_disease": 1,
+    "diabetes_without_complication": 1,
+    "diabetes_with_complication": 2,
+    "hemiplegia_paraplegia": 2,
+    "renal_disease": 2,
+    "malignancy": 2,
+    "moderate_severe_liver_disease": 3,
+    "metastatic_solid_tumor": 6,
+    "aids_hiv": 6,
+}
+
+# Elixhauser（31カテゴリ）
+ELIXHAUSER_ICD10_CODES: Dict[str, List[str]] = {
+    "congestive_heart_failure": ["I099", "I110", "I130", "I132", "I255", "I420", "I425-I429", "I43", "I50", "P290"],
+    "cardiac_arrhythmias": ["I441-I443", "I456", "I459", "I47-I49", "R000", "R001", "R008", "T821", "Z450", "Z950"],
+    "valvular_disease": ["A520", "I05-I08", "I091", "I098", "I34-I39", "Q230-Q233", "Z952-Z954"],
+    "pulmonary_circulation_disorders": ["I26", "I27", "I280", "I288", "I289"],
+    "peripheral_vascular_disorders": ["I70", "I71", "I731", "I738", "I739", "I771", "I790", "I792",
+                                      "K551", "K558", "K559", "Z958", "Z959"],
+    "hypertension_uncomplicated": ["I10"],
+    "hypertension_complicated": ["I11-I13", "I15"],
+    "paralysis": ["G041", "G114", "G801", "G802", "G81", "G82", "G830-G834", "G839"],
+    "other_neurological_disorders": ["G10-G13", "G20-G22", "G254", "G255", "G312", "G318", "G319", "G32",
+                                     "G35-G37", "G40", "G41", "G931", "G934", "R470", "R56"],
+    "chronic_pulmonary_disease": ["I278", "I279", "J40-J47", "J60-J67", "J684", "J701", "J703"],
+    "diabetes_uncomplicated": ["E100", "E101", "E109", "E110", "E111", "E119", "E120", "E121", "E129",
+                               "E130", "E131", "E139", "E140", "E141", "E149"],
+    "diabetes_complicated": ["E102-E108", "E112-E118", "E122-E128", "E132-E138", "E142-E148"],
+    "hypothyroidism": ["E00-E03", "E890"],
+    "renal_failure": ["I120", "I131", "N18", "N19", "N250", "Z490-Z492", "Z940", "Z992"],
+    "liver_disease": ["B18", "I85", "I864", "I982", "K70", "K711", "K713-K715", "K717", "K72-K74", "K760",
+                      "K762-K769", "Z944"],
+    "peptic_ulcer_disease": ["K257", "K259", "K267", "K269", "K277", "K279", "K287", "K289"],
+    "aids_hiv": ["B20-B22", "B24"],
+    "lymphoma": ["C81-C85", "C88", "C96", "C900", "C902"],
+    "metastatic_cancer": ["C77-C80"],
+    "solid_tumor_without_metastasis": ["C00-C26", "C30-C34", "C37-C41", "C43", "C45-C58", "C60-C76", "C97"],
+    "rheumatoid_arthritis": ["L940", "L941", "L943", "M05", "M06", "M08", "M120", "M123", "M30", "M310-M313",
+                             "M32-M35", "M45", "M461", "M468", "M469"],
+    "coagulopathy": ["D65-D68", "D691", "D693-D696"],
+    "obesity": ["E66"],
+    "weight_loss": ["E40-E46", "R634", "R64"],
+    "fluid_electrolyte_disorders": ["E222", "E86", "E87"],
+    "blood_loss_anemia": ["D500"],
+    "deficiency_anemia": ["D508", "D509", "D51-D53"],
+    "alcohol_abuse": ["F10", "E52", "G621", "I426", "K292", "K700", "K703", "K709", "T51", "Z502", "Z714", "Z721"],
+    "drug_abuse": ["F11-F16", "F18", "F19", "Z715", "Z722"],
+    "psychoses": ["F20", "F22-F25", "F28", "F29", "F302", "F312", "F315"],
+    "depression": ["F204", "F313-F315", "F32", "F33", "F341", "F412", "F432"],
+}
+
+# van Walraven et al. (2009) の重み
+ELIXHAUSER_WEIGHTS: Dict[str, int] = {
+    "congestive_heart_failure": 7,
+    "cardiac_arrhythmias": 5,
+    "valvular_disease": -1,
+    "pulmonary_circulation_disorders": 4,
+    "peripheral_vascular_disorders": 2,
+    "hypertension_uncomplicated": 0,
+    "hypertension_complicated": 0,
+    "paralysis": 7,
+    "other_neurological_disorders": 6,
+    "chronic_pulmonary_disease": 3,
+    "diabetes_uncomplicated": 0,
+    "diabetes_complicated": 0,
+    "hypothyroidism": 0,
+    "renal_failure": 5,
+    "liver_disease": 11,
+    "peptic_ulcer_disease": 0,
+    "aids_hiv": 0,
+    "lymphoma": 9,
+    "metastatic_cancer": 12,
+    "solid_tumor_without_metastasis": 4,
+    "rheumatoid_arthritis": 0,
+    "coagulopathy": 3,
+    "obesity": -4,
+    "weight_loss": 6,
+    "fluid_electrolyte_disorders": 5,
+    "blood_loss_anemia": -2,
+    "deficiency_anemia": -2,
+    "alcohol_abuse": 0,
+    "drug_abuse": -7,
+    "psychoses": 0,
+    "depression": -3,
+}
+
+# 指数の定義（指数名: カテゴリの接頭辞, コード表, 重み, 上位カテゴリがある場合に数えない下位カテゴリ）
+COMORBIDITY_INDICES = {
+    "charlson": {
+        "prefix": "cci",
+        "codes": CHARLSON_ICD10_CODES,
+        "weights": CHARLSON_WEIGHTS,
+        "hierarchy": {
+            "diabetes_without_complication": "diabetes_with_complication",
+            "mild_liver_disease": "moderate_severe_liver_disease",
+            "malignancy": "metastatic_solid_tumor",
+        },
+    },
+    "elixhauser": {
+        "prefix": "elix",
+        "codes": ELIXHAUSER_ICD10_CODES,
+        "weights": ELIXHAUSER_WEIGHTS,
+        "hierarchy": {
+            "hypertension_uncomplicated": "hypertension_complicated",
+            "diabetes_uncomplicated": "diabetes_complicated",
+            "solid_tumor_without_metastasis": "metastatic_cancer",
+        },
+    },
+}
+
+
+def expand_icd10_codes(codes: List[str]) -> List[str]:
+    """範囲表記（例: "I425-I429"、"C00-C26"）を前方一致用のコードのリストに展開"""
+    expanded = []
+    for code in codes:
+        if "-" not in code:
+            expanded.append(code)
+            continue
+        start, end = code.split("-")
+        if len(start) != len(end) or start[0] != end[0]:
+            raise ValueError(f"不正なICD-10コード範囲です: {code}")
+        width = len(start) - 1
+        expanded.extend(f"{start[0]}{number:0{width}d}" for number in range(int(start[1:]), int(end[1:]) + 1))
+    return expanded
+
+
+def category_name(index_name: str, category: str) -> str:
+    """指数のカテゴリ名（例: cci_dementia）"""
+    return f"{COMORBIDITY_INDICES[index_name]['prefix']}_{category}"
+
+
+def index_category_codes(index_names: List[str]) -> Dict[str, List[str]]:
+    """指数のカテゴリ名 -> ICD-10コードの前方一致リスト（comorbidity_engine.build_category_lookup 用）"""
+    category_codes = {}
+    for index_name in index_names:
+        if index_name not in COMORBIDITY_INDICES:
+            raise ValueError(f"不明な併存疾患指数です: {index_name}")
+        for category, codes in COMORBIDITY_INDICES[index_name]["codes"].items():
+            category_codes[category_name(index_name, category)] = expand_icd10_codes(codes)
+    return category_codes
+
+
+def with_index_scores(flags: pl.DataFrame, index_names: List[str]) -> pl.DataFrame:
+    """カテゴリ毎のフラグ（has_<カテゴリ名>）から指数（<指数名>_index）を計算して追加
+
+    上位カテゴリ（合併症ありの糖尿病、転移性腫瘍等）がある患者では、対応する下位カテゴリは数えない。
+    """
+    score_exprs = []
+    for index_name in index_names:
+        definition = COMORBIDITY_INDICES[index_name]
+        terms = []
+        for category, weight in definition["weights"].items():
+            if weight == 0:
+                continue
+            flag = pl.col(f"has_{category_name(index_name, category)}")
+            superior = definition["hierarchy"].get(category)
+            if superior is not None:
+                flag = flag & ~pl.col(f"has_{category_name(index_name, superior)}")
+            terms.append(flag.cast(pl.Int32) * weight)
+        score_exprs.append(pl.sum_horizontal(terms).cast(pl.Int32).alias(f"{index_name}_index"))
+    return flags.with_columns(score_exprs)
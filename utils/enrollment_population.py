@@ -0,0 +1,160 @@
+"""
+地域別の加入者数と処方患者数（Figure 2 のヒートマップ）のユーティリティ
+加入者全体を読む必要がある分母（地域・年度毎の加入者数）は適用ファイルから一度だけ集計して小さな表として保存し、
+薬剤や年度を変えて再実行する場合は保存した表と処方イベントのみを用います
+"""
+
+import os
+import logging
+from datetime import date
+from typing import List, Optional
+
+import polars as pl
+
+from utils.env_loader import DATA_ROOT_DIR
+from utils.table_io import scan_table
+
+logger = logging.getLogger(__name__)
+
+# 地域・年度毎の加入者数の既定の保存先（ファイル名に観察期間の年月を含める）
+DEFAULT_ENROLLMENT_POPULATION_DIR = os.path.join(DATA_ROOT_DIR, "enrollment_population")
+
+ENROLLMENT_POPULATION_SCHEMA = {
+    "chiiki_code": pl.String,
+    "fiscal_year": pl.Int32,
+    "n_enrollees": pl.UInt32,
+    "person_years": pl.Float64,
+}
+
+PRESCRIBING_RATE_SCHEMA = {
+    "chiiki_code": pl.String,
+    "fiscal_year": pl.Int32,
+    "n_treated_patients": pl.UInt32,
+    "n_enrollees": pl.UInt32,
+    "person_years": pl.Float64,
+    "treated_per_100k": pl.Float64,
+}
+
+
+def month_index(year: int, month: int) -> int:
+    """年月の通し番号（year * 12 + month - 1）"""
+    return year * 12 + month - 1
+
+
+def month_index_expr(column: str, dtype: pl.DataType) -> pl.Expr:
+    """年月（"YYYY/MM" の文字列、またはDate型）の列の通し番号"""
+    value = pl.col(column) if dtype == pl.Date else (pl.col(column).cast(pl.String) + "/01").str.to_date("%Y/%m/%d")
+    return value.dt.year().cast(pl.Int64) * 12 + value.dt.month().cast(pl.Int64) - 1
+
+
+def fiscal_year_of_month(month: pl.Expr) -> pl.Expr:
+    """年月の通し番号から年度（4月始まり）"""
+    return ((month - 3) // 12).cast(pl.Int32)
+
+
+def enrollment_population_path(directory: str, first_month: date, last_month: date) -> str:
+    """観察期間に対応する加入者数の表のパス"""
+    return os.path.join(directory,
+                        f"enrollment_population_{first_month:%Y%m}_{last_month:%Y%m}.feather")
+
+
+def build_enrollment_population(tekiyo_file: str, first_month: date, last_month: date) -> pl.DataFrame:
+    """
+    適用ファイルから地域・年度毎の加入者数を集計（観察可能期間を観察期間で打ち切る）
+
+    観察可能期間が年度と1か月でも重なる加入者（kojin_id の数）をその年度の加入者とし、重なる月数の合計を人年とする。
+    観察可能終了年月が空の加入者は観察期間の最終月まで観察可能とする。
+
+    Returns:
+        pl.DataFrame: chiiki_code, fiscal_year, n_enrollees, person_years（ENROLLMENT_POPULATION_SCHEMA）
+    """
+    first, last = month_index(first_month.year, first_month.month), month_index(last_month.year, last_month.month)
+    lf = scan_table(tekiyo_file)
+    schema = lf.collect_schema()
+    start = pl.max_horizontal(month_index_expr("observable_start_ym", schema["observable_start_ym"]).fill_null(first),
+                              pl.lit(first))
+    end = pl.min_horizontal(month_index_expr("observable_end_ym", schema["observable_end_ym"]).fill_null(last),
+                            pl.lit(last))
+    fiscal_year_start = pl.col("fiscal_year").cast(pl.Int64) * 12 + 3
+    months_in_year = (pl.min_horizontal(pl.col("end"), fiscal_year_start + 11)
+                      - pl.max_horizontal(pl.col("start"), fiscal_year_start) + 1)
+    population = (lf
+                  .select(["kojin_id", pl.col("chiiki_code").cast(pl.String), start.alias("start"), end.alias("end")])
+                  .filter(pl.col("start") <= pl.col("end"))
+                  .with_columns(pl.int_ranges(fiscal_year_of_month(pl.col("start")),
+                                              fiscal_year_of_month(pl.col("end")) + 1,
+                                              dtype=pl.Int32).alias("fiscal_year"))
+                  .explode("fiscal_year", empty_as_null=False)
+                  .group_by(["chiiki_code", "fiscal_year"])
+                  .agg([pl.col("kojin_id").n_unique().alias("n_enrollees"),
+                        (months_in_year.sum() / 12).alias("person_years")])
+                  .sort(["chiiki_code", "fiscal_year"])
+                  .collect(engine="streaming"))
+    return population.cast(ENROLLMENT_POPULATION_SCHEMA)
+
+
+def load_enrollment_population(tekiyo_file: str,
+                               directory: str,
+                               first_month: date,
+                               last_month: date,
+                               rebuild: bool = False) -> pl.DataFrame:
+    """保存した地域・年度毎の加入者数を読み込む（未作成、または適用ファイルの方が新しい場合は集計して保存）"""
+    path = enrollment_population_path(directory, first_month, last_month)
+    if not rebuild and os.path.exists(path) and os.path.getmtime(tekiyo_file) <= os.path.getmtime(path):
+        logger.info(f"保存済みの地域・年度毎の加入者数を使用します: {path}")
+        return pl.read_ipc(path, memory_map=False)
+
+    logger.info("適用ファイルから地域・年度毎の加入者数を集計します")
+    population = build_enrollment_population(tekiyo_file, first_month, last_month)
+    os.makedirs(directory, exist_ok=True)
+    # 書き込み途中のファイルを読まれないよう、一時ファイルに書いてから置き換える
+    tmp_path = path + ".tmp"
+    population.write_ipc(tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+    logger.info(f"地域・年度毎の加入者数を保存しました: {path}")
+    return population
+
+
+def treated_fiscal_years(events: pl.LazyFrame, first_day: date, last_day: date) -> pl.DataFrame:
+    """
+    処方イベントから患者・年度毎の処方数（処方のある年度のみ）
+
+    Returns:
+        pl.DataFrame: kojin_id, fiscal_year, n_fills
+    """
+    shohou_month = pl.col("shohou_ymd").dt.year().cast(pl.Int64) * 12 + pl.col("shohou_ymd").dt.month().cast(pl.Int64) - 1
+    return (events
+            .filter(pl.col("shohou_ymd").is_between(first_day, last_day))
+            .group_by(["kojin_id", fiscal_year_of_month(shohou_month).alias("fiscal_year")])
+            .agg(pl.len().cast(pl.UInt32).alias("n_fills"))
+            .sort(["kojin_id", "fiscal_year"])
+            .collect(engine="streaming"))
+
+
+def prescribing_rates(treated_years: pl.DataFrame,
+                      patient_regions: pl.DataFrame,
+                      population: pl.DataFrame,
+                      fiscal_years: Optional[List[int]] = None) -> pl.DataFrame:
+    """
+    地域・年度毎の処方患者数と加入者10万人あたりの処方患者数（ヒートマップ用、処方のない地域・年度は0）
+
+    Args:
+        treated_years: treated_fiscal_years の結果
+        patient_regions: kojin_id, chiiki_code（コホートの患者の地域）
+        population: 地域・年度毎の加入者数
+        fiscal_years: 対象の年度（Noneの場合は加入者数の表の全年度）
+    """
+    if fiscal_years is not None:
+        population = population.filter(pl.col("fiscal_year").is_in(fiscal_years))
+    treated = (treated_years
+               .join(patient_regions.select(["kojin_id", pl.col("chiiki_code").cast(pl.String)]),
+                     on="kojin_id", how="inner")
+               .group_by(["chiiki_code", "fiscal_year"])
+               .agg(pl.col("kojin_id").n_unique().alias("n_treated_patients")))
+    rates = (population
+             .join(treated, on=["chiiki_code", "fiscal_year"], how="left", nulls_equal=True)
+             .with_columns(pl.col("n_treated_patients").fill_null(0))
+             .with_columns((pl.col("n_treated_patients") / pl.col("n_enrollees") * 100_000).alias("treated_per_100k"))
+             .select(list(PRESCRIBING_RATE_SCHEMA))
+             .sort(["chiiki_code", "fiscal_year"], nulls_last=True))
+    return rates.cast(PRESCRIBING_RATE_SCHEMA)
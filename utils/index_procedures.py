@@ -0,0 +1,155 @@
+"""
+インデックス日の同時算定診療行為（Table 4）の集計ユーティリティ
+患者のインデックスのレセプト（first_receipt_id）を月毎にまとめ、その月の診療行為ファイル
+（receipt_medical_practice）と診療行為算定日ファイル（receipt_medical_practice_santei_ymd）を
+receipt_id をキーに1回ずつ結合します（患者毎の検索は行いません）
+"""
+
+import logging
+from typing import List
+
+import polars as pl
+
+from utils.canonical_schema import date_expr, with_date_columns
+from utils.table_io import scan_table, table_name
+
+logger = logging.getLogger(__name__)
+
+INDEX_PROCEDURE_SCHEMA = {
+    "kojin_id": pl.Int64,
+    "medical_practice_code": pl.String,
+    "medical_practice_name": pl.String,
+    "n_billed": pl.Int64,
+}
+
+PROCEDURE_FREQUENCY_SCHEMA = {
+    "treatment_group": pl.Int32,
+    "rank": pl.UInt32,
+    "medical_practice_code": pl.String,
+    "medical_practice_name": pl.String,
+    "n_patients": pl.UInt32,
+    "n_group_patients": pl.UInt32,
+    "proportion": pl.Float64,
+    "n_billed": pl.Int64,
+}
+
+
+def file_month(path: str) -> str:
+    """月次ファイル名の末尾の年月（YYYYMM）"""
+    return table_name(path).rsplit("_", 1)[-1]
+
+
+def build_practice_names(med_treat: pl.DataFrame) -> pl.DataFrame:
+    """診療行為マスターから medical_practice_code → 名称 の対応表（改定がある場合は最新の版の名称）"""
+    if med_treat is None or med_treat.is_empty():
+        return pl.DataFrame(schema={"medical_practice_code": pl.String, "medical_practice_name": pl.String})
+    return (med_treat
+            .select([pl.col("medical_practice_code").cast(pl.String),
+                     pl.col("medical_practice_name").cast(pl.String),
+                     pl.col("version_code").cast(pl.String)])
+            .sort("version_code", descending=True, nulls_last=True)
+            .unique("medical_practice_code", keep="first", maintain_order=True)
+            .select(["medical_practice_code", "medical_practice_name"]))
+
+
+def collect_index_procedures(practice_files: List[str],
+                             santei_files: List[str],
+                             index_receipts: pl.DataFrame,
+                             practice_names: pl.DataFrame) -> pl.DataFrame:
+    """
+    インデックスのレセプトのうち、インデックス日に算定された診療行為を患者毎に集計
+
+    インデックスのレセプトを含む月のファイルのみを読み込み、月毎に receipt_id の絞り込みと結合を1回ずつ行う。
+    receipt_id 順に保存された正規化済みデータ（Parquet）では、行グループの統計で対象外の行を読み飛ばせる。
+
+    Args:
+        practice_files: 月次の診療行為ファイル
+        santei_files: 月次の診療行為算定日ファイル
+        index_receipts: kojin_id, receipt_id, receipt_month（YYYYMM）, index_date
+        practice_names: medical_practice_code → medical_practice_name
+
+    Returns:
+        pl.DataFrame: kojin_id, medical_practice_code, medical_practice_name（マスターにない場合はnull）,
+                      n_billed（インデックス日の算定回数。算定日ファイルに回数がない場合は行数）
+    """
+    santei_by_month = {file_month(f): f for f in santei_files}
+    index_receipts = with_date_columns(index_receipts, ["index_date"])
+    receipts_by_month = index_receipts.partition_by("receipt_month", as_dict=True, include_key=False)
+
+    monthly = []
+    for practice_file in practice_files:
+        month = file_month(practice_file)
+        receipts = receipts_by_month.get((month,))
+        if receipts is None or month not in santei_by_month:
+            continue
+        receipt_ids = receipts["receipt_id"].unique()
+        keys = receipts.select(["kojin_id", "receipt_id"]).lazy()
+        practice = (scan_table(practice_file)
+                    .filter(pl.col("receipt_id").cast(pl.Int64).is_in(receipt_ids))
+                    .select([pl.col("kojin_id").cast(pl.Int64),
+                             pl.col("receipt_id").cast(pl.Int64),
+                             pl.col("line_no").cast(pl.Int64),
+                             pl.col("medical_practice_code").cast(pl.String)])
+                    .join(keys, on=["kojin_id", "receipt_id"], how="semi"))
+        santei = scan_table(santei_by_month[month])
+        santei_schema = santei.collect_schema()
+        kaisuu = (pl.col("kaisuu").cast(pl.Int64, strict=False).fill_null(1) if "kaisuu" in santei_schema
+                  else pl.lit(1, dtype=pl.Int64))
+        santei = (santei
+                  .filter(pl.col("receipt_id").cast(pl.Int64).is_in(receipt_ids))
+                  .select([pl.col("kojin_id").cast(pl.Int64),
+                           pl.col("receipt_id").cast(pl.Int64),
+                           pl.col("line_no").cast(pl.Int64),
+                           date_expr("santei_ymd", santei_schema["santei_ymd"]).alias("santei_ymd"),
+                           kaisuu.alias("kaisuu")]))
+        monthly.append(practice
+                       .join(santei, on=["kojin_id", "receipt_id", "line_no"], how="inner")
+                       .join(receipts.select(["kojin_id", "receipt_id", "index_date"]).lazy(),
+                             on=["kojin_id", "receipt_id"], how="inner")
+                       .filter(pl.col("santei_ymd") == pl.col("index_date"))
+                       .group_by(["kojin_id", "medical_practice_code"])
+                       .agg(pl.col("kaisuu").sum().alias("n_billed")))
+    logger.debug(f"collect_index_procedures: 対象月 {len(monthly)} / {len(receipts_by_month)}")
+    if not monthly:
+        return pl.DataFrame(schema=INDEX_PROCEDURE_SCHEMA)
+
+    procedures = (pl.concat([lf.collect(engine="streaming") for lf in monthly])
+                  .group_by(["kojin_id", "medical_practice_code"])
+                  .agg(pl.col("n_billed").sum())
+                  .join(practice_names, on="medical_practice_code", how="left")
+                  .select(list(INDEX_PROCEDURE_SCHEMA))
+                  .sort(["kojin_id", "medical_practice_code"]))
+    return procedures.cast(INDEX_PROCEDURE_SCHEMA)
+
+
+def procedure_frequencies(index_procedures: pl.DataFrame,
+                          treatment_groups: pl.DataFrame,
+                          top_n: int) -> pl.DataFrame:
+    """
+    治療群毎の同時算定診療行為の頻度（算定された患者数の多い順に上位 top_n 件）
+
+    Args:
+        index_procedures: collect_index_procedures の結果
+        treatment_groups: kojin_id, treatment_group（治療群の患者数の分母。診療行為のない患者も含む）
+
+    Returns:
+        pl.DataFrame: treatment_group, rank, medical_practice_code, medical_practice_name, n_patients,
+                      n_group_patients, proportion（n_patients / n_group_patients）, n_billed
+    """
+    group_sizes = (treatment_groups
+                   .group_by("treatment_group")
+                   .agg(pl.len().cast(pl.UInt32).alias("n_group_patients")))
+    frequencies = (index_procedures
+                   .join(treatment_groups.select(["kojin_id", "treatment_group"]), on="kojin_id", how="inner")
+                   .group_by(["treatment_group", "medical_practice_code"])
+                   .agg([pl.col("medical_practice_name").first(),
+                         pl.len().cast(pl.UInt32).alias("n_patients"),
+                         pl.col("n_billed").sum()])
+                   .sort(["treatment_group", "n_patients", "medical_practice_code"],
+                         descending=[False, True, False])
+                   .with_columns(pl.int_range(1, pl.len() + 1, dtype=pl.UInt32).over("treatment_group").alias("rank"))
+                   .filter(pl.col("rank") <= top_n)
+                   .join(group_sizes, on="treatment_group", how="left")
+                   .with_columns((pl.col("n_patients") / pl.col("n_group_patients")).alias("proportion")))
+    return frequencies.select(list(PROCEDURE_FREQUENCY_SCHEMA)).cast(PROCEDURE_FREQUENCY_SCHEMA)
+
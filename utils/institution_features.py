@@ -0,0 +1,130 @@
+"""
+医療機関の特徴（Table 2）の作成ユーティリティ
+医療機関マスター（m_hco_med）と標榜科マスター（m_hco_xref_specialty）から
+iryokikan_no → 医療機関種別・病床規模 の対応表を一度だけ作成し、
+患者のレセプトの医療機関（receipt_medical_institution）に1回の結合で付与します
+"""
+
+import logging
+from typing import Dict, List, Optional
+
+import polars as pl
+
+from utils.cohort_keys import CohortKeys
+from utils.table_io import scan_table
+
+logger = logging.getLogger(__name__)
+
+# 施設区分コード（m_hco_med.shisetsu_kbn_code）
+HOSPITAL_KBN_CODE = "11"
+CLINIC_KBN_CODE = "12"
+UNIVERSITY_KBN_CODE = "81"
+
+# 医療機関種別
+INSTITUTION_TYPES = [
+    "university_hospital",              # 大学病院（大学病院フラグ、または施設区分が大学関連施設）
+    "psychiatric_hospital",             # 精神科単科病院（標榜科が精神科系のみの病院）
+    "general_hospital_with_psychiatry", # 精神科のある一般病院
+    "hospital_without_psychiatry",      # 精神科のない病院
+    "psychiatric_clinic",               # 精神科系の標榜科がある診療所
+    "non_psychiatric_clinic",           # 精神科系の標榜科がない診療所
+    "other",                            # 歯科等
+    "unknown",                          # 医療機関マスターにない
+]
+
+INSTITUTION_LOOKUP_SCHEMA = {
+    "iryokikan_no": pl.Int64,
+    "institution_type": pl.String,
+    "bed_size_band": pl.String,
+    "total_byoshousuu_code": pl.String,
+    "dpc_hosp_code": pl.String,
+}
+
+
+def build_institution_lookup(hco_med: Optional[pl.DataFrame],
+                             hco_specialty: Optional[pl.DataFrame],
+                             psychiatric_specialties: List[str],
+                             bed_size_bands: Dict[str, str]) -> pl.DataFrame:
+    """
+    iryokikan_no → 医療機関種別・病床規模 の対応表（医療機関1行）
+
+    標榜科は標準化診療科名（空の場合は標榜診療科名）が psychiatric_specialties に含まれるかで判定する。
+    病床規模は総病床数コードを bed_size_bands で区分に変換する（対応がない場合は "unknown"）。
+    """
+    if hco_med is None or hco_med.is_empty():
+        return pl.DataFrame(schema=INSTITUTION_LOOKUP_SCHEMA)
+
+    specialties = pl.DataFrame(schema={"iryokikan_no": pl.Int64, "n_specialties": pl.UInt32,
+                                       "n_psychiatric": pl.UInt32})
+    if hco_specialty is not None and not hco_specialty.is_empty():
+        name = pl.coalesce(pl.col("std_specialty_name"), pl.col("specialty_name")).str.strip_chars()
+        specialties = (hco_specialty
+                       .select([pl.col("iryokikan_no").cast(pl.Int64), name.alias("specialty")])
+                       .drop_nulls()
+                       .unique()
+                       .group_by("iryokikan_no")
+                       .agg([pl.len().alias("n_specialties"),
+                             pl.col("specialty").is_in(psychiatric_specialties).sum().alias("n_psychiatric")])
+                       .cast({"n_specialties": pl.UInt32, "n_psychiatric": pl.UInt32}))
+
+    kbn = pl.col("shisetsu_kbn_code").cast(pl.String)
+    has_psychiatry = pl.col("n_psychiatric").fill_null(0) > 0
+    psychiatry_only = has_psychiatry & (pl.col("n_psychiatric") == pl.col("n_specialties"))
+    institution_type = (pl.when((pl.col("univ_hosp_flag").cast(pl.String) == "1") | (kbn == UNIVERSITY_KBN_CODE))
+                        .then(pl.lit("university_hospital"))
+                        .when((kbn == HOSPITAL_KBN_CODE) & psychiatry_only)
+                        .then(pl.lit("psychiatric_hospital"))
+                        .when((kbn == HOSPITAL_KBN_CODE) & has_psychiatry)
+                        .then(pl.lit("general_hospital_with_psychiatry"))
+                        .when(kbn == HOSPITAL_KBN_CODE)
+                        .then(pl.lit("hospital_without_psychiatry"))
+                        .when((kbn == CLINIC_KBN_CODE) & has_psychiatry)
+                        .then(pl.lit("psychiatric_clinic"))
+                        .when(kbn == CLINIC_KBN_CODE)
+                        .then(pl.lit("non_psychiatric_clinic"))
+                        .otherwise(pl.lit("other")))
+    bands = pl.DataFrame({"total_byoshousuu_code": list(bed_size_bands),
+                          "bed_size_band": list(bed_size_bands.values())},
+                         schema={"total_byoshousuu_code": pl.String, "bed_size_band": pl.String})
+    lookup = (hco_med
+              .with_columns([pl.col("iryokikan_no").cast(pl.Int64),
+                             pl.col("total_byoshousuu_code").cast(pl.String).str.strip_chars(),
+                             pl.col("dpc_hosp_code").cast(pl.String)])
+              .unique("iryokikan_no", keep="first")
+              .join(specialties, on="iryokikan_no", how="left")
+              .join(bands, on="total_byoshousuu_code", how="left")
+              .with_columns([institution_type.alias("institution_type"),
+                             pl.col("bed_size_band").fill_null("unknown")])
+              .select(list(INSTITUTION_LOOKUP_SCHEMA))
+              .sort("iryokikan_no"))
+    logger.debug(f"build_institution_lookup: 医療機関 {len(lookup)} 件, "
+                 f"種別 {dict(lookup['institution_type'].value_counts().iter_rows())}")
+    return lookup.cast(INSTITUTION_LOOKUP_SCHEMA)
+
+
+def resolve_receipt_institutions(receipts: pl.DataFrame,
+                                 institution_files: List[str],
+                                 cohort_keys: CohortKeys) -> pl.DataFrame:
+    """
+    患者毎のレセプト（kojin_id, receipt_id）の医療機関番号を receipt_medical_institution から取得
+
+    Returns:
+        pl.DataFrame: receipts に iryokikan_no（見つからない場合はnull）を加えたもの
+    """
+    receipts = receipts.with_columns(pl.col("receipt_id").cast(pl.Int64))
+    if not institution_files:
+        return receipts.with_columns(pl.lit(None, dtype=pl.Int64).alias("iryokikan_no"))
+    found = (cohort_keys.restrict(scan_table(institution_files))
+             .select(["kojin_id", pl.col("receipt_id").cast(pl.Int64), pl.col("iryokikan_no").cast(pl.Int64)])
+             .join(receipts.select(["kojin_id", "receipt_id"]).lazy(), on=["kojin_id", "receipt_id"], how="semi")
+             .unique(["kojin_id", "receipt_id"], keep="any")
+             .collect(engine="streaming"))
+    return receipts.join(found, on=["kojin_id", "receipt_id"], how="left")
+
+
+def classify_institutions(receipt_institutions: pl.DataFrame, lookup: pl.DataFrame) -> pl.DataFrame:
+    """医療機関番号に種別・病床規模を1回の結合で付与（マスターにない医療機関は "unknown"）"""
+    return (receipt_institutions
+            .join(lookup, on="iryokikan_no", how="left")
+            .with_columns([pl.col("institution_type").fill_null("unknown"),
+                           pl.col("bed_size_band").fill_null("unknown")]))
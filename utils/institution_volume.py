@@ -0,0 +1,135 @@
+"""
+医療機関毎の年度別F10.2患者数（専門医療機関の判定用）のユーティリティ
+全ての疾患ファイルのF10.2レコードをレセプトの医療機関と結合し、
+(iryokikan_no, fiscal_year, distinct_patients) の小さな表として一度だけ集計・保存します。
+専門医療機関の閾値を変えても、この表の絞り込みだけで判定でき、疾患ファイルを読み直す必要はありません
+"""
+
+import os
+import logging
+from typing import List, Optional
+
+import polars as pl
+
+from utils.env_loader import DATA_ROOT_DIR
+from utils.table_io import scan_table
+
+logger = logging.getLogger(__name__)
+
+# 医療機関別患者数の既定の保存先
+DEFAULT_INSTITUTION_VOLUME_PATH = os.path.join(DATA_ROOT_DIR, "institution_volume", "institution_f10_2_volume.feather")
+
+INSTITUTION_VOLUME_SCHEMA = {
+    "iryokikan_no": pl.Int64,
+    "fiscal_year": pl.Int32,
+    "distinct_patients": pl.UInt32,
+}
+
+# 分位点の補間方法。閾値が実際の患者数のいずれかとなり、保存する分位点の表と一致するよう両方で用いる
+QUANTILE_INTERPOLATION = "higher"
+
+
+def fiscal_year_expr(month_start: pl.Expr) -> pl.Expr:
+    """日付の列から年度（4月始まり）を求める式"""
+    return (month_start.dt.year() - (month_start.dt.month() < 4).cast(pl.Int32)).cast(pl.Int32)
+
+
+def build_institution_volume(disease_files: List[str],
+                             institution_files: List[str],
+                             f10_2_diseases_codes: List[str]) -> pl.DataFrame:
+    """
+    医療機関・年度毎にF10.2レコードのある患者数を集計
+
+    全ファイルを1つの遅延クエリとしてストリーミングで処理し、(医療機関, 年度, 患者) の重複を除いて数える。
+    年度はレセプト年月から求める。
+
+    Returns:
+        pl.DataFrame: iryokikan_no, fiscal_year, distinct_patients（INSTITUTION_VOLUME_SCHEMA）
+    """
+    if not disease_files or not institution_files or not f10_2_diseases_codes:
+        return pl.DataFrame(schema=INSTITUTION_VOLUME_SCHEMA)
+
+    codes = pl.DataFrame({"diseases_code": f10_2_diseases_codes}, schema={"diseases_code": pl.String})
+    receipt_month = (pl.col("receipt_ym").cast(pl.String) + "/01").str.to_date("%Y/%m/%d")
+    records = (scan_table(disease_files)
+               .select([pl.col("kojin_id").cast(pl.Int64),
+                        pl.col("receipt_id").cast(pl.Int64),
+                        pl.col("diseases_code").cast(pl.String),
+                        fiscal_year_expr(receipt_month).alias("fiscal_year")])
+               .join(codes.lazy(), on="diseases_code", how="semi")
+               .select(["kojin_id", "receipt_id", "fiscal_year"]))
+    institutions = (scan_table(institution_files)
+                    .select([pl.col("kojin_id").cast(pl.Int64),
+                             pl.col("receipt_id").cast(pl.Int64),
+                             pl.col("iryokikan_no").cast(pl.Int64)]))
+    volume = (records
+              .join(institutions, on=["kojin_id", "receipt_id"], how="inner")
+              .select(["iryokikan_no", "fiscal_year", "kojin_id"])
+              .unique()
+              .group_by(["iryokikan_no", "fiscal_year"])
+              .agg(pl.len().alias("distinct_patients"))
+              .sort(["iryokikan_no", "fiscal_year"])
+              .collect(engine="streaming"))
+    return volume.cast(INSTITUTION_VOLUME_SCHEMA)
+
+
+def load_institution_volume(path: str) -> Optional[pl.DataFrame]:
+    """医療機関別患者数の読み込み（未作成の場合はNone）"""
+    if not os.path.exists(path):
+        return None
+    return pl.read_ipc(path, memory_map=False)
+
+
+def volume_quantiles(volume: pl.DataFrame, quantiles: List[float]) -> pl.DataFrame:
+    """
+    医療機関・年度毎の患者数の分布の分位点（年度毎、および全年度をまとめたもの）
+
+    Returns:
+        pl.DataFrame: fiscal_year（全年度はnull）, n_institutions, quantile, distinct_patients
+    """
+    def summarize(df: pl.DataFrame, by: Optional[str]) -> pl.DataFrame:
+        aggs = ([pl.len().cast(pl.UInt32).alias("n_institutions")] +
+                [pl.col("distinct_patients").quantile(q, interpolation=QUANTILE_INTERPOLATION).alias(str(q)) for q in quantiles])
+        summary = (df.group_by(by).agg(aggs) if by
+                   else df.select(aggs).with_columns(pl.lit(None, dtype=pl.Int32).alias("fiscal_year")))
+        return summary.unpivot(index=["fiscal_year", "n_institutions"], variable_name="quantile",
+                               value_name="distinct_patients")
+
+    if volume.is_empty():
+        return pl.DataFrame(schema={"fiscal_year": pl.Int32, "n_institutions": pl.UInt32,
+                                    "quantile": pl.Float64, "distinct_patients": pl.Float64})
+    return (pl.concat([summarize(volume, "fiscal_year"), summarize(volume, None)])
+            .with_columns([pl.col("quantile").cast(pl.Float64), pl.col("distinct_patients").cast(pl.Float64)])
+            .sort(["fiscal_year", "quantile"], nulls_last=True))
+
+
+def specialist_threshold(volume: pl.DataFrame, min_patients: Optional[int], quantile: float) -> Optional[int]:
+    """専門医療機関の閾値（min_patients が None の場合は全年度の分布の quantile 分位点）"""
+    if min_patients is not None:
+        return min_patients
+    if volume.is_empty():
+        return None
+    return int(volume["distinct_patients"].quantile(quantile, interpolation=QUANTILE_INTERPOLATION))
+
+
+def specialist_facilities(volume: pl.DataFrame, threshold: int) -> pl.DataFrame:
+    """年度の患者数が閾値以上の (iryokikan_no, fiscal_year)。閾値を変えてもこの絞り込みのみで再判定できる"""
+    return (volume
+            .filter(pl.col("distinct_patients") >= threshold)
+            .select(["iryokikan_no", "fiscal_year"]))
+
+
+def flag_specialist_facilities(df: pl.DataFrame,
+                               specialists: pl.DataFrame,
+                               date_column: str,
+                               flag_column: str = "is_specialist_facility") -> pl.DataFrame:
+    """iryokikan_no と日付の列から、その年度に専門医療機関であったかのフラグを1回の結合で付与"""
+    return (df
+            .with_columns(fiscal_year_expr(pl.col(date_column)).alias("_fiscal_year"))
+            .join(specialists.with_columns(pl.lit(True).alias(flag_column)),
+                  left_on=["iryokikan_no", "_fiscal_year"], right_on=["iryokikan_no", "fiscal_year"], how="left")
+            .with_columns(pl.when(pl.col("iryokikan_no").is_null())
+                          .then(None)
+                          .otherwise(pl.col(flag_column).fill_null(False))
+                          .alias(flag_column))
+            .drop("_fiscal_year"))
@@ -0,0 +1,341 @@
+"""
+レセプト月次パーティションのインデックス用ユーティリティ
+各月次ファイルに含まれるコードと行数をサイドカーファイルに保持し、
+抽出条件に該当し得るファイルだけを読み込めるようにします
+"""
+
+import os
+import logging
+from typing import Dict, List, Optional, Tuple
+
+import polars as pl
+
+from utils.cohort_keys import as_id_series
+from utils.table_io import scan_table
+
+logger = logging.getLogger(__name__)
+
+# パーティションディレクトリ内に置くサイドカーファイル名
+DISEASES_CODE_INDEX_FILENAME = "_diseases_code_index.feather"
+
+DISEASES_CODE_INDEX_SCHEMA = {
+    "file_name": pl.String,
+    "file_size": pl.Int64,
+    "file_mtime": pl.Int64,
+    "diseases_code": pl.String,
+    "n_rows": pl.Int64
+}
+
+
+def get_file_signature(file_path: str) -> Tuple[int, int]:
+    """ファイルの更新検知に使う（サイズ, 更新時刻ns）"""
+    stat = os.stat(file_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def get_diseases_code_index_path(disease_dir: str) -> str:
+    """疾患ファイルディレクトリに対応するインデックスファイルのパス"""
+    return os.path.join(disease_dir, DISEASES_CODE_INDEX_FILENAME)
+
+
+def load_diseases_code_index(disease_dir: str) -> Optional[pl.DataFrame]:
+    """diseases_codeインデックスの読み込み（未作成の場合はNone）"""
+    index_path = get_diseases_code_index_path(disease_dir)
+    if not os.path.exists(index_path):
+        return None
+    return pl.read_ipc(index_path)
+
+
+def _index_diseases_file(file_path: str) -> pl.DataFrame:
+    """1ファイル分のdiseases_code別行数を集計"""
+    file_size, file_mtime = get_file_signature(file_path)
+    counts = (scan_table(file_path)
+              .group_by("diseases_code")
+              .agg(pl.len().cast(pl.Int64).alias("n_rows"))
+              .collect())
+    if counts.is_empty():
+        # 空ファイルもインデックス済みとして記録する
+        counts = pl.DataFrame({"diseases_code": [None], "n_rows": [0]},
+                              schema={"diseases_code": pl.String, "n_rows": pl.Int64})
+    return counts.select([
+        pl.lit(os.path.basename(file_path)).alias("file_name"),
+        pl.lit(file_size, dtype=pl.Int64).alias("file_size"),
+        pl.lit(file_mtime, dtype=pl.Int64).alias("file_mtime"),
+        pl.col("diseases_code").cast(pl.String),
+        pl.col("n_rows")
+    ])
+
+
+def _stale_files(file_paths: List[str], index: Optional[pl.DataFrame]) -> List[str]:
+    """インデックス未登録、またはサイズ・更新時刻が変わったファイルを抽出"""
+    if index is None:
+        return list(file_paths)
+
+    signatures: Dict[str, Tuple[int, int]] = {
+        row[0]: (row[1], row[2])
+        for row in index.select(["file_name", "file_size", "file_mtime"]).unique().iter_rows()
+    }
+    return [f for f in file_paths
+            if signatures.get(os.path.basename(f)) != get_file_signature(f)]
+
+
+def update_diseases_code_index(disease_dir: str, disease_files: List[str]) -> pl.DataFrame:
+    """
+    diseases_codeインデックスを差分更新して保存
+
+    新しく追加された月次ファイルと内容が変わったファイルのみを再集計し、
+    既に存在しないファイルのエントリは削除します。
+
+    Args:
+        disease_dir: 疾患ファイルディレクトリ（インデックスの保存先）
+        disease_files: インデックス対象の疾患ファイルのリスト
+
+    Returns:
+        pl.DataFrame: file_name, file_size, file_mtime, diseases_code, n_rows
+    """
+    index = load_diseases_code_index(disease_dir)
+    stale_files = _stale_files(disease_files, index)
+    current_names = [os.path.basename(f) for f in disease_files]
+    logger.info(f"diseases_codeインデックス: {len(disease_files)} ファイル中 {len(stale_files)} ファイルを集計します")
+
+    parts = []
+    if index is not None:
+        stale_names = [os.path.basename(f) for f in stale_files]
+        parts.append(index.filter(
+            pl.col("file_name").is_in(current_names) & ~pl.col("file_name").is_in(stale_names)
+        ))
+    for file_path in stale_files:
+        parts.append(_index_diseases_file(file_path))
+
+    if parts:
+        index = pl.concat(parts).sort(["file_name", "diseases_code"])
+    else:
+        index = pl.DataFrame(schema=DISEASES_CODE_INDEX_SCHEMA)
+
+    index_path = get_diseases_code_index_path(disease_dir)
+    index.write_ipc(index_path, compression="zstd")
+    logger.info(f"diseases_codeインデックスを保存しました: {index_path} ({len(index)} 行)")
+    return index
+
+
+def select_files_for_codes(disease_files: List[str],
+                           diseases_codes: List[str],
+                           index: Optional[pl.DataFrame]) -> List[str]:
+    """
+    指定したdiseases_codeを含み得る疾患ファイルのみを返す
+
+    インデックスが無い場合、またはインデックス作成後に追加・更新されたファイルは
+    内容が不明なため、常に読み込み対象に含めます。
+    """
+    if index is None:
+        return list(disease_files)
+
+    stale = set(_stale_files(disease_files, index))
+    matching_names = set(index
+                         .filter(pl.col("diseases_code").is_in(diseases_codes))
+                         .get_column("file_name")
+                         .to_list())
+    selected = [f for f in disease_files
+                if f in stale or os.path.basename(f) in matching_names]
+    logger.info(f"diseases_codeインデックスにより読み込み対象を {len(disease_files)} → {len(selected)} ファイルに絞り込みました")
+    return selected
+
+
+# ---------------------------------------------------------------------------
+# kojin_id サマリー（min/max と Bloom フィルタ）
+# ---------------------------------------------------------------------------
+
+# ファイルと同じディレクトリに置くサイドカーファイル名
+KOJIN_ID_SUMMARY_FILENAME = "_kojin_id_summary.feather"
+
+# Bloom フィルタのパラメータ（1キーあたり10ビット・7ハッシュで偽陽性率は約1%）
+BLOOM_BITS_PER_KEY = 10
+BLOOM_NUM_HASHES = 7
+
+KOJIN_ID_SUMMARY_SCHEMA = {
+    "file_name": pl.String,
+    "file_size": pl.Int64,
+    "file_mtime": pl.Int64,
+    "n_rows": pl.Int64,
+    "n_kojin_ids": pl.Int64,
+    "kojin_id_min": pl.Int64,
+    "kojin_id_max": pl.Int64,
+    "bloom_num_bits": pl.Int64,
+    "bloom_bits": pl.List(pl.UInt8)
+}
+
+_BIT_MASKS = pl.Series("mask", [1 << i for i in range(8)], dtype=pl.UInt8)
+
+
+def mix64(x: pl.Expr) -> pl.Expr:
+    """splitmix64 のファイナライザ（Polarsのバージョンに依存しない安定したハッシュ）"""
+    def shift_xor(z: pl.Expr, bits: int) -> pl.Expr:
+        return z.xor(z // pl.lit(1 << bits, dtype=pl.UInt64))
+
+    z = x + pl.lit(0x9E3779B97F4A7C15, dtype=pl.UInt64)
+    z = shift_xor(z, 30) * pl.lit(0xBF58476D1CE4E5B9, dtype=pl.UInt64)
+    z = shift_xor(z, 27) * pl.lit(0x94D049BB133111EB, dtype=pl.UInt64)
+    return shift_xor(z, 31)
+
+
+def _bloom_positions(kojin_ids: pl.Series, num_bits: int) -> pl.DataFrame:
+    """各kojin_idのBloomフィルタ上のビット位置（kojin_id, pos）を二重ハッシュで計算"""
+    ids = pl.DataFrame({"kojin_id": kojin_ids}).with_columns(
+        pl.col("kojin_id").cast(pl.Int64).reinterpret(signed=False).alias("_key")
+    )
+    hashed = ids.with_columns([
+        mix64(pl.col("_key")).alias("_h1"),
+        (mix64(pl.col("_key").xor(pl.lit(0x5851F42D4C957F2D, dtype=pl.UInt64))) | 1).alias("_h2")
+    ])
+    # num_bits は2のべき乗なので、剰余はビットマスクで計算できる
+    mask = pl.lit(num_bits - 1, dtype=pl.UInt64)
+    return (pl.concat([
+        hashed.select([
+            "kojin_id",
+            ((pl.col("_h1") + pl.col("_h2") * pl.lit(i, dtype=pl.UInt64)) & mask).cast(pl.Int64).alias("pos")
+        ])
+        for i in range(BLOOM_NUM_HASHES)
+    ]))
+
+
+def build_bloom_bits(kojin_ids: pl.Series) -> Tuple[int, pl.Series]:
+    """kojin_idの集合からBloomフィルタのビット列（UInt8配列）を作成"""
+    num_bits = 8
+    while num_bits < max(1, len(kojin_ids)) * BLOOM_BITS_PER_KEY:
+        num_bits *= 2
+
+    positions = _bloom_positions(kojin_ids, num_bits).get_column("pos")
+    set_bytes = (pl.DataFrame({
+                    "byte": positions // 8,
+                    "mask": _BIT_MASKS.gather(positions % 8)
+                 })
+                 .group_by("byte")
+                 .agg(pl.col("mask").bitwise_or()))
+    bits = pl.zeros(num_bits // 8, pl.UInt8, eager=True).scatter(set_bytes["byte"], set_bytes["mask"])
+    return num_bits, bits
+
+
+def bloom_may_contain(num_bits: int, bits: pl.Series, kojin_ids: pl.Series) -> pl.Series:
+    """各kojin_idがBloomフィルタに含まれ得るか（偽陽性あり・偽陰性なし）"""
+    positions = _bloom_positions(kojin_ids, num_bits)
+    pos = positions.get_column("pos")
+    hit = (bits.gather(pos // 8) & _BIT_MASKS.gather(pos % 8)) > 0
+    return (positions
+            .with_columns(hit.alias("hit"))
+            .group_by("kojin_id", maintain_order=True)
+            .agg(pl.col("hit").all())
+            .get_column("hit"))
+
+
+def _summarize_kojin_ids(file_path: str) -> pl.DataFrame:
+    """1ファイル分のkojin_idサマリーを作成"""
+    file_size, file_mtime = get_file_signature(file_path)
+    lf = scan_table(file_path)
+    n_rows = lf.select(pl.len()).collect().item()
+    kojin_ids = (lf.select(pl.col("kojin_id").cast(pl.Int64, strict=False))
+                 .drop_nulls()
+                 .unique()
+                 .collect()
+                 .get_column("kojin_id"))
+    num_bits, bits = build_bloom_bits(kojin_ids)
+    return pl.DataFrame({
+        "file_name": [os.path.basename(file_path)],
+        "file_size": [file_size],
+        "file_mtime": [file_mtime],
+        "n_rows": [n_rows],
+        "n_kojin_ids": [len(kojin_ids)],
+        "kojin_id_min": [kojin_ids.min()],
+        "kojin_id_max": [kojin_ids.max()],
+        "bloom_num_bits": [num_bits],
+        "bloom_bits": [bits]
+    }, schema=KOJIN_ID_SUMMARY_SCHEMA)
+
+
+def get_kojin_id_summary_path(directory: str) -> str:
+    """ディレクトリに対応するkojin_idサマリーファイルのパス"""
+    return os.path.join(directory, KOJIN_ID_SUMMARY_FILENAME)
+
+
+def load_kojin_id_summary(directory: str) -> Optional[pl.DataFrame]:
+    """kojin_idサマリーの読み込み（未作成の場合はNone）"""
+    summary_path = get_kojin_id_summary_path(directory)
+    if not os.path.exists(summary_path):
+        return None
+    return pl.read_ipc(summary_path)
+
+
+def update_kojin_id_summary(directory: str, file_paths: List[str]) -> pl.DataFrame:
+    """
+    ファイル毎のkojin_idサマリー（min/max・Bloomフィルタ）を差分更新して保存
+
+    同じディレクトリにある別種のファイル（例: raw/ 直下の健診ファイル）の
+    エントリは保持したまま、指定ファイルのエントリのみを更新します。
+
+    Args:
+        directory: 対象ファイルのディレクトリ（サマリーの保存先）
+        file_paths: サマリーを作成するファイルのリスト
+
+    Returns:
+        pl.DataFrame: ファイル毎のkojin_idサマリー
+    """
+    summary = load_kojin_id_summary(directory)
+    stale_files = _stale_files(file_paths, summary)
+    stale_names = [os.path.basename(f) for f in stale_files]
+    logger.info(f"kojin_idサマリー: {len(file_paths)} ファイル中 {len(stale_files)} ファイルを集計します")
+
+    parts = []
+    if summary is not None:
+        # 既に存在しないファイルのエントリは削除する
+        existing_names = [name for name in summary["file_name"].to_list()
+                          if os.path.exists(os.path.join(directory, name))]
+        parts.append(summary.filter(
+            pl.col("file_name").is_in(existing_names) & ~pl.col("file_name").is_in(stale_names)
+        ))
+    for file_path in stale_files:
+        parts.append(_summarize_kojin_ids(file_path))
+
+    if parts:
+        summary = pl.concat(parts).sort("file_name")
+    else:
+        summary = pl.DataFrame(schema=KOJIN_ID_SUMMARY_SCHEMA)
+
+    summary_path = get_kojin_id_summary_path(directory)
+    summary.write_ipc(summary_path, compression="zstd")
+    logger.info(f"kojin_idサマリーを保存しました: {summary_path} ({len(summary)} ファイル)")
+    return summary
+
+
+def select_files_for_patients(file_paths: List[str],
+                              patient_ids,
+                              summary: Optional[pl.DataFrame]) -> List[str]:
+    """
+    指定した患者を含み得るファイルのみを返す
+
+    kojin_idのmin/max範囲で判定した後、範囲内の患者についてBloomフィルタを確認します。
+    サマリーが無い場合、またはサマリー作成後に追加・更新されたファイルは常に読み込み対象に含めます。
+    """
+    if summary is None:
+        return list(file_paths)
+
+    cohort_ids = as_id_series(patient_ids)
+    stale = set(_stale_files(file_paths, summary))
+    # bloom_bitsはSeriesのまま取り出すため、行番号で参照する
+    entries = {name: i for i, name in enumerate(summary["file_name"].to_list())}
+
+    selected = []
+    for file_path in file_paths:
+        row = entries.get(os.path.basename(file_path))
+        if file_path in stale or row is None:
+            selected.append(file_path)
+            continue
+        if summary["n_kojin_ids"][row] == 0:
+            continue
+        in_range = cohort_ids.filter(cohort_ids.is_between(summary["kojin_id_min"][row],
+                                                           summary["kojin_id_max"][row]))
+        if in_range.is_empty():
+            continue
+        if bloom_may_contain(summary["bloom_num_bits"][row], summary["bloom_bits"][row], in_range).any():
+            selected.append(file_path)
+
+    logger.info(f"kojin_idサマリーにより読み込み対象を {len(file_paths)} → {len(selected)} ファイルに絞り込みました")
+    return selected
@@ -0,0 +1,102 @@
+"""
+kojin_idのハッシュによるバケット分割レイアウト用ユーティリティ
+月次ファイルを患者単位のバケットに並べ替えたデータセットの配置と、
+コホートの患者が属するバケットの特定を行います
+"""
+
+import os
+import json
+import logging
+from typing import Dict, Iterable, List, Optional, Union
+
+import polars as pl
+
+from utils.env_loader import DATA_ROOT_DIR
+from utils.cohort_keys import CohortKeys, as_id_series
+from utils.partition_index import get_file_signature, mix64
+from utils.table_io import list_table_files
+
+logger = logging.getLogger(__name__)
+
+# バケットデータセットの既定の出力先
+DEFAULT_BUCKET_ROOT_DIR = os.path.join(DATA_ROOT_DIR, "bucketed")
+
+# バケットデータセットのルートに置くレイアウト情報
+LAYOUT_FILENAME = "_bucket_layout.json"
+
+DEFAULT_NUM_BUCKETS = 64
+
+# バケット化する月次データセット（ディレクトリ名: 月次ファイルの接頭辞とバケット内の並び順）
+BUCKETED_DATASETS: Dict[str, Dict] = {
+    "receipt_drug": {
+        "prefix": "receipt_drug_",
+        "sort_keys": ["kojin_id", "receipt_ym", "receipt_id", "line_no"]
+    },
+    "receipt_drug_santei_ymd": {
+        "prefix": "receipt_drug_santei_ymd_",
+        "sort_keys": ["kojin_id", "shohou_ymd", "receipt_id", "line_no"]
+    },
+    "receipt_diseases": {
+        "prefix": "receipt_diseases",
+        "sort_keys": ["kojin_id", "sinryo_start_ymd", "receipt_ym"]
+    }
+}
+
+
+def bucket_expr(num_buckets: int) -> pl.Expr:
+    """kojin_idからバケット番号を計算する式（Polarsのバージョンに依存しない）"""
+    key = pl.col("kojin_id").cast(pl.Int64).reinterpret(signed=False)
+    return (mix64(key) % pl.lit(num_buckets, dtype=pl.UInt64)).cast(pl.Int32).alias("bucket")
+
+
+def get_bucket_file_path(bucket_root: str, dataset: str, bucket: int) -> str:
+    """バケットファイルのパス"""
+    return os.path.join(bucket_root, dataset, f"{dataset}_bucket_{bucket:03d}.feather")
+
+
+def load_bucket_layout(bucket_root: str) -> Optional[Dict]:
+    """レイアウト情報の読み込み（バケットデータセットが未作成の場合はNone）"""
+    layout_path = os.path.join(bucket_root, LAYOUT_FILENAME)
+    if not os.path.exists(layout_path):
+        return None
+    with open(layout_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_bucket_layout(bucket_root: str, layout: Dict):
+    """レイアウト情報の保存（全バケットの書き込み完了後に呼び出す）"""
+    layout_path = os.path.join(bucket_root, LAYOUT_FILENAME)
+    with open(layout_path, "w", encoding="utf-8") as f:
+        json.dump(layout, f, ensure_ascii=False, indent=2)
+
+
+def list_monthly_files(source_dir: str, prefix: str) -> List[str]:
+    """バケット化の元の月次ファイルのリスト（feather・Parquet。ディレクトリがない場合は空）"""
+    return list_table_files(source_dir, prefix)
+
+
+def get_source_signatures(monthly_files: List[str]) -> Dict[str, List[int]]:
+    """月次ファイル毎の [サイズ, 更新時刻ns]（レイアウト情報に記録し、読み込み時に元ファイルと照合する）"""
+    return {os.path.basename(f): list(get_file_signature(f)) for f in monthly_files}
+
+
+def is_bucket_dataset_current(dataset_layout: Dict, prefix: str) -> bool:
+    """バケットデータセットが元の月次ファイル（ファイルの一覧とサイズ・更新時刻）と一致するか"""
+    source_dir = dataset_layout.get("source_dir")
+    recorded = dataset_layout.get("source_signatures")
+    if source_dir is None or recorded is None:
+        # 元ファイルの情報を記録していない古いレイアウトは照合できないため、一致しないものとする
+        return False
+    return get_source_signatures(list_monthly_files(source_dir, prefix)) == recorded
+
+
+def stale_bucket_datasets(layout: Dict, datasets: Iterable[str]) -> List[str]:
+    """作成後に元の月次ファイルが追加・更新・削除されたバケットデータセット"""
+    return [dataset for dataset in datasets
+            if not is_bucket_dataset_current(layout["datasets"][dataset], BUCKETED_DATASETS[dataset]["prefix"])]
+
+
+def buckets_for_patients(patient_ids: Union[CohortKeys, Iterable], num_buckets: int) -> List[int]:
+    """患者が属するバケット番号の一覧"""
+    ids = pl.DataFrame({"kojin_id": as_id_series(patient_ids)})
+    return sorted(ids.select(bucket_expr(num_buckets)).get_column("bucket").unique().to_list())
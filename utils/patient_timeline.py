@@ -0,0 +1,136 @@
+"""
+患者毎のイベントタイムライン（Figure 3 のswim-laneプロット）のユーティリティ
+F10.2の算定月・処方・健診・転院をコホートの患者について一度だけ1つの表にまとめ、
+患者順に並べた型付きの列（イベント種別、インデックス日からの日数、薬剤）と、
+患者毎の開始位置・件数（CSR形式のオフセット）として保存します。
+任意の患者の抽出は、メモリマップした列のその患者の範囲の切り出しのみで行います
+"""
+
+import logging
+from typing import Iterable, List, Optional, Tuple
+
+import polars as pl
+
+from utils.canonical_schema import with_date_columns
+from utils.table_io import read_table
+
+logger = logging.getLogger(__name__)
+
+# イベント種別（同じ日のイベントはこの順に並べる）
+TIMELINE_EVENT_TYPES = [
+    "index_diagnosis",     # インデックス日（F10.2の初回）
+    "f10_2_diagnosis",     # F10.2の算定月（月初日）
+    "prescription",        # 対象薬剤の処方
+    "exam",                # 健診
+    "institution_change",  # 転院（転院先の最初の算定月の月初日）
+]
+
+TIMELINE_OFFSET_SCHEMA = {
+    "kojin_id": pl.Int64,
+    "offset": pl.UInt64,
+    "n_events": pl.UInt32,
+}
+
+
+def timeline_event_schema(drug_classes: List[str]) -> dict:
+    """タイムラインのイベントの列の型（イベント種別・薬剤はEnum）"""
+    return {
+        "kojin_id": pl.Int64,
+        "event_type": pl.Enum(TIMELINE_EVENT_TYPES),
+        "day_offset": pl.Int32,
+        "drug_class": pl.Enum(drug_classes),
+    }
+
+
+def build_timeline_events(index_dates: pl.DataFrame,
+                          diagnosis_months: Optional[pl.DataFrame],
+                          fills: Optional[pl.DataFrame],
+                          exams: Optional[pl.DataFrame],
+                          transfers: Optional[pl.DataFrame],
+                          drug_classes: List[str]) -> pl.DataFrame:
+    """
+    各データセットのイベントを1つの表にまとめる（ないデータセットはNone）
+
+    Args:
+        index_dates: kojin_id, index_date
+        diagnosis_months: kojin_id, month_start（F10.2の算定月）
+        fills: kojin_id, shohou_ymd, drug_class
+        exams: kojin_id, exam_ymd
+        transfers: kojin_id, transfer_month
+
+    Returns:
+        pl.DataFrame: kojin_id, event_type, day_offset（インデックス日からの日数。前は負）, drug_class（処方以外はnull）を
+                      kojin_id, day_offset, event_type の順に並べたもの
+    """
+    schema = timeline_event_schema(drug_classes)
+    index_dates = with_date_columns(index_dates.select(["kojin_id", "index_date"]), ["index_date"])
+    sources = [(index_dates.select(["kojin_id", pl.col("index_date").alias("event_date")]), "index_diagnosis")]
+    if diagnosis_months is not None:
+        sources.append((diagnosis_months.select(["kojin_id", pl.col("month_start").alias("event_date")]),
+                        "f10_2_diagnosis"))
+    if fills is not None:
+        sources.append((fills.select(["kojin_id", pl.col("shohou_ymd").alias("event_date"), "drug_class"]),
+                        "prescription"))
+    if exams is not None:
+        sources.append((exams.select(["kojin_id", pl.col("exam_ymd").alias("event_date")]).drop_nulls(), "exam"))
+    if transfers is not None:
+        sources.append((transfers.select(["kojin_id", pl.col("transfer_month").alias("event_date")]),
+                        "institution_change"))
+
+    events = pl.concat([
+        df.with_columns(pl.lit(event_type).alias("event_type"))
+          .select(["kojin_id", "event_type", "event_date",
+                   pl.col("drug_class") if "drug_class" in df.columns else pl.lit(None, dtype=pl.String).alias("drug_class")])
+        for df, event_type in sources
+    ])
+    return (events
+            .join(index_dates, on="kojin_id", how="inner")
+            .with_columns((pl.col("event_date") - pl.col("index_date")).dt.total_days().alias("day_offset"))
+            .select(list(schema))
+            .cast(schema)
+            .sort(["kojin_id", "day_offset", "event_type"]))
+
+
+def timeline_offsets(events: pl.DataFrame) -> pl.DataFrame:
+    """患者順に並んだイベントの、患者毎の開始位置と件数（CSR形式のオフセット）"""
+    return (events
+            .group_by("kojin_id", maintain_order=True)
+            .agg(pl.len().alias("n_events"))
+            .with_columns((pl.col("n_events").cum_sum() - pl.col("n_events")).alias("offset"))
+            .select(list(TIMELINE_OFFSET_SCHEMA))
+            .cast(TIMELINE_OFFSET_SCHEMA))
+
+
+def to_timeline_store(events: pl.DataFrame) -> Tuple[pl.DataFrame, pl.DataFrame]:
+    """
+    イベントの表を保存用の (イベントの列, オフセット) に分ける
+
+    イベントは kojin_id, day_offset, event_type の順に並べ直し、患者はオフセットの表のみに持たせる。
+    """
+    events = events.sort(["kojin_id", "day_offset", "event_type"])
+    return events.drop("kojin_id"), timeline_offsets(events)
+
+
+def slice_timelines(events: pl.DataFrame, offsets: pl.DataFrame, kojin_ids: Iterable) -> pl.DataFrame:
+    """
+    指定した患者のイベントをオフセットの範囲の切り出しで取得（読み込むのはその患者のイベントのみ）
+
+    Args:
+        events: 保存したイベントの列（メモリマップで読み込んだもの）
+        offsets: 保存したオフセット
+
+    Returns:
+        pl.DataFrame: kojin_id, event_type, day_offset, drug_class（指定した患者の順）
+    """
+    ids = pl.DataFrame({"kojin_id": list(kojin_ids)}, schema={"kojin_id": pl.Int64})
+    selected = ids.join(offsets, on="kojin_id", how="inner", maintain_order="left")
+    parts = [events.slice(offset, n_events).with_columns(pl.lit(kojin_id, dtype=pl.Int64).alias("kojin_id"))
+             for kojin_id, offset, n_events in selected.iter_rows()]
+    if not parts:
+        return pl.DataFrame(schema={"kojin_id": pl.Int64, **events.schema})
+    return pl.concat(parts).select(["kojin_id"] + events.columns)
+
+
+def load_patient_timelines(events_path: str, offsets_path: str, kojin_ids: Iterable) -> pl.DataFrame:
+    """保存したタイムラインから指定した患者のイベントを取得（イベントの列は .arrow のためメモリマップで読み込む）"""
+    return slice_timelines(read_table(events_path), read_table(offsets_path), kojin_ids)
@@ -0,0 +1,201 @@
+"""
+処方イベントデータセット用ユーティリティ
+月次の薬剤ファイル（receipt_drug）と薬剤算定日ファイル（receipt_drug_santei_ymd）を
+一度だけ結合し、型を揃えて並べ替えた処方イベントとして保存・読み込みします
+"""
+
+import os
+import logging
+from typing import List, Optional, Sequence, Tuple
+
+import polars as pl
+
+from utils.env_loader import DATA_ROOT_DIR
+from utils.canonical_schema import with_date_columns
+from utils.table_io import find_table, list_table_files, scan_table, table_name
+
+logger = logging.getLogger(__name__)
+
+# 処方イベントデータセットの既定の出力先
+DEFAULT_PRESCRIPTION_EVENTS_DIR = os.path.join(DATA_ROOT_DIR, "prescription_events")
+
+# 処方イベントの作成元（月次の薬剤ファイルと薬剤算定日ファイルを置く raw/ 配下）
+DEFAULT_PRESCRIPTION_EVENT_SOURCE_DIR = os.path.join(DATA_ROOT_DIR, "raw")
+
+PRESCRIPTION_EVENTS_PREFIX = "prescription_events_"
+
+# 処方イベントのカラム（並び順もこの順）
+# days_supply は算定日ファイルの回数（kaisuu、内服薬では処方日数）。算定日ファイルにない場合はnull
+PRESCRIPTION_EVENT_COLUMNS = ["kojin_id", "shohou_ymd", "drug_code", "receipt_id", "line_no", "days_supply"]
+
+
+def get_santei_file_path(drug_file: str, santei_dir: str) -> str:
+    """薬剤ファイルに対応する薬剤算定日ファイルのパス（拡張子を問わず探し、ない場合は薬剤ファイルと同じ拡張子）"""
+    santei_filename = os.path.basename(drug_file).replace("receipt_drug_", "receipt_drug_santei_ymd_")
+    return find_table(santei_dir, table_name(santei_filename)) or os.path.join(santei_dir, santei_filename)
+
+
+def get_event_file_path(drug_file: str, events_dir: str) -> str:
+    """薬剤ファイルに対応する処方イベントファイルのパス（年月部分を引き継ぐ。薬剤ファイルの形式によらずfeather）"""
+    event_name = table_name(drug_file).replace("receipt_drug_", PRESCRIPTION_EVENTS_PREFIX)
+    return os.path.join(events_dir, event_name + ".feather")
+
+
+def list_source_drug_files(source_dir: str) -> List[str]:
+    """処方イベントの作成元の薬剤ファイルのリスト（feather・Parquet。未作成の場合は空）"""
+    return list_table_files(os.path.join(source_dir, "receipt_drug"), "receipt_drug_")
+
+
+def join_monthly_sources(drug_file: str, santei_file: str) -> pl.LazyFrame:
+    """
+    1か月分の薬剤ファイルと算定日ファイルを結合する遅延クエリ（処方日が空・解析できない行も含む）
+
+    Returns:
+        pl.LazyFrame: PRESCRIPTION_EVENT_COLUMNS と kaisuu_invalid（回数が数値に変換できず days_supply を null とした行）
+    """
+    df_drug = (scan_table(drug_file)
+               .select([
+                   pl.col("kojin_id").cast(pl.Int64),
+                   pl.col("receipt_id").cast(pl.Int64),
+                   pl.col("line_no").cast(pl.Int64),
+                   "drug_code"
+               ]))
+    df_santei = scan_table(santei_file)
+    if "kaisuu" in df_santei.collect_schema():
+        days_supply = pl.col("kaisuu").cast(pl.Float64, strict=False)
+        kaisuu_invalid = pl.col("kaisuu").is_not_null() & days_supply.is_null()
+    else:
+        days_supply, kaisuu_invalid = pl.lit(None, dtype=pl.Float64), pl.lit(False)
+    df_santei = df_santei.select([
+        pl.col("kojin_id").cast(pl.Int64),
+        pl.col("receipt_id").cast(pl.Int64),
+        pl.col("line_no").cast(pl.Int64),
+        "shohou_ymd",
+        days_supply.alias("days_supply"),
+        kaisuu_invalid.alias("kaisuu_invalid")
+    ])
+    # 処方日を解析できない行は null として残し、作成時に件数を記録して除外する
+    df_santei = with_date_columns(df_santei, ["shohou_ymd"], strict=False)
+    return (df_drug
+            .join(df_santei, on=["kojin_id", "receipt_id", "line_no"], how="inner")
+            .select(PRESCRIPTION_EVENT_COLUMNS + ["kaisuu_invalid"]))
+
+
+def scan_monthly_prescription_events(drug_file: str, santei_file: str) -> pl.LazyFrame:
+    """
+    1か月分の薬剤ファイルと算定日ファイルを結合する遅延クエリ（処方日のない行は除き、並べ替えは行わない）
+
+    Returns:
+        pl.LazyFrame: kojin_id(Int64), shohou_ymd(Date), drug_code, receipt_id(Int64), line_no(Int64),
+                      days_supply(Float64)
+    """
+    return (join_monthly_sources(drug_file, santei_file)
+            .filter(pl.col("shohou_ymd").is_not_null())
+            .select(PRESCRIPTION_EVENT_COLUMNS))
+
+
+def build_monthly_prescription_events(drug_file: str, santei_file: str) -> pl.DataFrame:
+    """
+    1か月分の薬剤ファイルと算定日ファイルを結合して処方イベントを作成
+
+    処方日が空・日付として解析できない行は除外し、回数が数値に変換できない行は days_supply を null とする。
+    いずれも該当する行数を月毎にログに出力する。
+
+    Returns:
+        pl.DataFrame: scan_monthly_prescription_events の結果を kojin_id, shohou_ymd の順に並べたもの
+    """
+    joined = join_monthly_sources(drug_file, santei_file).collect()
+    events = joined.filter(pl.col("shohou_ymd").is_not_null())
+    n_dropped = len(joined) - len(events)
+    n_nulled = events["kaisuu_invalid"].sum()
+    if n_dropped or n_nulled:
+        logger.warning(f"{os.path.basename(drug_file)}: 処方日が空または解析できない {n_dropped} 行を除外し、"
+                       f"回数（kaisuu）が数値に変換できない {n_nulled} 行の days_supply を null としました")
+    return (events
+            .select(PRESCRIPTION_EVENT_COLUMNS)
+            .sort(["kojin_id", "shohou_ymd", "receipt_id", "line_no"]))
+
+
+def list_prescription_event_files(events_dir: str) -> List[str]:
+    """処方イベントファイルのリスト（未作成の場合は空）"""
+    return list_table_files(events_dir, PRESCRIPTION_EVENTS_PREFIX)
+
+
+def has_event_columns(event_file: str) -> bool:
+    """イベントファイルが現在の処方イベントのカラムを全て持つか（古い形式のファイルは再作成が必要）"""
+    schema = scan_table(event_file).collect_schema()
+    return all(column in schema for column in PRESCRIPTION_EVENT_COLUMNS)
+
+
+def is_event_file_current(event_file: str, source_files: List[str]) -> bool:
+    """イベントファイルが元ファイルより新しく、現在のカラムを全て持つか"""
+    if not os.path.exists(event_file):
+        return False
+    event_mtime = os.path.getmtime(event_file)
+    return (all(os.path.getmtime(f) <= event_mtime for f in source_files)
+            and has_event_columns(event_file))
+
+
+def resolve_prescription_event_sources(events_dir: str,
+                                       source_dir: str) -> Tuple[List[str], List[Tuple[str, str]]]:
+    """
+    作成元の月次ファイルと照合し、読み込む処方イベントファイルと、イベントファイルが使えない月の作成元を返す
+
+    作成元より古い、現在のカラムを持たない、または作成後に追加された月は (薬剤ファイル, 算定日ファイル) として返し、
+    作成元が削除された月のイベントファイルは読み込まない。作成元が見つからない場合は照合せずに全イベントファイルを返す。
+
+    Returns:
+        Tuple[List[str], List[Tuple[str, str]]]: (作成元と一致するイベントファイル, 作成元から結合する月の元ファイル)
+    """
+    event_files = list_prescription_event_files(events_dir)
+    if not event_files:
+        return [], []
+    drug_files = list_source_drug_files(source_dir)
+    if not drug_files:
+        logger.warning(f"処方イベントの作成元が見つからないため、イベントファイルを照合せずに使用します: {source_dir}")
+        return event_files, []
+
+    santei_dir = os.path.join(source_dir, "receipt_drug_santei_ymd")
+    current, stale = [], []
+    for drug_file in drug_files:
+        santei_file = get_santei_file_path(drug_file, santei_dir)
+        if not os.path.exists(santei_file):
+            # 作成時と同じく、算定日ファイルのない月は処方イベントを作成できない
+            continue
+        event_file = get_event_file_path(drug_file, events_dir)
+        if is_event_file_current(event_file, [drug_file, santei_file]):
+            current.append(event_file)
+        else:
+            stale.append((drug_file, santei_file))
+
+    n_orphaned = len(set(event_files) - set(current) - {get_event_file_path(d, events_dir) for d, _ in stale})
+    if stale or n_orphaned:
+        logger.warning(f"処方イベントデータセットが作成元の月次ファイルと一致しません（未作成・更新 {len(stale)} か月、"
+                       f"作成元の削除 {n_orphaned} か月）。該当月は作成元から結合して読み込みます"
+                       f"（build_prescription_events.py を再実行してください）")
+    return current, stale
+
+
+def scan_event_file(event_file: str) -> pl.LazyFrame:
+    """イベントファイルのスキャン（days_supply 追加前に作成したファイルは days_supply を null とする）"""
+    lf = scan_table(event_file)
+    if "days_supply" not in lf.collect_schema():
+        lf = lf.with_columns(pl.lit(None, dtype=pl.Float64).alias("days_supply"))
+    return lf.select(PRESCRIPTION_EVENT_COLUMNS)
+
+
+def scan_prescription_events(event_files: List[str],
+                             drug_codes: Optional[List] = None,
+                             stale_sources: Sequence[Tuple[str, str]] = ()) -> pl.LazyFrame:
+    """
+    処方イベントを1つの遅延クエリとしてスキャン（drug_codesを指定すると該当薬剤のみ）
+
+    stale_sources（resolve_prescription_event_sources の結果）の月は、作成元の薬剤・算定日ファイルを結合して加える。
+    作成元がなく古い形式のイベントファイルをそのまま読む場合も、列を揃えて1つのクエリにする。
+    """
+    frames = [scan_event_file(event_file) for event_file in event_files]
+    frames += [scan_monthly_prescription_events(drug_file, santei_file) for drug_file, santei_file in stale_sources]
+    lf = pl.concat(frames, how="vertical_relaxed") if len(frames) > 1 else frames[0]
+    if drug_codes is not None:
+        lf = lf.filter(pl.col("drug_code").is_in(drug_codes))
+    return lf
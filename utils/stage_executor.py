@@ -0,0 +1,61 @@
+"""
+独立した処理ステージの並行実行ユーティリティ
+互いに依存しないステージをスレッドプールで同時に実行します。
+新しいステージは、実行開始時からのプロセスのメモリ増加量がメモリ予算内の場合にのみ開始します
+"""
+
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Tuple
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# 実行中のステージの完了を待つ間隔（秒）。この間隔でメモリ使用量を確認し、次のステージを開始する
+DEFAULT_POLL_INTERVAL = 0.5
+
+
+def run_stages(stages: List[Tuple[str, Callable[[], Any]]],
+               max_workers: int,
+               memory_budget: int,
+               poll_interval: float = DEFAULT_POLL_INTERVAL) -> Dict[str, Any]:
+    """
+    ステージを並行実行し、ステージ名毎の戻り値を返す
+
+    Args:
+        stages: (ステージ名, 引数なしの関数) のリスト。この順に開始する
+        max_workers: 同時に実行するステージ数の上限
+        memory_budget: 実行開始時からのメモリ増加量（バイト）の上限。
+                       超えている間は新しいステージを開始しない（実行中のステージがない場合は開始する）
+        poll_interval: メモリ使用量を確認する間隔（秒）
+
+    Returns:
+        Dict[str, Any]: ステージ名 -> 戻り値。いずれかのステージの例外はそのまま送出する
+    """
+    process = psutil.Process()
+    baseline_rss = process.memory_info().rss
+    pending = list(stages)
+    running = {}
+    results = {}
+    start_times = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while pending or running:
+            memory_used = process.memory_info().rss - baseline_rss
+            while pending and len(running) < max_workers and (not running or memory_used < memory_budget):
+                name, func = pending.pop(0)
+                logger.info(f"ステージ開始: {name}（メモリ増加量 {memory_used / 1024**2:.0f} MB / 予算 {memory_budget / 1024**2:.0f} MB）")
+                start_times[name] = time.time()
+                running[executor.submit(func)] = name
+            if pending and running and memory_used >= memory_budget:
+                logger.debug(f"run_stages: メモリ予算に達しているため {pending[0][0]} の開始を待機します")
+
+            done, _ = wait(list(running), timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                results[name] = future.result()
+                logger.info(f"ステージ完了: {name}（{time.time() - start_times[name]:.2f}秒）")
+
+    return results
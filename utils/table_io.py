@@ -0,0 +1,111 @@
+"""
+テーブルファイルの入出力ユーティリティ
+zstd圧縮のFeather（既定）、Parquet、非圧縮のArrow IPCのいずれの形式でも同じ手順で読み書きできるようにします。
+Parquetは行グループ毎のmin/max統計を持つため、並べ替えて保存しておくと
+pl.scan_parquet のフィルタ条件で不要な行グループの読み込みを省けます。
+非圧縮のArrow IPC（.arrow）はメモリマップで読み込むため、展開処理なしにページキャッシュから直接参照できます
+"""
+
+import os
+import logging
+from typing import List, Optional, Sequence, Union
+
+import polars as pl
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_FORMATS = {
+    "feather": ".feather",
+    "parquet": ".parquet",
+    "arrow": ".arrow",
+}
+
+# 同名のファイルが複数ある場合はこの順に優先する
+TABLE_EXTENSIONS = (".parquet", ".feather", ".arrow")
+
+# Parquetの行グループあたりの行数（小さいほど統計による読み飛ばしが細かくなる）
+DEFAULT_ROW_GROUP_SIZE = 128_000
+
+Source = Union[str, Sequence[str]]
+
+
+def is_table_file(filename: str, prefix: str = "") -> bool:
+    """テーブルファイル（補助ファイルを除く）か"""
+    basename = os.path.basename(filename)
+    return (basename.startswith(prefix) and not basename.startswith("_")
+            and basename.endswith(TABLE_EXTENSIONS))
+
+
+def table_name(filename: str) -> str:
+    """拡張子を除いたテーブル名"""
+    basename = os.path.basename(filename)
+    for extension in TABLE_EXTENSIONS:
+        if basename.endswith(extension):
+            return basename[:-len(extension)]
+    return basename
+
+
+def list_table_files(directory: str, prefix: str = "") -> List[str]:
+    """ディレクトリ内のテーブルファイルのリスト（未作成の場合は空）"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(os.path.join(directory, f) for f in os.listdir(directory) if is_table_file(f, prefix))
+
+
+def get_table_path(directory: str, name: str, output_format: str = "feather") -> str:
+    """出力形式に応じたテーブルファイルのパス"""
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"不明な出力形式です: {output_format}")
+    return os.path.join(directory, name + OUTPUT_FORMATS[output_format])
+
+
+def find_table(directory: str, name: str) -> Optional[str]:
+    """拡張子を問わずテーブルファイルを探す（見つからない場合はNone）"""
+    for extension in TABLE_EXTENSIONS:
+        path = os.path.join(directory, name + extension)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def scan_table(source: Source) -> pl.LazyFrame:
+    """テーブルファイル（単一または複数）を拡張子に応じてスキャン"""
+    first = source if isinstance(source, str) else source[0]
+    if first.endswith(".parquet"):
+        return pl.scan_parquet(source)
+    # 非圧縮のArrow IPCのみメモリマップする（圧縮ファイルは展開が必要なため従来どおり）
+    return pl.scan_ipc(source, memory_map=first.endswith(".arrow"))
+
+
+def read_table(path: str) -> pl.DataFrame:
+    """テーブルファイルを拡張子に応じて読み込み"""
+    if path.endswith(".parquet"):
+        return pl.read_parquet(path)
+    return pl.read_ipc(path, memory_map=path.endswith(".arrow"))
+
+
+def write_table(df: pl.DataFrame, path: str,
+                sort_keys: Optional[List[str]] = None,
+                row_group_size: int = DEFAULT_ROW_GROUP_SIZE):
+    """拡張子に応じてテーブルファイルを書き込み
+
+    Parquetの場合は sort_keys で並べ替え、行グループ毎の統計を付けて保存する。
+    書き込み途中のファイルを読まれないよう、一時ファイルに書いてから置き換える。
+    形式を切り替えた場合に古い結果が読まれないよう、同名の別形式のファイルは削除する。
+    """
+    tmp_path = path + ".tmp"
+    if path.endswith(".parquet"):
+        if sort_keys:
+            df = df.sort([key for key in sort_keys if key in df.columns])
+        df.write_parquet(tmp_path, compression="zstd", statistics=True, row_group_size=row_group_size)
+    elif path.endswith(".arrow"):
+        df.write_ipc(tmp_path, compression="uncompressed")
+    else:
+        df.write_ipc(tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+
+    directory, name = os.path.dirname(path), table_name(path)
+    for extension in TABLE_EXTENSIONS:
+        other_path = os.path.join(directory, name + extension)
+        if other_path != path and os.path.exists(other_path):
+            os.remove(other_path)
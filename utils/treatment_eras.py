@@ -0,0 +1,105 @@
+"""
+治療エピソード（treatment era）作成ユーティリティ
+処方イベントを患者・処方日順に並べ、処方日数で求めた各処方の終了日と次の処方日の間隔が
+許容日数以内であれば同じエピソードとして連結します（患者毎の累積最大・shift・累積和による列演算）
+"""
+
+import logging
+from datetime import date
+from typing import Dict, Optional
+
+import polars as pl
+
+from utils.canonical_schema import with_date_columns
+
+logger = logging.getLogger(__name__)
+
+TREATMENT_ERA_SCHEMA = {
+    "kojin_id": pl.Int64,
+    "era_number": pl.UInt32,
+    "era_start": pl.Date,
+    "era_end": pl.Date,
+    "duration_days": pl.Int64,
+    "n_fills": pl.UInt32,
+    "first_drug": pl.String,
+    "censored": pl.Boolean,
+}
+
+
+def build_treatment_eras(events: pl.LazyFrame,
+                         index_dates: pl.DataFrame,
+                         drug_names: Dict[int, str],
+                         allowed_gap_days: int,
+                         default_days_supply: int,
+                         observation_end: date,
+                         follow_up_ends: Optional[pl.DataFrame] = None) -> pl.DataFrame:
+    """
+    インデックス日以降の対象薬剤の処方から、患者毎の治療エピソードを作成
+
+    Args:
+        events: 処方イベント（kojin_id, shohou_ymd, drug_code, days_supply）
+        index_dates: 患者毎のインデックス日（kojin_id, index_date）
+        drug_names: 対象薬剤の drug_code -> 薬剤名
+        allowed_gap_days: 前の処方の終了日から次の処方日までの許容日数（超えると別エピソード）
+        default_days_supply: 処方日数（days_supply）が欠損・0の場合に用いる日数
+        observation_end: 観察期間の終了日（follow_up_ends にない患者の追跡終了日）
+        follow_up_ends: 患者毎の追跡終了日（kojin_id, follow_up_end）。処方とエピソード終了日はこの日で打ち切る
+
+    Returns:
+        pl.DataFrame: kojin_id, era_number（1始まり）, era_start, era_end, duration_days, n_fills,
+                      first_drug（エピソード最初の処方の薬剤名。同日に複数ある場合は drug_code の小さい方）,
+                      censored（終了日＋許容日数が追跡終了日を超え、継続の有無が観察できないエピソード）
+    """
+    schema = events.collect_schema()
+    days_supply = (pl.col("days_supply") if "days_supply" in schema
+                   else pl.lit(None, dtype=pl.Float64))
+    drug_map = pl.DataFrame({"drug_code": list(drug_names.keys()), "drug_name": list(drug_names.values())},
+                            schema_overrides={"drug_code": schema["drug_code"]})
+    index_dates = with_date_columns(index_dates.select(["kojin_id", "index_date"]), ["index_date"])
+    if follow_up_ends is not None:
+        index_dates = index_dates.join(follow_up_ends.select(["kojin_id", "follow_up_end"]), on="kojin_id", how="left")
+    else:
+        index_dates = index_dates.with_columns(pl.lit(None, dtype=pl.Date).alias("follow_up_end"))
+    index_dates = index_dates.with_columns(pl.col("follow_up_end").fill_null(pl.lit(observation_end)))
+
+    fills = (events
+             .select(["kojin_id", "shohou_ymd", "drug_code", days_supply.alias("days_supply")])
+             .join(drug_map.lazy(), on="drug_code", how="inner")
+             .join(index_dates.lazy(), on="kojin_id", how="inner")
+             .filter((pl.col("shohou_ymd") >= pl.col("index_date")) & (pl.col("shohou_ymd") <= pl.col("follow_up_end")))
+             .with_columns(
+                 pl.when(pl.col("days_supply") > 0)
+                 .then(pl.col("days_supply"))
+                 .otherwise(default_days_supply)
+                 .cast(pl.Int64)
+                 .alias("days_supply"))
+             .with_columns((pl.col("shohou_ymd") + pl.duration(days=pl.col("days_supply"))).alias("fill_end"))
+             .sort(["kojin_id", "shohou_ymd", "fill_end", "drug_code"]) # 同日の複数薬剤は drug_code 順
+             .collect(engine="streaming"))
+    logger.debug(f"build_treatment_eras: 対象薬剤の処方数 = {len(fills)}")
+    if fills.is_empty():
+        return pl.DataFrame(schema=TREATMENT_ERA_SCHEMA)
+
+    # それまでの処方の終了日の最大値（重なる処方を含めたカバー期間の終了日）より
+    # 許容日数を超えて後の処方から新しいエピソードとする
+    covered_until = pl.col("fill_end").cum_max().shift(1).over("kojin_id")
+    new_era = (covered_until.is_null()
+               | (pl.col("shohou_ymd") > covered_until + pl.duration(days=allowed_gap_days)))
+    eras = (fills
+            .with_columns(new_era.cast(pl.UInt32).cum_sum().over("kojin_id").alias("era_number"))
+            .group_by(["kojin_id", "era_number"])
+            .agg([
+                pl.col("shohou_ymd").first().alias("era_start"),
+                pl.col("fill_end").max().alias("era_end"),
+                pl.len().alias("n_fills"),
+                pl.col("drug_name").first().alias("first_drug"),
+                pl.col("follow_up_end").first(),
+            ])
+            .with_columns([
+                (pl.col("era_end") + pl.duration(days=allowed_gap_days) > pl.col("follow_up_end")).alias("censored"),
+                pl.min_horizontal(pl.col("era_end"), pl.col("follow_up_end")).alias("era_end"),
+            ])
+            .with_columns((pl.col("era_end") - pl.col("era_start")).dt.total_days().alias("duration_days"))
+            .select(list(TREATMENT_ERA_SCHEMA))
+            .sort(["kojin_id", "era_number"]))
+    return eras.cast(TREATMENT_ERA_SCHEMA)
@@ -0,0 +1,130 @@
+"""
+治療状態の推移（Figure 4 のSankey図）のユーティリティ
+インデックス日からの経過日数で追跡期間を一定長の区間に分け、処方イベントの患者×区間の集約から
+各区間の治療状態（薬剤の区分 / none / lost）を割り当て、隣り合う区間の間の推移を数えます
+"""
+
+import logging
+from datetime import date
+from typing import Dict, List
+
+import polars as pl
+
+from utils.canonical_schema import with_date_columns
+
+logger = logging.getLogger(__name__)
+
+# 処方のない区間、追跡終了後の区間の状態
+NO_TREATMENT_STATE = "none"
+LOST_STATE = "lost"
+
+INTERVAL_STATE_SCHEMA = {
+    "kojin_id": pl.Int64,
+    "interval_number": pl.UInt32,
+    "state": pl.String,
+}
+
+TRANSITION_SCHEMA = {
+    "from_interval": pl.UInt32,
+    "to_interval": pl.UInt32,
+    "from_state": pl.String,
+    "to_state": pl.String,
+    "n_patients": pl.UInt32,
+}
+
+
+def follow_up_end_expr(column: str, dtype: pl.DataType, observation_end: date) -> pl.Expr:
+    """観察可能終了年月（"YYYY/MM"）の月末と観察期間の終了日の早い方（空の場合は観察期間の終了日）"""
+    month_start = pl.col(column) if dtype == pl.Date else (pl.col(column).cast(pl.String) + "/01").str.to_date("%Y/%m/%d")
+    return pl.min_horizontal(month_start.dt.month_end(), pl.lit(observation_end)).fill_null(pl.lit(observation_end))
+
+
+def interval_treatments(events: pl.LazyFrame,
+                        index_dates: pl.DataFrame,
+                        drug_states: Dict[int, str],
+                        state_order: List[str],
+                        interval_days: int,
+                        n_intervals: int) -> pl.DataFrame:
+    """
+    処方イベントを患者×区間に集約し、区間の治療状態を決める（処方のある区間のみ）
+
+    区間 k（1始まり）はインデックス日＋(k-1)×interval_days 日からの interval_days 日間。
+    同じ区間に複数の区分の処方がある場合は state_order の先の区分とする。
+
+    Args:
+        events: 処方イベント（kojin_id, shohou_ymd, drug_code）
+        index_dates: kojin_id, index_date
+        drug_states: drug_code -> 治療状態（区分）
+        state_order: 区分の優先順
+
+    Returns:
+        pl.DataFrame: kojin_id, interval_number, state（INTERVAL_STATE_SCHEMA）
+    """
+    schema = events.collect_schema()
+    states = pl.DataFrame({"drug_code": list(drug_states.keys()),
+                           "priority": [state_order.index(state) for state in drug_states.values()]},
+                          schema_overrides={"drug_code": schema["drug_code"], "priority": pl.UInt32})
+    index_dates = with_date_columns(index_dates.select(["kojin_id", "index_date"]), ["index_date"])
+    interval_number = ((pl.col("shohou_ymd") - pl.col("index_date")).dt.total_days() // interval_days + 1)
+    treated = (events
+               .select(["kojin_id", "shohou_ymd", "drug_code"])
+               .join(states.lazy(), on="drug_code", how="inner")
+               .join(index_dates.lazy(), on="kojin_id", how="inner")
+               .with_columns(interval_number.alias("interval_number"))
+               .filter(pl.col("interval_number").is_between(1, n_intervals))
+               .group_by(["kojin_id", "interval_number"])
+               .agg(pl.col("priority").min())
+               .collect(engine="streaming"))
+    state_names = pl.DataFrame({"priority": list(range(len(state_order))), "state": state_order},
+                               schema={"priority": pl.UInt32, "state": pl.String})
+    return (treated
+            .join(state_names, on="priority", how="left")
+            .select(list(INTERVAL_STATE_SCHEMA))
+            .cast(INTERVAL_STATE_SCHEMA)
+            .sort(["kojin_id", "interval_number"]))
+
+
+def assign_states(patients: pl.DataFrame,
+                  treatments: pl.DataFrame,
+                  interval_days: int,
+                  n_intervals: int) -> pl.DataFrame:
+    """
+    全患者×全区間の治療状態（区間の開始日が追跡終了日より後なら lost、処方がなければ none）
+
+    Args:
+        patients: kojin_id, index_date, follow_up_end
+        treatments: interval_treatments の結果
+
+    Returns:
+        pl.DataFrame: kojin_id, interval_number, state（INTERVAL_STATE_SCHEMA）
+    """
+    patients = with_date_columns(patients.select(["kojin_id", "index_date", "follow_up_end"]), ["index_date"])
+    interval_start = pl.col("index_date") + pl.duration(days=(pl.col("interval_number") - 1) * interval_days)
+    grid = (patients
+            .with_columns(pl.int_ranges(1, n_intervals + 1, dtype=pl.UInt32).alias("interval_number"))
+            .explode("interval_number", empty_as_null=False)
+            .join(treatments, on=["kojin_id", "interval_number"], how="left")
+            .with_columns(pl.when(interval_start > pl.col("follow_up_end"))
+                          .then(pl.lit(LOST_STATE))
+                          .otherwise(pl.col("state").fill_null(NO_TREATMENT_STATE))
+                          .alias("state")))
+    return grid.select(list(INTERVAL_STATE_SCHEMA)).cast(INTERVAL_STATE_SCHEMA).sort(["kojin_id", "interval_number"])
+
+
+def transition_counts(states: pl.DataFrame) -> pl.DataFrame:
+    """
+    隣り合う区間の間の治療状態の推移毎の患者数（Sankey図のリンク）
+
+    Returns:
+        pl.DataFrame: from_interval, to_interval, from_state, to_state, n_patients（TRANSITION_SCHEMA）
+    """
+    transitions = (states
+                   .sort(["kojin_id", "interval_number"])
+                   .with_columns([pl.col("interval_number").shift(-1).over("kojin_id").alias("to_interval"),
+                                  pl.col("state").shift(-1).over("kojin_id").alias("to_state")])
+                   .filter(pl.col("to_interval").is_not_null())
+                   .group_by([pl.col("interval_number").alias("from_interval"), "to_interval",
+                              pl.col("state").alias("from_state"), "to_state"])
+                   .agg(pl.len().alias("n_patients"))
+                   .sort(["from_interval", "from_state", "to_state"]))
+    return transitions.select(list(TRANSITION_SCHEMA)).cast(TRANSITION_SCHEMA)
@@ -0,0 +1,87 @@
+"""
+メモリマップ用作業コピー（working copy）のユーティリティ
+頻繁に読み込むテーブル（receipt_diseases、receipt_drug、tekiyo、m_icd10）を非圧縮のArrow IPC（.arrow）で
+複製しておき、読み込み時は展開なしにメモリマップで参照できるようにします
+"""
+
+import os
+import json
+import logging
+from typing import Dict, List, Optional
+
+from utils.env_loader import DATA_ROOT_DIR
+from utils.partition_index import get_file_signature
+from utils.table_io import list_table_files
+
+logger = logging.getLogger(__name__)
+
+# 作業コピーの既定の出力先
+DEFAULT_WORKING_COPY_DIR = os.path.join(DATA_ROOT_DIR, "mmap")
+
+# 全ファイルの書き込み完了後に作成するマニフェスト（これがある場合のみ読み込み側が利用する）
+WORKING_COPY_MANIFEST_FILENAME = "_working_copy_manifest.json"
+
+# 作業コピーを作成するテーブル（テーブル名: 月次ファイルのディレクトリか単一ファイルか）
+HOT_TABLES: Dict[str, bool] = {
+    "receipt_diseases": True,
+    "receipt_drug": True,
+    "tekiyo": False,
+    "m_icd10": False,
+}
+
+
+def load_working_copy_manifest(working_copy_dir: str) -> Optional[Dict]:
+    """マニフェストの読み込み（作業コピーが未作成の場合はNone）"""
+    manifest_path = os.path.join(working_copy_dir, WORKING_COPY_MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_working_copy_manifest(working_copy_dir: str, manifest: Dict):
+    """マニフェストの保存（全ファイルの書き込み完了後に呼び出す）"""
+    manifest_path = os.path.join(working_copy_dir, WORKING_COPY_MANIFEST_FILENAME)
+    with open(manifest_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+def stale_working_copy_files(table: str, table_manifest: Dict) -> List[str]:
+    """
+    作業コピーの作成後に複製元が追加・更新・削除されたファイル（複製元のファイル名）
+
+    記録した複製元のサイズ・更新時刻と現在の複製元を照合し、月次ファイルのテーブルは
+    複製元のディレクトリに作成後に追加されたファイルも含める。
+    """
+    sources = [entry["source"] for entry in table_manifest["files"].values()]
+    stale = [os.path.basename(entry["source"]) for entry in table_manifest["files"].values()
+             if not os.path.exists(entry["source"])
+             or get_file_signature(entry["source"]) != (entry["source_size"], entry["source_mtime"])]
+    if table_manifest["partitioned"]:
+        source_dirs = {os.path.dirname(source) for source in sources}
+        recorded = {os.path.basename(source) for source in sources}
+        stale += [os.path.basename(f) for source_dir in source_dirs for f in list_table_files(source_dir, table)
+                  if os.path.basename(f) not in recorded]
+    return stale
+
+
+def resolve_table_dir(table: str, default_dir: str,
+                      working_copy_dir: str = DEFAULT_WORKING_COPY_DIR) -> str:
+    """テーブルを読み込むディレクトリ（作業コピーがあり、複製元と一致する場合はそちら）
+
+    月次ファイルのテーブルはパーティションディレクトリを、単一ファイルのテーブルは
+    ファイルを置くディレクトリを default_dir に指定する。
+    """
+    manifest = load_working_copy_manifest(working_copy_dir)
+    if manifest is None or table not in manifest["tables"]:
+        return default_dir
+    stale = stale_working_copy_files(table, manifest["tables"][table])
+    if stale:
+        # 作成後に追加・更新されたデータを読み落とさないよう、元のデータから読み込む
+        logger.warning(f"{table}: メモリマップ用作業コピーが複製元と一致しないため使用しません"
+                       f"（{len(stale)} ファイル、例: {stale[0]}。build_working_copy.py を再実行してください）")
+        return default_dir
+    logger.info(f"{table}: メモリマップ用作業コピーを使用します")
+    if manifest["tables"][table]["partitioned"]:
+        return os.path.join(working_copy_dir, table)
+    return working_copy_dir